@@ -2,3 +2,5 @@ from __future__ import division, absolute_import, print_function
 from . import util
 from . import calibration
 from . import abstention
+from . import serialization
+from . import experiments
@@ -1,8 +1,12 @@
 from __future__ import division, print_function, absolute_import
 import numpy as np
-from sklearn.metrics import roc_auc_score
-#from sklearn.metrics import average_precision_score
-import sys
+from multiprocessing.pool import ThreadPool
+import copy
+import time
+import shutil
+import tempfile
+from .instrumentation import get_instrumentation
+from .util import external_argsort, get_float_dtype
 
 
 def basic_average_precision_score(y_true, y_score):
@@ -21,14 +25,367 @@ def basic_average_precision_score(y_true, y_score):
     average_precision = np.sum(sorted_y_true*precisions)/(num_pos)
     return average_precision
 
-average_precision_score = basic_average_precision_score
+
+def as_score_columns(y_true, y_score):
+    #returns y_true and y_score as (n, num_columns) arrays, and whether the
+    #scores were 1-D; a 1-D y_true is shared by all columns of y_score
+    y_true = np.asarray(y_true)
+    y_score = np.asarray(y_score)
+    is_1d = (y_score.ndim == 1)
+    if (is_1d):
+        y_score = y_score[:,None]
+        y_true = y_true.reshape(-1)[:,None]
+    elif (y_true.ndim == 1):
+        y_true = np.broadcast_to(y_true[:,None], y_score.shape)
+    return y_true, y_score, is_1d
+
+
+def sorted_tie_bounds(sorted_score):
+    """
+        For columns sorted in ascending order, returns for every entry the
+        row where its run of tied scores starts and the row just past
+        where it ends
+    """
+    num_rows = sorted_score.shape[0]
+    rows = np.arange(num_rows)[:,None]
+    tied_with_previous = np.zeros(sorted_score.shape, dtype="bool")
+    tied_with_previous[1:] = sorted_score[1:]==sorted_score[:-1]
+    tied_with_next = np.zeros(sorted_score.shape, dtype="bool")
+    tied_with_next[:-1] = tied_with_previous[1:]
+    tie_start = np.maximum.accumulate(
+                    np.where(tied_with_previous, 0, rows), axis=0)
+    tie_end = np.minimum.accumulate(
+                    np.where(tied_with_next, num_rows, rows+1)[::-1],
+                    axis=0)[::-1]
+    return tie_start, tie_end
+
+
+def sort_score_columns(y_true, y_score):
+    order = np.argsort(y_score, axis=0, kind="mergesort")
+    columns = np.arange(y_score.shape[1])
+    return (y_true==1)[order, columns], y_score[order, columns]
+
+
+def auroc_score(y_true, y_score):
+    """
+        auROC from the Mann-Whitney U statistic, with tied scores given
+        their average rank. y_true and y_score can be (n, num_columns) to
+        score many columns (tasks, resamples...) in one call, in which case
+        an array of num_columns values is returned.
+    """
+    y_true, y_score, is_1d = as_score_columns(y_true, y_score)
+    sorted_is_pos, sorted_score = sort_score_columns(y_true, y_score)
+    tie_start, tie_end = sorted_tie_bounds(sorted_score)
+    #ranks are 1-based, so the average rank of rows [start, end) is:
+    average_ranks = 0.5*(tie_start + 1 + tie_end)
+    num_pos = np.sum(sorted_is_pos, axis=0)
+    num_neg = len(sorted_is_pos) - num_pos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auroc = ((np.sum(average_ranks*sorted_is_pos, axis=0)
+                  - 0.5*num_pos*(num_pos+1))/(num_pos*num_neg))
+    return auroc[0] if is_1d else auroc
+
+
+def average_precision_from_sorted(sorted_is_pos, sorted_score):
+    #columns must be sorted by ascending score
+    tie_start, tie_end = sorted_tie_bounds(sorted_score)
+    columns = np.arange(sorted_score.shape[1])
+    num_pos = np.sum(sorted_is_pos, axis=0)
+    num_above = len(sorted_score) - tie_end
+    num_pos_above = num_pos - np.cumsum(sorted_is_pos, axis=0)[
+                                    tie_end-1, columns]
+    #the precision of an example is that of the examples scored strictly
+    #above it, and 1 if there are none
+    precisions = num_pos_above/np.maximum(num_above, 1).astype("float64")
+    precisions[num_above==0] = 1.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(sorted_is_pos*precisions, axis=0)/num_pos
+
+
+def average_precision_score(y_true, y_score):
+    """
+        Same definition as basic_average_precision_score, but vectorized,
+        and examples with tied scores are not ranked above each other
+        (instead of being ordered arbitrarily by the sort). y_true and
+        y_score can be (n, num_columns), as for auroc_score.
+    """
+    y_true, y_score, is_1d = as_score_columns(y_true, y_score)
+    average_precision = average_precision_from_sorted(
+                            *sort_score_columns(y_true, y_score))
+    return average_precision[0] if is_1d else average_precision
+
+
+class FenwickTree(object):
+
+    """
+        Binary indexed tree over positions 0..size-1, all zero or
+        initialized from values in O(size). add and prefix_sum are
+        vectorized over arrays of positions, for batches of updates;
+        add_one, prefix_sum_one and find_prefix are their scalar forms,
+        for one update at a time (as in eviction).
+    """
+
+    def __init__(self, size, values=None):
+        self.size = size
+        self.num_levels = int(size).bit_length()
+        self.top_node = 1 << (self.num_levels-1) if size else 0
+        self.tree = np.zeros(size+1)
+        if (values is not None):
+            #node i (1-based) holds the sum over positions [i - (i & -i), i)
+            nodes = np.arange(1, size+1)
+            cumsum_values = np.concatenate(
+                [[0.0], np.cumsum(values, dtype="float64")])
+            self.tree[1:] = (cumsum_values[nodes]
+                             - cumsum_values[nodes - (nodes & -nodes)])
+
+    def add(self, positions, values):
+        idx = np.asarray(positions)+1
+        values = np.asarray(values, dtype="float64")*np.ones(len(idx))
+        while (len(idx) > 0):
+            np.add.at(self.tree, idx, values)
+            idx = idx + (idx & -idx)
+            keep = idx <= self.size
+            idx, values = idx[keep], values[keep]
+
+    def prefix_sum(self, positions):
+        #sum of the values at positions strictly below each of `positions`
+        idx = np.array(positions)
+        total = np.zeros(len(idx))
+        for level in range(self.num_levels):
+            total += self.tree[idx]
+            idx -= (idx & -idx)
+        return total
+
+    def add_one(self, position, value):
+        tree, size = self.tree, self.size
+        node = position+1
+        while (node <= size):
+            tree[node] += value
+            node += node & -node
+
+    def prefix_sum_one(self, position):
+        #sum of the values at positions strictly below position
+        tree = self.tree
+        total = 0.0
+        while (position > 0):
+            total += tree[position]
+            position &= position-1
+        return total
+
+    def find_prefix(self, target):
+        #the first position where the running sum of the values (which
+        #must be non-negative) reaches target; with 0/1 values, the
+        #position of the target-th item (1-based)
+        tree, size = self.tree, self.size
+        node = 0
+        step = self.top_node
+        while (step > 0):
+            if (node+step <= size and tree[node+step] < target):
+                node += step
+                target -= tree[node]
+            step >>= 1
+        return node
+
+
+def count_pairs_ranked_above(ranks_above, ranks_below):
+    #for each of ranks_above, the number of ranks_below under it
+    #(ties count 1/2); ranks_below must be sorted
+    return 0.5*(np.searchsorted(ranks_below, ranks_above, side="left")
+                + np.searchsorted(ranks_below, ranks_above, side="right"))
+
+
+def auroc_retention_curve(y_true, y_score, num_retained, batch_size=256):
+    """
+        auROC of the first num_retained[i] examples, for every i.
+        y_true and y_score should be in the order in which examples are
+        retained, which are added back in batches: the Mann-Whitney U
+        statistic (ties count 1/2) gains the pairs between a batch and the
+        earlier batches, counted with Fenwick trees over the score ranks,
+        plus the pairs within the batch. Batches that contain several
+        retention levels are at most batch_size long and their pairs are
+        compared directly; a larger batch holds no level but its last
+        example and its pairs are counted by sorting. The whole curve costs
+        O(n log n) plus O(batch_size) per example for dense levels.
+    """
+    y_true = np.asarray(y_true).squeeze()==1
+    y_score = np.asarray(y_score).squeeze()
+    num_retained = np.asarray(num_retained)
+    unique_scores, ranks = np.unique(y_score, return_inverse=True)
+    ranks = ranks.ravel()
+    num_ranks = len(unique_scores)
+    pos_tree = FenwickTree(num_ranks)
+    neg_tree = FenwickTree(num_ranks)
+
+    batch_ends = []
+    batch_start = 0
+    last_level = 0
+    for level in np.unique(num_retained):
+        if (level-batch_start > batch_size and last_level > batch_start):
+            batch_ends.append(last_level)
+            batch_start = last_level
+        last_level = level
+    batch_ends.append(last_level)
+
+    #pair_credit[i] is the U statistic gained when adding example i; for
+    #large batches the whole gain is put on the last example
+    pair_credit = np.zeros(last_level)
+    num_pos_so_far = 0
+    batch_start = 0
+    for batch_end in batch_ends:
+        batch_ranks = ranks[batch_start:batch_end]
+        batch_is_pos = y_true[batch_start:batch_end]
+        #pairs with earlier batches
+        num_below = len(batch_ranks)
+        neg_below = neg_tree.prefix_sum(
+                        np.concatenate([batch_ranks, batch_ranks+1]))
+        pos_below = pos_tree.prefix_sum(
+                        np.concatenate([batch_ranks, batch_ranks+1]))
+        neg_below = 0.5*(neg_below[:num_below] + neg_below[num_below:])
+        pos_below = 0.5*(pos_below[:num_below] + pos_below[num_below:])
+        credit = np.where(batch_is_pos, neg_below, num_pos_so_far-pos_below)
+        #pairs within the batch
+        if (batch_end-batch_start <= batch_size):
+            comparison = 0.5*(np.sign(batch_ranks[:,None]
+                                      - batch_ranks[None,:])+1)
+            opposite_class = batch_is_pos[:,None] != batch_is_pos[None,:]
+            earlier = np.tri(len(batch_ranks), k=-1, dtype="bool")
+            credit += np.sum(np.where(batch_is_pos[:,None],
+                                      comparison, 1-comparison)
+                             *(opposite_class*earlier), axis=1)
+            pair_credit[batch_start:batch_end] = credit
+        else:
+            pair_credit[batch_end-1] = np.sum(credit) + np.sum(
+                count_pairs_ranked_above(
+                    ranks_above=batch_ranks[batch_is_pos],
+                    ranks_below=np.sort(batch_ranks[batch_is_pos==False])))
+        pos_tree.add(batch_ranks[batch_is_pos], 1.0)
+        neg_tree.add(batch_ranks[batch_is_pos==False], 1.0)
+        num_pos_so_far += np.sum(batch_is_pos)
+        batch_start = batch_end
+
+    total_credit = np.cumsum(pair_credit)[num_retained-1]
+    num_pos = np.cumsum(y_true)[num_retained-1]
+    num_neg = num_retained - num_pos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return total_credit/(num_pos*num_neg)
+
+
+def average_precision_retention_curve(y_true, y_score, num_retained,
+                                      max_batch_entries=2**22):
+    """
+        Average precision of the first num_retained[i] examples, for every
+        i. y_true and y_score should be in the order in which examples are
+        retained. The examples are sorted by score once, and the retained
+        examples and positives above every example are counted at all the
+        retention levels with a (num_levels, n) cumsum over that order
+        (for as many levels at a time as fit in max_batch_entries).
+
+        This costs O(n) per level, i.e. O(num_levels*n), which is
+        quadratic for the curve at every retention level. Unlike the U
+        statistic of the auROC, average precision has no per-example
+        increments: the precision of a positive is a ratio of the counts
+        above it, which every example retained above it changes.
+    """
+    y_true, y_score, is_1d = as_score_columns(y_true, y_score)
+    sorted_is_pos, sorted_score = sort_score_columns(y_true, y_score)
+    #the position in retention order of every example in score order
+    retention_idx = np.argsort(y_score[:,0], kind="mergesort")
+    tie_end = sorted_tie_bounds(sorted_score)[1][:,0]
+    sorted_is_pos = sorted_is_pos[:,0]
+    pos_rows = np.nonzero(sorted_is_pos)[0]
+    pos_retention_idx = retention_idx[pos_rows]
+    pos_tie_end = tie_end[pos_rows]
+
+    num_retained = np.asarray(num_retained)
+    to_return = np.zeros(len(num_retained))
+    batch_size = max(max_batch_entries//max(len(retention_idx), 1), 1)
+    for batch_start in range(0, len(num_retained), batch_size):
+        levels = num_retained[batch_start:batch_start+batch_size]
+        #one row per level, cumulated along the score order
+        keep = retention_idx[None,:] < levels[:,None]
+        num_kept_upto = np.cumsum(keep, axis=1)
+        keep &= sorted_is_pos[None,:]
+        num_pos_kept_upto = np.cumsum(keep, axis=1)
+        num_pos = num_pos_kept_upto[:,-1:]
+        #the counts scored strictly above every positive, at every level
+        num_above = levels[:,None] - num_kept_upto[:,pos_tie_end-1]
+        num_pos_above = num_pos - num_pos_kept_upto[:,pos_tie_end-1]
+        precisions = num_pos_above/np.maximum(num_above, 1).astype("float64")
+        precisions[num_above==0] = 1.0
+        precisions *= pos_retention_idx[None,:] < levels[:,None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            to_return[batch_start:batch_start+batch_size] =\
+                np.sum(precisions, axis=1)/num_pos[:,0]
+    return to_return
+
+
+def get_tie_groups(sorted_score):
+    #start of every run of tied scores in a sorted 1-D array
+    return np.concatenate([[0], np.nonzero(sorted_score[1:]
+                                           != sorted_score[:-1])[0]+1])
+
+
+def weighted_auroc_from_groups(pos_weights, all_weights):
+    """
+        auROC of weighted examples, for every row of (num_resamples,
+        num_groups) weights of the positives and of all the examples in
+        each run of tied scores, runs in ascending order of score. Ties
+        count 1/2, as in auroc_score.
+    """
+    neg_weights = all_weights - pos_weights
+    neg_below = np.cumsum(neg_weights, axis=1)
+    num_neg = neg_below[:,-1].copy()
+    neg_below -= 0.5*neg_weights
+    num_pos = np.sum(pos_weights, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(pos_weights*neg_below, axis=1)/(num_pos*num_neg)
+
+
+def weighted_average_precision_from_groups(pos_weights, all_weights):
+    """
+        Average precision of weighted examples, as
+        weighted_auroc_from_groups; the precision of a run of tied scores
+        is that of the weight scored strictly above it, and 1 if there is
+        none, as in average_precision_score.
+    """
+    num_pos_above = np.cumsum(pos_weights, axis=1)
+    num_pos = num_pos_above[:,-1].copy()
+    num_pos_above = num_pos[:,None] - num_pos_above
+    num_above = np.cumsum(all_weights, axis=1)
+    num_above = num_above[:,-1:] - num_above
+    #the weights are counts, so an empty set above is exactly 0
+    precisions = np.where(num_above > 0,
+                          num_pos_above/np.maximum(num_above, 1), 1.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(pos_weights*precisions, axis=1)/num_pos
+
+
+def draw_bootstrap_counts(num_examples, num_resamples, rng):
+    """
+        (num_resamples, num_examples) matrix of how many times each
+        example is drawn in each bootstrap resample, from one matrix of
+        uniform draws
+    """
+    draws = rng.randint(num_examples, size=(num_resamples, num_examples))
+    draws += num_examples*np.arange(num_resamples)[:,None]
+    return np.bincount(draws.ravel(), minlength=num_resamples*num_examples
+                       ).reshape(num_resamples, num_examples)
 
 
 class AbstentionEval(object):
 
-    def __init__(self, metric, proportion_to_retain):
+    def __init__(self, metric, proportion_to_retain,
+                       retention_curve_func=None,
+                       metric_handles_columns=False,
+                       bootstrap_metric_func=None):
         self.metric = metric
         self.proportion_to_retain = proportion_to_retain
+        self.retention_curve_func = retention_curve_func
+        self.metric_handles_columns = metric_handles_columns
+        #computes the metric of weighted examples from the per-tie-group
+        #weights, for many resamples at once (see
+        #weighted_auroc_from_groups)
+        self.bootstrap_metric_func = bootstrap_metric_func
 
     def __call__(self, abstention_scores, y_true, y_score):
         #lower abstention score means KEEP
@@ -37,31 +394,197 @@ class AbstentionEval(object):
         return self.metric(y_true=y_true[indices],
                            y_score=y_score[indices])
 
+    def evaluate_many(self, abstention_scores, y_true, y_score):
+        """
+            abstention_scores is (n, num_candidates); returns the metric
+            for every candidate column, with all columns argsorted in one
+            call (and scored in one call if the metric handles columns)
+        """
+        indices = np.argsort(abstention_scores, axis=0)[
+                    :int(np.ceil(len(y_true)*self.proportion_to_retain))]
+        if (self.metric_handles_columns):
+            return self.metric(y_true=y_true[indices],
+                               y_score=y_score[indices])
+        return np.array([self.metric(y_true=y_true[indices[:,i]],
+                                     y_score=y_score[indices[:,i]])
+                         for i in range(indices.shape[1])])
+
+    def retention_curve(self, abstention_scores, y_true, y_score,
+                              proportions_to_retain=None):
+        """
+            Returns the metric at each of proportions_to_retain (all
+            retention levels if None), sorting the abstention scores once.
+            The auROC curve costs about O(n log n) however many
+            levels there are; the auPRC curve costs O(n) per level (see
+            average_precision_retention_curve).
+        """
+        num_examples = len(y_true)
+        if (proportions_to_retain is None):
+            num_retained = np.arange(1, num_examples+1)
+        else:
+            num_retained = self.get_num_retained(num_examples,
+                                                 proportions_to_retain)
+        indices = np.argsort(abstention_scores)
+        return self.sorted_retention_curve(y_true=y_true[indices],
+                                           y_score=y_score[indices],
+                                           num_retained=num_retained)
+
+    def get_num_retained(self, num_examples, proportions_to_retain):
+        return np.array([int(np.ceil(num_examples*proportion_to_retain))
+                         for proportion_to_retain in proportions_to_retain])
+
+    def sorted_retention_curve(self, y_true, y_score, num_retained):
+        #y_true and y_score are in the order in which examples are
+        #retained; levels that retain no example get nan
+        num_retained = np.asarray(num_retained)
+        to_return = np.full(len(num_retained), np.nan)
+        nonempty = num_retained > 0
+        if (self.retention_curve_func is not None):
+            to_return[nonempty] = self.retention_curve_func(
+                y_true=y_true, y_score=y_score,
+                num_retained=num_retained[nonempty])
+        else:
+            to_return[nonempty] = [
+                self.metric(y_true=y_true[:num_to_retain],
+                            y_score=y_score[:num_to_retain])
+                for num_to_retain in num_retained[nonempty]]
+        return to_return
+
+    def bootstrap_retention_curve(self, abstention_scores, y_true, y_score,
+                                        proportions_to_retain=None,
+                                        num_bootstraps=1000,
+                                        random_state=None, batch_size=None):
+        """
+            Returns a (num_bootstraps, num_levels) matrix of the metric at
+            each of proportions_to_retain (by default the evaluator's own
+            proportion_to_retain) on bootstrap resamples of the examples;
+            within a resample, the ceil(n*proportion) examples with the
+            lowest abstention scores are retained, as in __call__.
+
+            A resample is a row of counts of how often each example is
+            drawn. The examples are sorted once by abstention score and
+            once by y_score; then, for a batch of resamples (batch_size
+            rows, by default as many as fit in ~2**20 entries), each level
+            is a clip of the cumulative counts in retention order and a
+            cumsum over the runs of tied y_score, done for all the rows at
+            once by bootstrap_metric_func. Evaluators without one evaluate
+            the resamples one at a time.
+
+            random_state is a seed or a np.random.RandomState.
+        """
+        y_true = np.asarray(y_true).squeeze()
+        y_score = np.asarray(y_score).squeeze()
+        num_examples = len(y_true)
+        if (proportions_to_retain is None):
+            proportions_to_retain = [self.proportion_to_retain]
+        num_retained = self.get_num_retained(num_examples,
+                                             proportions_to_retain)
+        if (isinstance(random_state, np.random.RandomState) == False):
+            random_state = np.random.RandomState(random_state)
+        if (batch_size is None):
+            batch_size = max(2**20//max(num_examples, 1), 1)
+
+        retention_order = np.argsort(abstention_scores)
+        y_true = y_true[retention_order]==1
+        y_score = y_score[retention_order]
+        score_order = np.argsort(y_score, kind="mergesort")
+        group_starts = get_tie_groups(y_score[score_order])
+        sorted_is_pos = y_true[score_order]
+
+        to_return = []
+        for batch_start in range(0, num_bootstraps, batch_size):
+            counts = draw_bootstrap_counts(
+                        num_examples=num_examples,
+                        num_resamples=min(batch_size,
+                                          num_bootstraps-batch_start),
+                        rng=random_state)
+            if (self.bootstrap_metric_func is None):
+                to_return.extend(
+                    self.sorted_retention_curve(
+                        y_true=y_true[resample], y_score=y_score[resample],
+                        num_retained=num_retained)
+                    for resample in [np.repeat(np.arange(num_examples), row)
+                                     for row in counts])
+                continue
+            counts = counts.astype("float64")
+            #the draws before each example in retention order, then both
+            #moved to score order once for all the levels
+            counts_before = (np.cumsum(counts, axis=1)
+                             - counts)[:,score_order]
+            counts = counts[:,score_order]
+            batch_values = np.zeros((len(counts), len(num_retained)))
+            for level_idx, num_to_retain in enumerate(num_retained):
+                #how many of the draws of each example are retained
+                retained = np.clip(num_to_retain - counts_before,
+                                   0, counts)
+                pos_weights = retained*sorted_is_pos
+                if (len(group_starts) < num_examples):
+                    pos_weights = np.add.reduceat(pos_weights,
+                                                  group_starts, axis=1)
+                    retained = np.add.reduceat(retained, group_starts,
+                                               axis=1)
+                batch_values[:,level_idx] = self.bootstrap_metric_func(
+                    pos_weights=pos_weights, all_weights=retained)
+            to_return.extend(batch_values)
+        return np.array(to_return).reshape(num_bootstraps,
+                                           len(num_retained))
+
+    def bootstrap_intervals(self, abstention_scores, y_true, y_score,
+                                  proportions_to_retain=None,
+                                  confidence=0.95, **bootstrap_kwargs):
+        """
+            Percentile bootstrap confidence intervals of the metric at each
+            of proportions_to_retain: returns the arrays (lower, upper).
+            Resamples where the metric is undefined (e.g. no positives
+            retained) are ignored. bootstrap_kwargs are passed to
+            bootstrap_retention_curve.
+        """
+        values = self.bootstrap_retention_curve(
+                    abstention_scores=abstention_scores, y_true=y_true,
+                    y_score=y_score,
+                    proportions_to_retain=proportions_to_retain,
+                    **bootstrap_kwargs)
+        tail = 100*(1-confidence)/2
+        lower, upper = np.nanpercentile(values, [tail, 100-tail], axis=0)
+        return lower, upper
+
 
 class AuPrcAbstentionEval(AbstentionEval):
 
     def __init__(self, proportion_to_retain):
         super(AuPrcAbstentionEval, self).__init__(
             metric=average_precision_score,
-            proportion_to_retain=proportion_to_retain)
+            proportion_to_retain=proportion_to_retain,
+            retention_curve_func=average_precision_retention_curve,
+            metric_handles_columns=True,
+            bootstrap_metric_func=weighted_average_precision_from_groups)
 
 
 class AuRocAbstentionEval(AbstentionEval):
 
     def __init__(self, proportion_to_retain):
         super(AuRocAbstentionEval, self).__init__(
-            metric=roc_auc_score,
-            proportion_to_retain=proportion_to_retain)
+            metric=auroc_score,
+            proportion_to_retain=proportion_to_retain,
+            retention_curve_func=auroc_retention_curve,
+            metric_handles_columns=True,
+            bootstrap_metric_func=weighted_auroc_from_groups)
     
 
 class ThresholdFinder(object):
 
+    #whether (n, num_tasks) labels and posteriors can be passed in one call,
+    #returning one threshold per task
+    handles_multiple_tasks = False
+
     def __call__(self, valid_labels, valid_posterior):
         raise NotImplementedError()
 
 
 class FixedThreshold(ThresholdFinder):
 
+    handles_multiple_tasks = True
+
     def __init__(self, threshold):
         self.threshold = threshold
 
@@ -71,42 +594,121 @@ class FixedThreshold(ThresholdFinder):
 
 class OptimalF1(ThresholdFinder):
 
+    """
+        Finds the threshold on the posterior that maximizes the F-beta
+        score on the validation set. If range_to_search is None, every
+        distinct threshold is considered: the posteriors are sorted once
+        and the confusion counts at every cut-off come from cumulative
+        sums. valid_labels and valid_posterior can also be (n, num_tasks)
+        arrays, in which case one threshold per task is returned.
+    """
+
+    handles_multiple_tasks = True
+
     def __init__(self, beta,
                        range_to_search=np.arange(0.00, 1.00, 0.01),
-                       verbose=True):
+                       verbose=True, instrumentation=None):
         self.beta = beta
         self.range_to_search = range_to_search
         self.verbose = verbose
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
+
+    def compute_fbeta(self, true_positives, predicted_positives,
+                            total_positives):
+        precision = true_positives/\
+                    (predicted_positives + np.finfo(np.float32).eps)
+        recall = true_positives/\
+                    (total_positives + np.finfo(np.float32).eps)
+        bb = self.beta ** 2
+        return ((1 + bb) * (precision * recall)) /\
+                (bb * precision + recall + np.finfo(np.float32).eps)
 
     def __call__(self, valid_labels, valid_posterior):
+        if (self.instrumentation is not None):
+            start_time = time.time()
+        if (self.range_to_search is None):
+            best_threshold = self.search_all_thresholds(
+                                valid_labels=valid_labels,
+                                valid_posterior=valid_posterior)
+        else:
+            best_threshold = self.search_range(
+                                valid_labels=valid_labels,
+                                valid_posterior=valid_posterior)
+        if (self.instrumentation is not None):
+            self.instrumentation.on_event("optimal_f1.threshold",
+                {"threshold": best_threshold,
+                 "seconds": time.time() - start_time})
+        return best_threshold 
+
+    def search_range(self, valid_labels, valid_posterior):
 
         valid_labels = np.array(valid_labels) 
-        total_positives = np.sum(valid_labels==1)
+        total_positives = np.sum(valid_labels==1, axis=0)
 
-        best_score = -1
-        best_threshold = 0
+        #one entry per task (0-d for a single task)
+        best_score = -np.ones(np.shape(total_positives))
+        best_threshold = np.zeros(np.shape(total_positives))
         for threshold in self.range_to_search:
             y_pred = np.array(valid_posterior > threshold)
-            true_positives = np.sum(valid_labels*y_pred)
-            predicted_positives = np.sum(y_pred)
-            precision = float(true_positives)/\
-                        (predicted_positives + np.finfo(np.float32).eps)
-            recall = float(true_positives)/\
-                        (total_positives + np.finfo(np.float32).eps)
-            bb = self.beta ** 2
-            score = ((1 + bb) * (precision * recall)) /\
-                    (bb * precision + recall + np.finfo(np.float32).eps)
-            if score > best_score:
-                best_threshold = threshold
-                best_score = score   
-        if (self.verbose):
-            print("Threshold is",best_threshold)
-            sys.stdout.flush()
-        return best_threshold 
+            true_positives = np.sum(valid_labels*y_pred, axis=0)
+            predicted_positives = np.sum(y_pred, axis=0)
+            score = self.compute_fbeta(
+                        true_positives=true_positives.astype("float64"),
+                        predicted_positives=predicted_positives,
+                        total_positives=total_positives)
+            improved = score > best_score
+            best_threshold = np.where(improved, threshold, best_threshold)
+            best_score = np.where(improved, score, best_score)
+        return best_threshold[()]
+
+    def search_all_thresholds(self, valid_labels, valid_posterior):
+
+        valid_labels = np.asarray(valid_labels)
+        valid_posterior = np.asarray(valid_posterior)
+        is_1d = (valid_posterior.ndim == 1)
+        if (is_1d):
+            valid_labels = valid_labels[:,None]
+            valid_posterior = valid_posterior[:,None]
+        num_examples = valid_posterior.shape[0]
+
+        sorted_indices = np.argsort(valid_posterior, axis=0, kind="mergesort")
+        task_indices = np.arange(valid_posterior.shape[1])
+        sorted_posterior = valid_posterior[sorted_indices, task_indices]
+        sorted_is_pos = (valid_labels==1)[sorted_indices, task_indices]
+        total_positives = np.sum(sorted_is_pos, axis=0)
+
+        #row i+1 is the threshold sorted_posterior[i], which predicts
+        #everything ranked above i as positive; row 0 predicts everything
+        #as positive
+        thresholds = np.concatenate(
+            [np.nextafter(sorted_posterior[:1], -np.inf), sorted_posterior],
+            axis=0)
+        true_positives = total_positives - np.concatenate(
+            [np.zeros((1, sorted_is_pos.shape[1])),
+             np.cumsum(sorted_is_pos, axis=0)], axis=0)
+        predicted_positives = (num_examples
+            - np.arange(num_examples+1))[:,None]
+        scores = self.compute_fbeta(
+                    true_positives=true_positives,
+                    predicted_positives=predicted_positives,
+                    total_positives=total_positives)
+        #a threshold tied with the next posterior does not predict that
+        #example as positive, so only the last of each tied run is valid
+        scores[1:-1][sorted_posterior[:-1]==sorted_posterior[1:]] = -np.inf
+
+        best_threshold = thresholds[np.argmax(scores, axis=0), task_indices]
+        if (is_1d):
+            best_threshold = best_threshold[0]
+        return best_threshold
 
 
 class AbstainerFactory(object):
 
+    #whether the factory and the functions it returns accept
+    #(n, num_tasks) arrays and treat every column as a separate task
+    handles_multiple_tasks = False
+
     def __call__(self, valid_labels,
                        valid_posterior,
                        valid_uncert):
@@ -121,70 +723,119 @@ class AbstainerFactory(object):
 
 class MulticlassWrapper(AbstainerFactory):
 
-    def __init__(self, single_class_abstainer_factory, verbose=True):
+    """
+        Applies a single-class abstainer to every column. If the
+        single-class factory handles multiple tasks, it is called once on
+        the full matrices. Otherwise one abstainer is fit per column,
+        mapping over `pool` if given (e.g. a multiprocessing.Pool or
+        ThreadPool; the factories and the abstaining functions they
+        return are picklable, so process pools work too), and the
+        per-column scores are written into a preallocated output array.
+    """
+
+    def __init__(self, single_class_abstainer_factory, verbose=True,
+                       pool=None):
         self.single_class_abstainer_factory = single_class_abstainer_factory
         self.verbose = verbose
+        self.pool = pool
+
+    @property
+    def handles_multiple_tasks(self):
+        return True
 
     def __call__(self, valid_labels, valid_posterior, valid_uncert):
 
-        all_class_abstainers = []
-        for class_idx in range(valid_labels.shape[1]):
-
-            if (valid_labels is not None):
-                class_valid_labels = valid_labels[:, class_idx] 
-            else:
-                class_valid_labels = None 
-
-            if (valid_posterior is not None):
-                class_valid_posterior = valid_posterior[:, class_idx]
-            else:
-                class_valid_posterior = None
-
-            if (valid_uncert is not None):
-                class_valid_uncert = valid_uncert[:, class_idx]
-            else:
-                class_valid_uncert = None
-           
-            class_abstainer = self.single_class_abstainer_factory(
-                                        valid_labels=class_valid_labels,
-                                        valid_posterior=class_valid_posterior,
-                                        valid_uncert=class_valid_uncert) 
-            all_class_abstainers.append(class_abstainer)
-
-        def func(posterior_probs, uncertainties):
-
-            all_class_scores = []
-
-            for class_idx in range(posterior_probs.shape[1]):
-
-                if (posterior_probs is not None):
-                    class_posterior_probs = posterior_probs[:,class_idx]
-                else:
-                    class_posterior_probs = None
-
-                if (uncertainties is not None):
-                    class_uncertainties = uncertainties[:, class_idx]
-                else:
-                    class_uncertainties = None
-
-                class_scores = all_class_abstainers[class_idx](
-                                 posterior_probs=class_posterior_probs,
-                                 uncertainties=class_uncertainties)
-                all_class_scores.append(class_scores)
-            return np.array(all_class_scores).transpose((1,0))
-
-        return func
+        if (self.single_class_abstainer_factory.handles_multiple_tasks):
+            return self.single_class_abstainer_factory(
+                        valid_labels=valid_labels,
+                        valid_posterior=valid_posterior,
+                        valid_uncert=valid_uncert)
+
+        num_classes = [x for x in [valid_labels, valid_posterior,
+                                   valid_uncert] if x is not None][0].shape[1]
+        fit_args = [(self.single_class_abstainer_factory,
+                     get_column(valid_labels, class_idx),
+                     get_column(valid_posterior, class_idx),
+                     get_column(valid_uncert, class_idx))
+                    for class_idx in range(num_classes)]
+        all_class_abstainers = (self.pool.map(fit_single_class_abstainer,
+                                              fit_args)
+                                if self.pool is not None else
+                                [fit_single_class_abstainer(x)
+                                 for x in fit_args])
+        return MulticlassAbstainingFunc(
+                    class_abstaining_funcs=all_class_abstainers,
+                    pool=self.pool)
+
+
+class MulticlassAbstainingFunc(object):
+
+    """
+        Holds one fitted abstaining function per column. The pool is not
+        part of the fitted state: it is dropped when pickling, so an
+        unpickled copy scores the columns serially unless a new pool is
+        assigned to self.pool.
+    """
+
+    def __init__(self, class_abstaining_funcs, pool=None):
+        self.class_abstaining_funcs = class_abstaining_funcs
+        self.pool = pool
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
+
+    def __call__(self, posterior_probs, uncertainties=None):
+
+        num_classes = len(self.class_abstaining_funcs)
+        apply_args = [(self.class_abstaining_funcs[class_idx],
+                       get_column(posterior_probs, class_idx),
+                       get_column(uncertainties, class_idx))
+                      for class_idx in range(num_classes)]
+        all_class_scores = (
+            self.pool.imap(apply_single_class_abstainer, apply_args)
+            if self.pool is not None else
+            (apply_single_class_abstainer(x) for x in apply_args))
+
+        to_return = None
+        for class_idx, class_scores in enumerate(all_class_scores):
+            if (to_return is None):
+                to_return = np.zeros((len(class_scores), num_classes),
+                                     dtype=np.asarray(class_scores).dtype)
+            to_return[:, class_idx] = class_scores
+        return to_return
+
+
+def get_column(arr, idx):
+    return arr[:, idx] if arr is not None else None
+
+
+def fit_single_class_abstainer(args):
+    factory, valid_labels, valid_posterior, valid_uncert = args
+    return factory(valid_labels=valid_labels,
+                   valid_posterior=valid_posterior,
+                   valid_uncert=valid_uncert)
+
+
+def apply_single_class_abstainer(args):
+    abstaining_func, posterior_probs, uncertainties = args
+    return abstaining_func(posterior_probs=posterior_probs,
+                           uncertainties=uncertainties)
             
 
 class RandomAbstention(AbstainerFactory):
 
     def __call__(self, valid_labels=None, valid_posterior=None,
                        valid_uncert=None):
+        return RandomAbstainingFunc()
+
+
+class RandomAbstainingFunc(object):
 
-        def random_func(posterior_probs, uncertainties=None):
-            return np.random.permutation(range(len(posterior_probs)))/(
-                     len(posterior_probs))
-        return random_func
+    def __call__(self, posterior_probs, uncertainties=None):
+        return np.random.permutation(range(len(posterior_probs)))/(
+                 len(posterior_probs))
 
 
 class NegPosteriorDistanceFromThreshold(AbstainerFactory):
@@ -192,41 +843,255 @@ class NegPosteriorDistanceFromThreshold(AbstainerFactory):
     def __init__(self, threshold_finder):
         self.threshold_finder = threshold_finder
 
+    @property
+    def handles_multiple_tasks(self):
+        return self.threshold_finder.handles_multiple_tasks
+
     def __call__(self, valid_labels, valid_posterior, valid_uncert=None):
 
         threshold = self.threshold_finder(valid_labels, valid_posterior)
+        return NegPosteriorDistanceAbstainingFunc(threshold=threshold)
+
+
+class NegPosteriorDistanceAbstainingFunc(object):
+
+    def __init__(self, threshold):
+        self.threshold = threshold
 
-        def abstaining_func(posterior_probs, uncertainties=None):
-            return -np.abs(posterior_probs-threshold) 
-        return abstaining_func
+    def __call__(self, posterior_probs, uncertainties=None):
+        posterior_probs = np.asarray(posterior_probs)
+        return -np.abs(posterior_probs-np.asarray(
+                   self.threshold, dtype=get_float_dtype(posterior_probs)))
 
 
 class NegativeAbsLogLikelihoodRatio(AbstainerFactory):
 
+    handles_multiple_tasks = True
+
     def __call__(self, valid_labels, valid_posterior, valid_uncert=None):
 
-        p_pos = np.sum(valid_labels)/len(valid_labels)
-        assert p_pos > 0 and p_pos < 1.0, "only one class in labels"
+        p_pos = np.sum(valid_labels, axis=0)/len(valid_labels)
+        assert np.all(p_pos > 0) and np.all(p_pos < 1.0),\
+            "only one class in labels"
         #lpr = log posterior ratio
         lpr = np.log(p_pos) - np.log(1-p_pos)
-
-        def abstaining_func(posterior_probs, uncertainties=None):
-            #llr = log-likelihood ratio
-            # prob = 1/(1 + e^-(llr + lpr))
-            # (1+e^-(llr + lpr)) = 1/prob
-            # e^-(llr + lpr) = 1/prob - 1
-            # llr + lpr = -np.log(1/prob - 1)
-            # llr = -np.log(1/prob - 1) - lpr
-            np.clip(posterior_probs, a_min=1e-7, a_max=None, out=posterior_probs)
-            llr = -np.log(1/(posterior_probs) - 1) - lpr
-            return -np.abs(llr)
-        return abstaining_func
+        return NegativeAbsLogLikelihoodRatioAbstainingFunc(lpr=lpr)
+
+
+class NegativeAbsLogLikelihoodRatioAbstainingFunc(object):
+
+    def __init__(self, lpr):
+        self.lpr = lpr
+
+    def __call__(self, posterior_probs, uncertainties=None):
+        #llr = log-likelihood ratio
+        # prob = 1/(1 + e^-(llr + lpr))
+        # (1+e^-(llr + lpr)) = 1/prob
+        # e^-(llr + lpr) = 1/prob - 1
+        # llr + lpr = -np.log(1/prob - 1)
+        # llr = -np.log(1/prob - 1) - lpr
+        #posteriors of exactly 0 or 1 (e.g. from isotonic regression)
+        #would give an infinite llr; the caller's array is left as is
+        posterior_probs = np.clip(posterior_probs, a_min=1e-7, a_max=1-1e-7)
+        llr = -np.log(1/(posterior_probs) - 1) - np.asarray(
+                  self.lpr, dtype=get_float_dtype(posterior_probs))
+        return -np.abs(llr)
+
+
+class MarginalDeltaEvictionEngine(object):
+
+    """
+        Keeps the items remaining during recursive eviction in preallocated
+        buffers (sorted by posterior) and evicts the item with the highest
+        abstention score according to marginal_delta_metric. Works for any
+        marginal delta metric, at the cost of a vectorized O(n) pass
+        per eviction.
+    """
+
+    def __init__(self, marginal_delta_metric, sorted_ppos):
+        self.marginal_delta_metric = marginal_delta_metric
+        self.ppos = np.array(sorted_ppos, dtype="float64")
+        self.sorted_positions = np.arange(len(self.ppos))
+        self.num_remaining = len(self.ppos)
+
+    def evict_next(self):
+        """
+            Removes the item with the highest abstention score and
+            returns its position in the original sorted order
+        """
+        ppos = self.ppos[:self.num_remaining]
+        est_numpos = np.sum(ppos)
+        est_numneg = np.sum(1-ppos)
+        est_pos_cdfs = np.cumsum(ppos)/est_numpos
+        est_neg_cdfs = np.cumsum(1-ppos)/est_numneg
+        est_metric = self.marginal_delta_metric.estimate_metric(
+            ppos=ppos, pos_cdfs=est_pos_cdfs, neg_cdfs=est_neg_cdfs)
+        abstention_scores =\
+            self.marginal_delta_metric.compute_abstention_score(
+                est_metric=est_metric,
+                est_numpos=est_numpos,
+                est_numneg=est_numneg,
+                ppos=ppos,
+                pos_cdfs=est_pos_cdfs,
+                neg_cdfs=est_neg_cdfs)
+        idx = np.argmax(abstention_scores)
+        evicted_position = self.sorted_positions[idx]
+        #shift the tail down by one instead of rebuilding the buffers
+        self.ppos[idx:self.num_remaining-1] =\
+            self.ppos[idx+1:self.num_remaining]
+        self.sorted_positions[idx:self.num_remaining-1] =\
+            self.sorted_positions[idx+1:self.num_remaining]
+        self.num_remaining -= 1
+        return evicted_position
+
+
+class AuRocEvictionEngine(object):
+
+    """
+        Incremental eviction for the marginal delta auROC, in O(log n)
+        per eviction.
+
+        With P_i the cumulative sum of ppos and c_i the number of items
+        up to item i (in sorted order), the abstention score of item i is
+        an increasing affine function of
+            s_i = x*ppos_i + P_i - ppos_i*c_i
+        where x = est_metric*est_numneg - (est_metric-1)*est_numpos is
+        shared by all items. Then s_{i+1} - s_i = (ppos_{i+1}-ppos_i)*
+        (x - c_i), which is >= 0 while c_i < x and <= 0 after, so the
+        highest score is at the item of rank ceil(x) (clipped to the
+        items that remain), or at the first remaining item tied with it
+        in ppos, as np.argmax would pick. The remaining items are kept in
+        Fenwick trees of counts and of positive mass over the sorted
+        positions, which find that rank and the cumulative sums needed to
+        update the estimated metric and the class totals.
+    """
+
+    def __init__(self, sorted_ppos):
+        self.ppos = np.array(sorted_ppos, dtype="float64")
+        num_items = len(self.ppos)
+        self.num_remaining = num_items
+        #the first position with the same ppos as each position
+        self.first_tied = np.searchsorted(self.ppos, self.ppos,
+                                          side="left").tolist()
+        self.count_tree = FenwickTree(num_items, values=np.ones(num_items))
+        self.posmass_tree = FenwickTree(num_items, values=self.ppos)
+
+        self.est_numpos = np.sum(self.ppos)
+        self.est_numneg = np.sum(1-self.ppos)
+        #sum over items of ppos_i*Q_i, where Q_i is the cumulative sum of
+        #1-ppos, i.e. the numerator of the est. auROC
+        self.sum_ppos_times_negcumsum =\
+            np.sum(self.ppos*np.cumsum(1-self.ppos))
+
+    def evict_next(self):
+        """
+            Removes the item with the highest abstention score and
+            returns its position in the original sorted order
+        """
+        est_metric = self.sum_ppos_times_negcumsum/(
+                        self.est_numpos*self.est_numneg)
+        x = est_metric*self.est_numneg - (est_metric-1)*self.est_numpos
+        #if x is nan (a single class left), np.argmax picks the first
+        rank = (int(min(max(np.ceil(x), 1), self.num_remaining))
+                if np.isfinite(x) else 1)
+        position = self.count_tree.find_prefix(rank)
+        first_tied = self.first_tied[position]
+        if (first_tied < position):
+            rank = self.count_tree.prefix_sum_one(first_tied)+1
+            position = self.count_tree.find_prefix(rank)
+
+        #update the running totals before removing the item
+        ppos = self.ppos[position]
+        cumsum_pos = self.posmass_tree.prefix_sum_one(position+1)
+        cumsum_neg = rank - cumsum_pos
+        self.sum_ppos_times_negcumsum -= (
+            ppos*cumsum_neg + (1-ppos)*(self.est_numpos-cumsum_pos))
+        self.est_numpos -= ppos
+        self.est_numneg -= (1-ppos)
+
+        self.count_tree.add_one(position, -1)
+        self.posmass_tree.add_one(position, -ppos)
+        self.num_remaining -= 1
+        return position
+
+
+class AuPrcEvictionEngine(object):
+
+    """
+        Eviction for the marginal delta auPRC, in O(n) per eviction, so
+        O(n^2) to evict a fixed proportion of n items. Evicting an item
+        changes the estimated precision of every item ranked below it,
+        and a precision is a ratio of counts, so unlike the terms of the
+        auROC the scores have no updates that a Fenwick tree could keep
+        in O(log n) and each eviction takes a pass over the remaining
+        items. The pass is kept to a few in-place vectorized operations on
+        preallocated buffers: with the items in ascending order, the
+        number of items ranked above the i-th of r remaining ones is
+        r-1-i, so its reciprocal is a slice of an array computed once,
+        and the positive mass above every item is a single cumsum.
+        The scores are the same as compute_abstention_score of
+        MarginalDeltaAuPrcMixin, up to the positive factor 1/est_numpos.
+    """
+
+    def __init__(self, sorted_ppos):
+        self.ppos = np.array(sorted_ppos, dtype="float64")
+        num_items = len(self.ppos)
+        self.sorted_positions = np.arange(num_items)
+        self.num_remaining = num_items
+        #1/(number of items above) of the i-th item when r items remain
+        #is at index num_items-r+i; the top item is treated as having one
+        #(positive) item above it, as in compute_abstention_score
+        self.inv_num_above = np.ones(num_items)
+        self.inv_num_above[:-1] /= np.arange(num_items-1, 0, -1)
+        self.buffers = np.zeros((3, num_items))
+
+    def evict_next(self):
+        """
+            Removes the item with the highest abstention score and
+            returns its position in the original sorted order
+        """
+        num_remaining = self.num_remaining
+        ppos = self.ppos[:num_remaining]
+        inv_num_above = self.inv_num_above[len(self.ppos)-num_remaining:]
+        precisions, cmcpr_term1, cmcpr_term2 =\
+            self.buffers[:,:num_remaining]
+
+        npos_above = np.cumsum(ppos, out=precisions)
+        est_numpos = npos_above[-1]
+        np.subtract(est_numpos, npos_above, out=npos_above)
+        npos_above[-1] = 1.0
+        precisions = np.multiply(npos_above, inv_num_above, out=precisions)
+        est_metric = np.dot(ppos, precisions)/est_numpos
+        #the cumulative sums of ppos/num_above and of
+        #ppos*npos_above/num_above**2
+        np.multiply(ppos, inv_num_above, out=cmcpr_term2)
+        np.multiply(cmcpr_term2, precisions, out=cmcpr_term1)
+        np.cumsum(cmcpr_term1, out=cmcpr_term1)
+        np.cumsum(cmcpr_term2, out=cmcpr_term2)
+        #abstention_scores*est_numpos =
+        #ppos*(est_metric - precision - cmcpr_term2) + cmcpr_term1
+        scores = np.subtract(est_metric, precisions, out=precisions)
+        scores -= cmcpr_term2
+        scores *= ppos
+        scores += cmcpr_term1
+        idx = np.argmax(scores)
+
+        evicted_position = self.sorted_positions[idx]
+        self.ppos[idx:num_remaining-1] = self.ppos[idx+1:num_remaining]
+        self.sorted_positions[idx:num_remaining-1] =\
+            self.sorted_positions[idx+1:num_remaining]
+        self.num_remaining -= 1
+        return evicted_position
 
 
 class RecursiveMarginalDeltaMetric(AbstainerFactory):
 
-    def __init__(self, proportion_to_retain):
+    def __init__(self, proportion_to_retain, verbose=True,
+                       instrumentation=None):
         self.proportion_to_retain = proportion_to_retain
+        self.verbose = verbose
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
 
     def estimate_metric(self, ppos, pos_cdfs, neg_cdfs):
         raise NotImplementedError()
@@ -238,76 +1103,165 @@ class RecursiveMarginalDeltaMetric(AbstainerFactory):
                                        est_numpos, est_numneg):
         raise NotImplementedError()
 
+    def get_eviction_engine(self, sorted_ppos):
+        return MarginalDeltaEvictionEngine(marginal_delta_metric=self,
+                                           sorted_ppos=sorted_ppos)
+
     def __call__(self, valid_labels=None,
                        valid_posterior=None, valid_uncert=None):
-
-        def abstaining_func(posterior_probs, uncertainties=None):
-            reverse_eviction_ordering = np.zeros(len(posterior_probs))
-            #test_posterior_and_index have 2-tuples of prob, testing index
-            test_posterior_and_index = [(x[1], x[0]) for x in
-                                        enumerate(posterior_probs)]
-            test_sorted_indices, test_sorted_posterior_probs =\
-                zip(*sorted(enumerate(posterior_probs),
-                      key=lambda x: x[1]))
-            test_sorted_posterior_probs =\
-                np.array(test_sorted_posterior_probs)
-
-            items_remaining = len(posterior_probs)  
-            while items_remaining >\
-                  int(self.proportion_to_retain*len(posterior_probs)):
-                if (items_remaining%100 == 0):
-                    print("Items recursively evicted:",
-                      (len(posterior_probs)-items_remaining),
-                       "of",len(posterior_probs)-
-                       int(self.proportion_to_retain*len(posterior_probs)))
-                    sys.stdout.flush()
-                est_numpos_from_data = np.sum(test_sorted_posterior_probs)
-                est_numneg_from_data = np.sum(1-test_sorted_posterior_probs)
-                est_pos_cdfs_from_data =\
-                    (np.cumsum(test_sorted_posterior_probs))/\
-                    est_numpos_from_data
-                est_neg_cdfs_from_data =\
-                    (np.cumsum(1-test_sorted_posterior_probs))/\
-                    est_numneg_from_data
-                est_metric_from_data=self.estimate_metric(
-                    ppos=test_sorted_posterior_probs,
-                    pos_cdfs=est_pos_cdfs_from_data,
-                    neg_cdfs=est_neg_cdfs_from_data)
-
-                test_sorted_abstention_scores = self.compute_abstention_score(
-                    est_metric=est_metric_from_data,
-                    est_numpos=est_numpos_from_data,
-                    est_numneg=est_numneg_from_data,
-                    ppos=test_sorted_posterior_probs,
-                    pos_cdfs=est_pos_cdfs_from_data,
-                    neg_cdfs=est_neg_cdfs_from_data)
-                to_evict_idx = max(zip(test_sorted_indices,
-                                       test_sorted_abstention_scores),
-                                   key=lambda x: x[1])[0]
-                reverse_eviction_ordering[to_evict_idx] = items_remaining  
-                items_remaining -= 1
-                idx_to_evict_from_sorted =\
-                    np.argmax(test_sorted_abstention_scores)
-                test_sorted_indices =\
-                    np.array(list(test_sorted_indices[:
-                                   idx_to_evict_from_sorted])
-                           +list(test_sorted_indices[
-                                   idx_to_evict_from_sorted+1:]))
-                test_sorted_posterior_probs =\
-                    np.array(list(test_sorted_posterior_probs[:
-                                   idx_to_evict_from_sorted])
-                         +list(test_sorted_posterior_probs[
-                                   idx_to_evict_from_sorted+1:]))
-            return reverse_eviction_ordering
-
-        return abstaining_func
+        return RecursiveMarginalDeltaAbstainingFunc(
+                    recursive_marginal_delta_metric=self)
+
+
+def without_instrumentation(factory):
+    #a shallow copy of the factory with no instrumentation: like a pool,
+    #an instrumentation belongs to the running process (it may hold
+    #callbacks, loggers or streams), so it is not pickled with the fitted
+    #functions that keep the factory's settings
+    factory = copy.copy(factory)
+    factory.instrumentation = None
+    return factory
+
+
+class RecursiveMarginalDeltaAbstainingFunc(object):
+
+    """
+        The instrumentation of the metric is dropped when pickling; set
+        recursive_marginal_delta_metric.instrumentation on an unpickled
+        copy to get events again.
+    """
+
+    def __init__(self, recursive_marginal_delta_metric):
+        self.recursive_marginal_delta_metric = recursive_marginal_delta_metric
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["recursive_marginal_delta_metric"] = without_instrumentation(
+            self.recursive_marginal_delta_metric)
+        return state
+
+    def __call__(self, posterior_probs, uncertainties=None):
+        metric = self.recursive_marginal_delta_metric
+        instrumentation = metric.instrumentation
+        if (instrumentation is not None):
+            start_time = time.time()
+        posterior_probs = np.asarray(posterior_probs)
+        reverse_eviction_ordering = np.zeros(len(posterior_probs))
+        test_sorted_indices = np.argsort(posterior_probs, kind="mergesort")
+        eviction_engine = metric.get_eviction_engine(
+            sorted_ppos=posterior_probs[test_sorted_indices])
+
+        items_remaining = len(posterior_probs)  
+        num_to_retain = int(metric.proportion_to_retain*len(posterior_probs))
+        while items_remaining > num_to_retain:
+            if (instrumentation is not None and items_remaining%100 == 0):
+                instrumentation.on_event("recursive_eviction.progress",
+                    {"num_evicted": len(posterior_probs)-items_remaining,
+                     "num_to_evict": len(posterior_probs)-num_to_retain,
+                     "seconds": time.time() - start_time})
+            to_evict_idx =\
+                test_sorted_indices[eviction_engine.evict_next()]
+            reverse_eviction_ordering[to_evict_idx] = items_remaining  
+            items_remaining -= 1
+        if (instrumentation is not None):
+            instrumentation.on_event("recursive_eviction.done",
+                {"num_evicted": len(posterior_probs)-num_to_retain,
+                 "seconds": time.time() - start_time})
+        return reverse_eviction_ordering
+
+
+class ValidationCdfs(object):
+
+    """
+        Positive and negative cdfs of the validation set, compiled into
+        sorted arrays so that the cdfs at test posteriors can be looked up
+        with a single np.searchsorted.
+
+        A test posterior gets the cdfs stored with the highest-ranked
+        validation posterior that is <= it, and every validation example
+        stores the fraction of positives/negatives ranked strictly below
+        it. The negative cdf is floored at float32 eps.
+
+        For (n, num_tasks) inputs every column is a separate task; the
+        lookup then merges the validation and test posteriors of all
+        columns with one stable argsort.
+    """
+
+    def __init__(self, valid_labels, valid_posterior):
+        valid_labels = np.asarray(valid_labels)
+        valid_posterior = np.asarray(valid_posterior)
+        sorted_indices = np.argsort(valid_posterior, axis=0, kind="mergesort")
+        self.sorted_posterior = take_rows(valid_posterior, sorted_indices)
+        sorted_is_pos = (take_rows(valid_labels, sorted_indices)==1)
+        num_positives = np.sum(valid_labels==1, axis=0)
+        num_negatives = np.sum(valid_labels==0, axis=0)
+        #entry k is for test posteriors with k validation posteriors <= them
+        leading_zeros = np.zeros((2,)+valid_posterior.shape[1:])
+        self.pos_cdfs = np.concatenate(
+            [leading_zeros, np.cumsum(sorted_is_pos, axis=0)[:-1]])/\
+            num_positives.astype("float64")
+        self.neg_cdfs = np.maximum(np.concatenate(
+            [leading_zeros, np.cumsum(sorted_is_pos==False, axis=0)[:-1]])/
+            num_negatives.astype("float64"), np.finfo(np.float32).eps)
+
+    def __call__(self, posterior_probs):
+        posterior_probs = np.asarray(posterior_probs)
+        if (posterior_probs.ndim == 1):
+            num_below = np.searchsorted(self.sorted_posterior,
+                                        posterior_probs, side="right")
+        else:
+            num_valid = len(self.sorted_posterior)
+            #validation posteriors come first, so they stay below tied
+            #test posteriors in the stable sort
+            merged_order = np.argsort(
+                np.concatenate([self.sorted_posterior, posterior_probs]),
+                axis=0, kind="mergesort")
+            is_test = merged_order >= num_valid
+            num_valid_upto = np.cumsum(is_test==False, axis=0)
+            columns = np.broadcast_to(np.arange(posterior_probs.shape[1]),
+                                      merged_order.shape)
+            num_below = np.zeros(posterior_probs.shape, dtype="int64")
+            num_below[merged_order[is_test]-num_valid, columns[is_test]] =\
+                num_valid_upto[is_test]
+        return (take_rows(self.pos_cdfs, num_below),
+                take_rows(self.neg_cdfs, num_below))
+
+
+def take_rows(arr, row_indices):
+    #arr[row_indices] for 1-D arrays, and column by column for 2-D arrays
+    if (arr.ndim == 1):
+        return arr[row_indices]
+    return arr[row_indices, np.arange(arr.shape[1])]
+
+
+class MarginalDeltaValidationStats(object):
+
+    def __init__(self, est_metric, num_positives, num_negatives, cdfs):
+        self.est_metric = est_metric
+        self.num_positives = num_positives
+        self.num_negatives = num_negatives
+        self.cdfs = cdfs
 
 
 class MarginalDeltaMetric(AbstainerFactory):
 
+    """
+        The abstention scores are computed in dtype, or by default in the
+        dtype of the test posteriors if it is floating, so (n, k) float32
+        posteriors give float32 scores without float64 copies; the sums
+        and cumsums over the examples are accumulated in float64.
+    """
+
+    handles_multiple_tasks = True
+
     def __init__(self, estimate_cdfs_from_valid=False,
                        estimate_imbalance_and_perf_from_valid=False,
-                       all_estimates_from_valid=False):
+                       all_estimates_from_valid=False,
+                       verbose=True, instrumentation=None, dtype=None):
+        self.verbose = verbose
+        self.dtype = dtype
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
         self.all_estimates_from_valid = all_estimates_from_valid
         if (self.all_estimates_from_valid):
             estimate_cdfs_from_valid = True
@@ -326,169 +1280,371 @@ class MarginalDeltaMetric(AbstainerFactory):
                                        est_numpos, est_numneg):
         raise NotImplementedError()
 
-    def __call__(self, valid_labels, valid_posterior, valid_uncert=None):
-
+    def get_validation_stats(self, valid_labels, valid_posterior):
+        return MarginalDeltaValidationStats(
+            est_metric=np.array(self.compute_metric(y_true=valid_labels,
+                                                    y_score=valid_posterior)),
+            num_positives=np.sum(valid_labels==1, axis=0),
+            num_negatives=np.sum(valid_labels==0, axis=0),
+            cdfs=ValidationCdfs(valid_labels=valid_labels,
+                                valid_posterior=valid_posterior))
+
+    def choose_estimates(self, validation_stats, est_metric_from_data,
+                               est_numpos_from_data, est_numneg_from_data,
+                               sample_size, count_scale=1.0):
+        """
+            Reports the validation and data estimates of the metric, and
+            returns the (est_metric, est_numpos, est_numneg) that the
+            abstention scores of sample_size test posteriors are computed
+            from: those estimated from the test posteriors, or, if
+            estimate_imbalance_and_perf_from_valid, the validation
+            metric and the validation class counts (scaled by
+            count_scale if all_estimates_from_valid, or else to
+            sample_size).
+        """
+        instrumentation = self.instrumentation
+        valid_num_positives = validation_stats.num_positives
+        valid_num_negatives = validation_stats.num_negatives
+        valid_est_metric = validation_stats.est_metric
+        if (instrumentation is not None):
+            instrumentation.on_event("marginal_delta.metric_estimates",
+                {"valid_est_metric": valid_est_metric,
+                 "data_est_metric": est_metric_from_data})
+            if (np.any(np.abs(est_metric_from_data-valid_est_metric)
+                       > 0.01)):
+                instrumentation.on_event("marginal_delta.warning",
+                    {"message": "If the perf on the validation set is "
+                                "very different from the estimated perf "
+                                "on the test data, it may be a sign that "
+                                "the calibration is poor!!!"})
+
+        if (not self.estimate_imbalance_and_perf_from_valid):
+            return (est_metric_from_data, est_numpos_from_data,
+                    est_numneg_from_data)
+        valid_frac_pos = valid_num_positives/\
+                         (valid_num_positives+valid_num_negatives)
+        valid_frac_neg = valid_num_negatives/\
+                         (valid_num_positives+valid_num_negatives)
         if (self.all_estimates_from_valid):
-            print("Estimating everything relative to validation set")
-
-        #get the original auROC from the validation set
-        valid_est_metric = np.array(self.compute_metric(
-                                         y_true=valid_labels,
-                                         y_score=valid_posterior))
-        valid_num_positives = np.sum(valid_labels==1)
-        valid_num_negatives = np.sum(valid_labels==0)
-
-        #compute the cdf for the positives and the negatives from valid set
-        sorted_labels_and_probs = sorted(zip(valid_labels, valid_posterior),
-                                         key=lambda x: x[1]) 
-        running_sum_positives = [0]
-        running_sum_negatives = [0]
-        for label, prob in sorted_labels_and_probs:
-            if (label==1):
-                running_sum_positives.append(running_sum_positives[-1]+1)
-                running_sum_negatives.append(running_sum_negatives[-1])
-            else:
-                running_sum_positives.append(running_sum_positives[-1])
-                running_sum_negatives.append(running_sum_negatives[-1]+1)
-        valid_positives_cdf =\
-            np.array(running_sum_positives)/float(valid_num_positives) 
-        valid_negatives_cdf =\
-            np.array(running_sum_negatives)/float(valid_num_negatives) 
-
-        #validation_vals are a 3-tuple of prob, positive_cdf, neg_cdf
-        validation_vals = list(zip([x[1] for x in sorted_labels_and_probs],
-                               valid_positives_cdf, valid_negatives_cdf))
-
-
-        def abstaining_func(posterior_probs, uncertainties=None):
-            #test_posterior_and_index have 2-tuples of prob, testing index
-            test_posterior_and_index = [(x[1], x[0]) for x in
-                                        enumerate(posterior_probs)]
-            sorted_valid_and_test =\
-                sorted(validation_vals+test_posterior_and_index,
-                       key=lambda x: x[0])
-            pos_cdf = 0
-            neg_cdf = np.finfo(np.float32).eps
-            test_sorted_posterior_probs = []
-            test_sorted_pos_cdfs = []
-            test_sorted_neg_cdfs = []
-            test_sorted_indices = []
-            to_return = np.zeros(len(posterior_probs))
-            for value in sorted_valid_and_test:
-                is_from_valid = True if len(value)==3 else False 
-                if (is_from_valid):
-                    pos_cdf = value[1]
-                    neg_cdf = max(value[2],np.finfo(np.float32).eps)
-                else:
-                    ppos = value[0]
-                    idx = value[1]
-                    test_sorted_posterior_probs.append(ppos)
-                    test_sorted_indices.append(idx)
-                    test_sorted_pos_cdfs.append(pos_cdf)
-                    test_sorted_neg_cdfs.append(neg_cdf)
-            test_sorted_posterior_probs = np.array(test_sorted_posterior_probs)
-            test_sorted_pos_cdfs = np.array(test_sorted_pos_cdfs)
-            test_sorted_neg_cdfs = np.array(test_sorted_neg_cdfs)
-
-            valid_frac_pos = valid_num_positives/\
-                             (valid_num_positives+valid_num_negatives)
-            valid_frac_neg = valid_num_negatives/\
-                             (valid_num_positives+valid_num_negatives)
-            if (self.all_estimates_from_valid):
-                est_numpos_from_valid = valid_num_positives
-                est_numneg_from_valid = valid_num_negatives
-            else:
-                est_numpos_from_valid = valid_frac_pos*len(posterior_probs)
-                est_numneg_from_valid = valid_frac_neg*len(posterior_probs)
-            
-            est_numpos_from_data = np.sum(test_sorted_posterior_probs)
-            est_numneg_from_data = np.sum(1-test_sorted_posterior_probs)
-            est_pos_cdfs_from_data =\
-                (np.cumsum(test_sorted_posterior_probs))/est_numpos_from_data
-            est_neg_cdfs_from_data =\
-                (np.cumsum(1-test_sorted_posterior_probs))/est_numneg_from_data
+            est_numpos_from_valid = valid_num_positives*count_scale
+            est_numneg_from_valid = valid_num_negatives*count_scale
+        else:
+            est_numpos_from_valid = valid_frac_pos*sample_size
+            est_numneg_from_valid = valid_frac_neg*sample_size
+        return valid_est_metric, est_numpos_from_valid, est_numneg_from_valid
+
+    def score_sorted_posteriors(self, validation_stats,
+                                      test_sorted_posterior_probs,
+                                      num_examples=None):
+        """
+            Abstention scores of the (sorted along axis 0) test
+            posteriors. If they are a representative sample (e.g.
+            quantiles) of num_examples test posteriors, every count is
+            scaled accordingly, so the scores estimate those the full set
+            would get.
+        """
+        dtype = get_float_dtype(test_sorted_posterior_probs, self.dtype)
+        test_sorted_posterior_probs = np.asarray(
+            test_sorted_posterior_probs, dtype=dtype)
+        sample_size = len(test_sorted_posterior_probs)
+        count_scale = (1.0 if num_examples is None
+                       else sample_size/num_examples)
+        test_sorted_pos_cdfs, test_sorted_neg_cdfs = [
+            x.astype(dtype, copy=False) for x in
+            validation_stats.cdfs(test_sorted_posterior_probs)]
+
+        est_numpos_from_data = np.sum(test_sorted_posterior_probs, axis=0,
+                                      dtype="float64")
+        est_numneg_from_data = np.sum(1-test_sorted_posterior_probs,
+                                      axis=0, dtype="float64")
+        est_pos_cdfs_from_data =\
+            (np.cumsum(test_sorted_posterior_probs, axis=0,
+                       dtype="float64")/est_numpos_from_data).astype(
+                       dtype, copy=False)
+        est_neg_cdfs_from_data =\
+            (np.cumsum(1-test_sorted_posterior_probs, axis=0,
+                       dtype="float64")/est_numneg_from_data).astype(
+                       dtype, copy=False)
+
+        if (self.estimate_cdfs_from_valid):
+            est_metric_from_data=self.estimate_metric(
+                ppos=test_sorted_posterior_probs,
+                pos_cdfs=test_sorted_pos_cdfs,
+                neg_cdfs=test_sorted_neg_cdfs)
+        else:
+            est_metric_from_data=self.estimate_metric(
+                ppos=test_sorted_posterior_probs,
+                pos_cdfs=est_pos_cdfs_from_data,
+                neg_cdfs=est_neg_cdfs_from_data)
+
+        est_metric, est_numpos, est_numneg = self.choose_estimates(
+            validation_stats=validation_stats,
+            est_metric_from_data=est_metric_from_data,
+            est_numpos_from_data=est_numpos_from_data,
+            est_numneg_from_data=est_numneg_from_data,
+            sample_size=sample_size, count_scale=count_scale)
+
+        test_sorted_abstention_scores = self.compute_abstention_score(
+            est_metric=np.asarray(est_metric, dtype=dtype),
+            est_numpos=np.asarray(est_numpos, dtype=dtype),
+            est_numneg=np.asarray(est_numneg, dtype=dtype),
+            ppos=np.array(test_sorted_posterior_probs),
+            pos_cdfs=(np.array(test_sorted_pos_cdfs)
+                      if self.estimate_cdfs_from_valid
+                      else est_pos_cdfs_from_data),
+            neg_cdfs=(np.array(test_sorted_neg_cdfs)
+                      if self.estimate_cdfs_from_valid
+                      else est_neg_cdfs_from_data)
+        )
+        if (num_examples is not None):
+            test_sorted_abstention_scores *= count_scale
+        return test_sorted_abstention_scores
+
+    def score_sorted_posteriors_in_chunks(self, validation_stats,
+                                                test_sorted_posterior_probs,
+                                                chunk_size):
+        """
+            Same scores as score_sorted_posteriors for 1-D sorted
+            posteriors (e.g. a memmap), computed in streaming passes over
+            chunks of chunk_size values: one for the estimated class
+            counts, one for the metric estimate and one for the scores.
+            Yields (start_idx, abstention scores of the chunk), so memory
+            stays O(chunk_size).
+        """
+        sample_size = len(test_sorted_posterior_probs)
+        chunk_starts = range(0, sample_size, chunk_size)
+
+        def get_chunk(start_idx):
+            return np.asarray(
+                test_sorted_posterior_probs[start_idx:start_idx+chunk_size],
+                dtype="float64")
+
+        est_numpos_from_data = 0.0
+        est_numneg_from_data = 0.0
+        for start_idx in chunk_starts:
+            ppos = get_chunk(start_idx)
+            est_numpos_from_data += np.sum(ppos)
+            est_numneg_from_data += np.sum(1-ppos)
+
+        def get_chunk_cdfs(ppos, pos_sum_before, neg_sum_before):
+            if (self.estimate_cdfs_from_valid):
+                return validation_stats.cdfs(ppos)
+            return ((np.cumsum(ppos) + pos_sum_before)/est_numpos_from_data,
+                    (np.cumsum(1-ppos) + neg_sum_before)/est_numneg_from_data)
+
+        est_metric_from_data = 0.0
+        pos_sum_before, neg_sum_before = 0.0, 0.0
+        for start_idx in chunk_starts:
+            ppos = get_chunk(start_idx)
+            pos_cdfs, neg_cdfs = get_chunk_cdfs(ppos, pos_sum_before,
+                                                neg_sum_before)
+            est_metric_from_data += self.estimate_metric_chunk(
+                ppos=ppos, pos_cdfs=pos_cdfs, neg_cdfs=neg_cdfs,
+                num_pos=est_numpos_from_data, num_neg=est_numneg_from_data,
+                is_last_chunk=(start_idx+chunk_size >= sample_size))
+            pos_sum_before += np.sum(ppos)
+            neg_sum_before += np.sum(1-ppos)
+        est_metric_from_data /= est_numpos_from_data
+
+        est_metric, est_numpos, est_numneg = self.choose_estimates(
+            validation_stats=validation_stats,
+            est_metric_from_data=est_metric_from_data,
+            est_numpos_from_data=est_numpos_from_data,
+            est_numneg_from_data=est_numneg_from_data,
+            sample_size=sample_size)
+
+        carry = None
+        pos_sum_before, neg_sum_before = 0.0, 0.0
+        for start_idx in chunk_starts:
+            ppos = get_chunk(start_idx)
+            pos_cdfs, neg_cdfs = get_chunk_cdfs(ppos, pos_sum_before,
+                                                neg_sum_before)
+            chunk_scores, carry = self.compute_abstention_score_chunk(
+                est_metric=est_metric, est_numpos=est_numpos,
+                est_numneg=est_numneg,
+                ppos=ppos, pos_cdfs=pos_cdfs, neg_cdfs=neg_cdfs,
+                carry=carry,
+                is_last_chunk=(start_idx+chunk_size >= sample_size))
+            pos_sum_before += np.sum(ppos)
+            neg_sum_before += np.sum(1-ppos)
+            yield start_idx, chunk_scores
 
-            sorted_idx_and_val = sorted(enumerate(posterior_probs),
-                                        key=lambda x: x[1])
+    def __call__(self, valid_labels, valid_posterior, valid_uncert=None):
 
-            if (self.estimate_cdfs_from_valid):
-                est_metric_from_data=self.estimate_metric(
-                    ppos=test_sorted_posterior_probs,
-                    pos_cdfs=test_sorted_pos_cdfs,
-                    neg_cdfs=test_sorted_neg_cdfs)
-            else:
-                est_metric_from_data=self.estimate_metric(
-                    ppos=test_sorted_posterior_probs,
-                    pos_cdfs=est_pos_cdfs_from_data,
-                    neg_cdfs=est_neg_cdfs_from_data)
-
-            print("valid est metric", valid_est_metric)
-            print("data est metric", est_metric_from_data)
-            sys.stdout.flush()
-            if (np.abs(est_metric_from_data-valid_est_metric) > 0.01):
-                print("If the perf on the validation set is "
-                      "very different from the estimated perf "
-                      "on the test data, it may be a sign that "
-                      "the calibration is poor!!!") 
-                sys.stdout.flush()
-
-            test_sorted_abstention_scores = self.compute_abstention_score(
-                est_metric=(valid_est_metric if
-                            self.estimate_imbalance_and_perf_from_valid
-                            else est_metric_from_data),
-                est_numpos=(est_numpos_from_valid if
-                            self.estimate_imbalance_and_perf_from_valid
-                            else est_numpos_from_data),
-                est_numneg=(est_numneg_from_valid if
-                            self.estimate_imbalance_and_perf_from_valid else
-                            est_numneg_from_data),
-                ppos=np.array(test_sorted_posterior_probs),
-                pos_cdfs=(np.array(test_sorted_pos_cdfs)
-                          if self.estimate_cdfs_from_valid
-                          else est_pos_cdfs_from_data),
-                neg_cdfs=(np.array(test_sorted_neg_cdfs)
-                          if self.estimate_cdfs_from_valid
-                          else est_neg_cdfs_from_data)
-            )
-
-            final_abstention_scores = np.zeros(len(posterior_probs)) 
+        instrumentation = self.instrumentation
+        if (instrumentation is not None and self.all_estimates_from_valid):
+            instrumentation.on_event("marginal_delta.info",
+                {"message": "Estimating everything relative to"
+                            " validation set"})
+
+        validation_stats = self.get_validation_stats(
+                                valid_labels=valid_labels,
+                                valid_posterior=valid_posterior)
+        return MarginalDeltaAbstainingFunc(marginal_delta_metric=self,
+                                           validation_stats=validation_stats)
+
+
+class MarginalDeltaAbstainingFunc(object):
+
+    """
+        The fitted state of a MarginalDeltaMetric: the metric settings
+        and the MarginalDeltaValidationStats (validation cdf arrays,
+        estimated metric and class counts) of the validation set. The
+        instrumentation of the metric is not part of the fitted state and
+        is dropped when pickling.
+    """
+
+    def __init__(self, marginal_delta_metric, validation_stats):
+        self.marginal_delta_metric = marginal_delta_metric
+        self.validation_stats = validation_stats
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["marginal_delta_metric"] = without_instrumentation(
+            self.marginal_delta_metric)
+        return state
+
+    def __call__(self, posterior_probs, uncertainties=None):
+        instrumentation = self.marginal_delta_metric.instrumentation
+        if (instrumentation is not None):
+            start_time = time.time()
+        posterior_probs = np.asarray(posterior_probs)
+        dtype = get_float_dtype(posterior_probs,
+                                self.marginal_delta_metric.dtype)
+        test_sorted_indices = np.argsort(posterior_probs, axis=0,
+                                         kind="mergesort")
+        test_sorted_posterior_probs = take_rows(posterior_probs,
+                                                test_sorted_indices)
+        test_sorted_abstention_scores =\
+            self.marginal_delta_metric.score_sorted_posteriors(
+                validation_stats=self.validation_stats,
+                test_sorted_posterior_probs=test_sorted_posterior_probs)
+
+        final_abstention_scores = np.zeros(posterior_probs.shape,
+                                           dtype=dtype)
+        if (posterior_probs.ndim == 1):
             final_abstention_scores[test_sorted_indices] =\
                 test_sorted_abstention_scores 
-            return final_abstention_scores
-
-        return abstaining_func
+        else:
+            final_abstention_scores[test_sorted_indices,
+                np.arange(posterior_probs.shape[1])] =\
+                test_sorted_abstention_scores
+        if (instrumentation is not None):
+            instrumentation.on_event("marginal_delta.score",
+                {"num_examples": len(posterior_probs),
+                 "seconds": time.time() - start_time})
+        return final_abstention_scores
+
+    def score_out_of_core(self, posterior_probs, out, chunk_size=2**20,
+                                tmp_dir=None):
+        """
+            Scores a 1-D set of posteriors that need not fit in memory.
+            posterior_probs is a .npy file name or an array (typically a
+            memmap); out is a .npy file name, which is created as a
+            float64 memmap, or an array to write the scores into. The
+            sorted order comes from a chunked external sort whose runs
+            live in a temporary directory under tmp_dir, and the scores
+            are computed in streaming passes, so peak memory is a small
+            multiple of chunk_size values. Returns out.
+        """
+        instrumentation = self.marginal_delta_metric.instrumentation
+        if (instrumentation is not None):
+            start_time = time.time()
+        if (isinstance(posterior_probs, str)):
+            posterior_probs = np.load(posterior_probs, mmap_mode="r")
+        assert posterior_probs.ndim == 1,\
+            "out-of-core scoring is for a single task"
+        if (isinstance(out, str)):
+            out = np.lib.format.open_memmap(out, mode="w+", dtype="float64",
+                                            shape=posterior_probs.shape)
+        sort_dir = tempfile.mkdtemp(prefix="abstention_sort_", dir=tmp_dir)
+        try:
+            test_sorted_posterior_probs, test_sorted_indices =\
+                external_argsort(values=posterior_probs,
+                                 chunk_size=chunk_size, tmp_dir=sort_dir)
+            for start_idx, chunk_scores in\
+                self.marginal_delta_metric.score_sorted_posteriors_in_chunks(
+                    validation_stats=self.validation_stats,
+                    test_sorted_posterior_probs=test_sorted_posterior_probs,
+                    chunk_size=chunk_size):
+                out[test_sorted_indices[
+                    start_idx:start_idx+len(chunk_scores)]] = chunk_scores
+            del test_sorted_posterior_probs, test_sorted_indices
+        finally:
+            shutil.rmtree(sort_dir, ignore_errors=True)
+        if (isinstance(out, np.memmap)):
+            out.flush()
+        if (instrumentation is not None):
+            instrumentation.on_event("marginal_delta.score",
+                {"num_examples": len(posterior_probs),
+                 "seconds": time.time() - start_time})
+        return out
 
 
 class AbstractMarginalDeltaMetricMixin(object):
 
-    def estimate_metric(self, ppos, pos_cdfs, neg_cdfs):
+    """
+        estimate_metric_chunk and compute_abstention_score_chunk work on
+        one chunk of the sorted posteriors at a time (num_pos and
+        num_neg are the totals over all the chunks, and carry is what
+        compute_abstention_score_chunk returned for the previous chunk,
+        or None for the first one), so that the scores can be computed
+        out of core; estimate_metric and compute_abstention_score treat
+        the whole array as a single chunk.
+    """
+
+    def estimate_metric_chunk(self, ppos, pos_cdfs, neg_cdfs,
+                                    num_pos, num_neg, is_last_chunk=True):
+        #the contribution of the chunk to the numerator of the estimate;
+        #the estimate is the sum over the chunks divided by num_pos
         raise NotImplementedError()
 
+    def estimate_metric(self, ppos, pos_cdfs, neg_cdfs):
+        num_pos = np.sum(ppos, axis=0, dtype="float64")
+        num_neg = np.sum(1-ppos, axis=0, dtype="float64")
+        #the counts enter the per-example arithmetic in the dtype of ppos
+        return self.estimate_metric_chunk(
+                    ppos=ppos, pos_cdfs=pos_cdfs, neg_cdfs=neg_cdfs,
+                    num_pos=num_pos.astype(ppos.dtype),
+                    num_neg=num_neg.astype(ppos.dtype))/num_pos
+
     def compute_metric(self, y_true, y_score):
         raise NotImplementedError()
 
+    def compute_abstention_score_chunk(self, est_metric, est_numpos,
+                                             est_numneg, ppos, pos_cdfs,
+                                             neg_cdfs, carry=None,
+                                             is_last_chunk=True):
+        #returns (abstention scores, carry for the next chunk)
+        raise NotImplementedError()
+
     def compute_abstention_score(self, est_metric, est_numpos, est_numneg,
                                        ppos, pos_cdfs, neg_cdfs):
-        raise NotImplementedError()
+        return self.compute_abstention_score_chunk(
+                    est_metric=est_metric, est_numpos=est_numpos,
+                    est_numneg=est_numneg, ppos=ppos, pos_cdfs=pos_cdfs,
+                    neg_cdfs=neg_cdfs)[0]
 
 
 class MarginalDeltaAuRocMixin(AbstractMarginalDeltaMetricMixin):
 
-    def estimate_metric(self, ppos, pos_cdfs, neg_cdfs): 
+    def estimate_metric_chunk(self, ppos, pos_cdfs, neg_cdfs,
+                                    num_pos, num_neg, is_last_chunk=True):
         #probability that a randomly chosen positive is ranked above
-        #a randomly chosen negative:
-        est_total_positives = np.sum(ppos)
-        #probability of being ranked above a randomly chosen negative
-        #is just neg_cdf
-        return np.sum(ppos*neg_cdfs)/est_total_positives
+        #a randomly chosen negative. The probability of being ranked
+        #above a randomly chosen negative is just neg_cdf
+        return np.sum(ppos*neg_cdfs, axis=0, dtype="float64")
 
     def compute_metric(self, y_true, y_score):
-        return roc_auc_score(y_true=y_true, y_score=y_score)
+        return auroc_score(y_true=y_true, y_score=y_score)
 
-    def compute_abstention_score(self, est_metric, est_numpos, est_numneg,
-                                       ppos, pos_cdfs, neg_cdfs):
-        return (ppos*((est_metric - neg_cdfs)/est_numpos) 
-                + (1-ppos)*((est_metric - (1-pos_cdfs))/est_numneg))
+    def compute_abstention_score_chunk(self, est_metric, est_numpos,
+                                             est_numneg, ppos, pos_cdfs,
+                                             neg_cdfs, carry=None,
+                                             is_last_chunk=True):
+        return ((ppos*((est_metric - neg_cdfs)/est_numpos) 
+                 + (1-ppos)*((est_metric - (1-pos_cdfs))/est_numneg)),
+                None)
 
 
 class MarginalDeltaAuRoc(MarginalDeltaAuRocMixin, MarginalDeltaMetric):
@@ -497,40 +1653,48 @@ class MarginalDeltaAuRoc(MarginalDeltaAuRocMixin, MarginalDeltaMetric):
 
 class RecursiveMarginalDeltaAuRoc(MarginalDeltaAuRocMixin,
                                   RecursiveMarginalDeltaMetric):
-    pass
+
+    def get_eviction_engine(self, sorted_ppos):
+        return AuRocEvictionEngine(sorted_ppos=sorted_ppos)
 
 
 class MarginalDeltaAuPrcMixin(AbstractMarginalDeltaMetricMixin):
 
-    def estimate_metric(self, ppos, pos_cdfs, neg_cdfs): 
+    def estimate_metric_chunk(self, ppos, pos_cdfs, neg_cdfs,
+                                    num_pos, num_neg, is_last_chunk=True):
         #average precision over all the positives
-        num_pos = np.sum(ppos)
-        num_neg = np.sum(1-ppos)
         #num positives ranked above = (1-pos_cdfs)*num_pos
         #num negatives ranked above = (1-neg_cdfs)*num_neg
-        pos_cdfs[-1] = np.finfo(np.float32).eps #prevent div by 0
+        if (is_last_chunk):
+            pos_cdfs[-1] = np.finfo(np.float32).eps #prevent div by 0
         precision_at_threshold = ((1-pos_cdfs)*num_pos)/\
                                  ((1-pos_cdfs)*num_pos + (1-neg_cdfs)*num_neg)
-        precision_at_threshold[-1] = 1.0
-        return np.sum(ppos*precision_at_threshold)/num_pos
+        if (is_last_chunk):
+            precision_at_threshold[-1] = 1.0
+        return np.sum(ppos*precision_at_threshold, axis=0, dtype="float64")
 
     def compute_metric(self, y_true, y_score):
         return average_precision_score(y_true=y_true, y_score=y_score)
 
-    def compute_abstention_score(self, est_metric, est_numpos, est_numneg,
-                                       ppos, pos_cdfs, neg_cdfs):
-        pos_cdfs[-1] = -1.0 #prevent 0.0 warning
-        neg_cdfs[-1] = -1.0
+    def compute_abstention_score_chunk(self, est_metric, est_numpos,
+                                             est_numneg, ppos, pos_cdfs,
+                                             neg_cdfs, carry=None,
+                                             is_last_chunk=True):
+        if (is_last_chunk):
+            pos_cdfs[-1] = -1.0 #prevent 0.0 warning
+            neg_cdfs[-1] = -1.0
         precision_at_threshold =\
             ((1-pos_cdfs)*est_numpos)/(
              (1-pos_cdfs)*est_numpos + (1-neg_cdfs)*est_numneg)
-        precision_at_threshold[-1] = 1.0 #dealing with 0.0/0.0
+        if (is_last_chunk):
+            precision_at_threshold[-1] = 1.0 #dealing with 0.0/0.0
 
         est_nneg_above = est_numneg*(1-neg_cdfs)
         est_npos_above = est_numpos*(1-pos_cdfs)
-        #to prevent 0/0:
-        est_npos_above[-1] = 1.0
-        est_nneg_above[-1] = 0.0
+        if (is_last_chunk):
+            #to prevent 0/0:
+            est_npos_above[-1] = 1.0
+            est_nneg_above[-1] = 0.0
 
         #mep_pos = marginal effect on precision of evicting higher
         #ranked positive example
@@ -546,14 +1710,20 @@ class MarginalDeltaAuPrcMixin(AbstractMarginalDeltaMetricMixin):
         #return slope_if_positive*ppos + slope_if_negative*(1-ppos)
 
         mcpr_term1 = est_npos_above/np.square(est_npos_above + est_nneg_above)
-        cmcpr_term1 = np.cumsum(ppos*mcpr_term1)
+        cmcpr_term1 = np.cumsum(ppos*mcpr_term1, axis=0, dtype="float64")
         mcpr_term2 = -1.0/(est_npos_above + est_nneg_above)
-        cmcpr_term2 = np.cumsum(ppos*mcpr_term2)*ppos
+        cmcpr_term2 = np.cumsum(ppos*mcpr_term2, axis=0, dtype="float64")
+        if (carry is not None):
+            #the cumulative sums over the previous chunks
+            cmcpr_term1 += carry[0]
+            cmcpr_term2 += carry[1]
+        carry = (cmcpr_term1[-1], cmcpr_term2[-1])
+        cmcpr_term1 = cmcpr_term1.astype(ppos.dtype, copy=False)
+        cmcpr_term2 = cmcpr_term2.astype(ppos.dtype, copy=False)
         slope = (ppos*(est_metric - precision_at_threshold)
-                 + cmcpr_term1 + cmcpr_term2)/est_numpos
-
-        return slope
+                 + cmcpr_term1 + cmcpr_term2*ppos)/est_numpos
 
+        return slope, carry
 
 
 class MarginalDeltaAuPrc(MarginalDeltaAuPrcMixin, MarginalDeltaMetric):
@@ -562,33 +1732,201 @@ class MarginalDeltaAuPrc(MarginalDeltaAuPrcMixin, MarginalDeltaMetric):
 
 class RecursiveMarginalDeltaAuPrc(MarginalDeltaAuPrcMixin,
                                   RecursiveMarginalDeltaMetric):
-    pass
+
+    def get_eviction_engine(self, sorted_ppos):
+        return AuPrcEvictionEngine(sorted_ppos=sorted_ppos)
+
+
+class QuantileSketch(object):
+
+    """
+        Compact summary of a stream of values as at most about
+        max_centroids (mean, count) centroids sorted by mean. Each update
+        sorts the new values in and merges adjacent centroids as long as
+        the merged count stays within 2*total_count/max_centroids, so
+        quantiles and cdfs read off the sketch are within about
+        2/max_centroids (as a fraction of the stream) of the exact ones.
+        Memory is O(max_centroids) however long the stream.
+    """
+
+    def __init__(self, max_centroids=500):
+        self.max_centroids = max_centroids
+        self.means = np.zeros(0)
+        self.counts = np.zeros(0)
+        self.total_count = 0
+        self.min_value = np.inf
+        self.max_value = -np.inf
+
+    def update(self, values):
+        values = np.sort(np.asarray(values, dtype="float64").ravel())
+        if (len(values) == 0):
+            return
+        self.total_count += len(values)
+        self.min_value = min(self.min_value, values[0])
+        self.max_value = max(self.max_value, values[-1])
+        #merge the sorted values into the sorted centroids, after the
+        #centroids with equal means
+        num_items = len(self.means)+len(values)
+        value_slots = (np.searchsorted(self.means, values, side="right")
+                       + np.arange(len(values)))
+        is_centroid_slot = np.ones(num_items, dtype="bool")
+        is_centroid_slot[value_slots] = False
+        means = np.empty(num_items)
+        means[value_slots] = values
+        means[is_centroid_slot] = self.means
+        counts = np.ones(num_items)
+        counts[is_centroid_slot] = self.counts
+        if (num_items <= self.max_centroids):
+            self.means, self.counts = means, counts
+            return
+
+        max_centroid_count = 2.0*self.total_count/self.max_centroids
+        #greedily merge runs of adjacent centroids: a run starting at item
+        #i ends before the first item that takes the merged count over
+        #max_centroid_count, so next_start[i] is one searchsorted for all
+        #i, and the starts of the runs (the chain 0, next_start[0], ...)
+        #come from pointer doubling. Sums of values are kept so that
+        #merged means are exact
+        cumulative_counts = np.cumsum(counts)
+        next_start = np.maximum(
+            np.searchsorted(cumulative_counts,
+                            cumulative_counts - counts + max_centroid_count,
+                            side="right"),
+            np.arange(1, num_items+1))
+        jumps = np.append(next_start, num_items)
+        run_starts = np.zeros(1, dtype="int64")
+        while (run_starts[-1] < num_items):
+            run_starts = np.concatenate([run_starts, jumps[run_starts]])
+            jumps = jumps[jumps]
+        run_starts = run_starts[run_starts < num_items]
+        self.counts = np.add.reduceat(counts, run_starts)
+        self.means = np.add.reduceat(means*counts, run_starts)/self.counts
+
+    def get_quantiles(self, probs):
+        #interpolates between centroid means placed at the middle of
+        #their mass, and the smallest and largest values seen
+        cumulative_counts = np.cumsum(self.counts)
+        knot_probs = np.concatenate([[0.0],
+            (cumulative_counts - 0.5*self.counts)/self.total_count, [1.0]])
+        knot_values = np.concatenate([[self.min_value], self.means,
+                                      [self.max_value]])
+        return np.interp(probs, knot_probs, knot_values)
+
+
+class StreamingMarginalDeltaScorer(object):
+
+    """
+        Online version of the abstaining_func of a MarginalDeltaMetric
+        (e.g. MarginalDeltaAuRoc), for a single task whose test posteriors
+        arrive in micro-batches. The test posteriors seen so far are kept
+        in a QuantileSketch. After each update the marginal delta scores
+        are computed for num_quantiles quantiles of the sketch (at
+        probabilities (k+0.5)/num_quantiles), scaled to the number of
+        examples seen, and every item of a batch is scored by linearly
+        interpolating between them (or extrapolating from the end ones),
+        in O(log num_quantiles).
+
+        Calling the scorer on a batch updates it with the batch and then
+        scores the batch, so the scores reflect all the data up to and
+        including it; update and score can also be called separately.
+    """
+
+    def __init__(self, marginal_delta_metric, valid_labels, valid_posterior,
+                       max_centroids=500, num_quantiles=2000):
+        self.marginal_delta_metric = marginal_delta_metric
+        self.validation_stats = marginal_delta_metric.get_validation_stats(
+            valid_labels=np.asarray(valid_labels),
+            valid_posterior=np.asarray(valid_posterior))
+        self.sketch = QuantileSketch(max_centroids=max_centroids)
+        self.num_quantiles = num_quantiles
+        self.quantiles = None
+        self.quantile_scores = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["marginal_delta_metric"] = without_instrumentation(
+            self.marginal_delta_metric)
+        return state
+
+    def update(self, posterior_probs):
+        self.sketch.update(posterior_probs)
+        self.quantiles = self.sketch.get_quantiles(
+            (np.arange(self.num_quantiles)+0.5)/self.num_quantiles)
+        self.quantile_scores =\
+            self.marginal_delta_metric.score_sorted_posteriors(
+                validation_stats=self.validation_stats,
+                test_sorted_posterior_probs=self.quantiles,
+                num_examples=self.sketch.total_count)
+
+    def score(self, posterior_probs):
+        posterior_probs = np.asarray(posterior_probs)
+        scores = np.interp(posterior_probs, self.quantiles,
+                           self.quantile_scores)
+        #extrapolate beyond the end quantiles along the end segments
+        for (end, inner, is_outside) in [
+            (-1, -2, posterior_probs > self.quantiles[-1]),
+            (0, 1, posterior_probs < self.quantiles[0])]:
+            value_gap = self.quantiles[end] - self.quantiles[inner]
+            if (np.any(is_outside) and value_gap != 0):
+                slope = (self.quantile_scores[end]
+                         - self.quantile_scores[inner])/value_gap
+                scores[is_outside] += slope*(posterior_probs[is_outside]
+                                             - self.quantiles[end])
+        return scores
+
+    def __call__(self, posterior_probs):
+        self.update(posterior_probs)
+        return self.score(posterior_probs)
 
 
 class Uncertainty(AbstainerFactory):
 
+    handles_multiple_tasks = True
+
     def __call__(self, valid_labels=None, valid_posterior=None,
                        valid_uncert=None):
 
-        def abstaining_func(posterior_probs, uncertainties):
-            #posterior_probs can be None
-            return uncertainties
-        return abstaining_func
+        return UncertaintyAbstainingFunc()
+
+
+class UncertaintyAbstainingFunc(object):
+
+    def __call__(self, posterior_probs, uncertainties):
+        #posterior_probs can be None
+        return uncertainties
 
 
 class ConvexHybrid(AbstainerFactory):
 
+    """
+        Mixes the scores of two abstainers as a*scores1 + (1-a)*scores2,
+        with a chosen on the validation set from a grid of the given
+        stepsize. If abstention_eval_func is an AbstentionEval, all the
+        mixtures of a grid are evaluated together; otherwise they are
+        evaluated one at a time, on num_workers threads if specified.
+        Each refinement round searches around the best a with a step
+        that is stepsize times smaller.
+    """
+
     def __init__(self, factory1, factory2,
                        abstention_eval_func, stepsize=0.1,
-                       verbose=True):
+                       num_refinement_rounds=0,
+                       num_workers=None,
+                       verbose=True, instrumentation=None):
         self.factory1 = factory1
         self.factory2 = factory2
         self.abstention_eval_func = abstention_eval_func
         self.stepsize = stepsize
+        self.num_refinement_rounds = num_refinement_rounds
+        self.num_workers = num_workers
         self.verbose = verbose
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
 
     def __call__(self, valid_labels, valid_posterior, valid_uncert):
 
+        if (self.instrumentation is not None):
+            start_time = time.time()
         factory1_func = self.factory1(valid_labels=valid_labels,
                                       valid_posterior=valid_posterior,
                                       valid_uncert=valid_uncert)
@@ -602,39 +1940,102 @@ class ConvexHybrid(AbstainerFactory):
                     y_true=valid_labels,
                     y_score=valid_posterior)  
 
+        if (isinstance(self.abstention_eval_func, AbstentionEval)):
+            def batch_evaluation_func(scores):
+                return self.abstention_eval_func.evaluate_many(
+                        abstention_scores=scores,
+                        y_true=valid_labels,
+                        y_score=valid_posterior)
+        else:
+            batch_evaluation_func = None
+
         a = find_best_mixing_coef(
                 evaluation_func=evaluation_func,
                 scores1=factory1_func(posterior_probs=valid_posterior,
                                       uncertainties=valid_uncert),
                 scores2=factory2_func(posterior_probs=valid_posterior,
                                       uncertainties=valid_uncert),
-                stepsize=self.stepsize)
+                stepsize=self.stepsize,
+                batch_evaluation_func=batch_evaluation_func,
+                num_workers=self.num_workers,
+                num_refinement_rounds=self.num_refinement_rounds)
        
-        if (self.verbose):
-            print("Best a",a) 
-
-        def abstaining_func(posterior_probs, uncertainties):
-            scores1 = factory1_func(posterior_probs=posterior_probs,
-                                    uncertainties=uncertainties)
-            scores2 = factory2_func(posterior_probs=posterior_probs,
-                                   uncertainties=uncertainties)
-            return a*scores1 + (1-a)*scores2
-        return abstaining_func
+        if (self.instrumentation is not None):
+            self.instrumentation.on_event("convex_hybrid.fit",
+                {"mixing_coef": a, "seconds": time.time() - start_time})
+
+        return ConvexHybridAbstainingFunc(func1=factory1_func,
+                                          func2=factory2_func,
+                                          mixing_coef=a)
+
+
+class ConvexHybridAbstainingFunc(object):
+
+    def __init__(self, func1, func2, mixing_coef):
+        self.func1 = func1
+        self.func2 = func2
+        self.mixing_coef = mixing_coef
+
+    def __call__(self, posterior_probs, uncertainties):
+        scores1 = self.func1(posterior_probs=posterior_probs,
+                             uncertainties=uncertainties)
+        scores2 = self.func2(posterior_probs=posterior_probs,
+                             uncertainties=uncertainties)
+        a = np.asarray(self.mixing_coef, dtype=get_float_dtype(scores1))
+        return a*scores1 + (1-a)*scores2
+
+
+def find_best_mixing_coef(evaluation_func, scores1, scores2, stepsize,
+                          batch_evaluation_func=None, num_workers=None,
+                          num_refinement_rounds=0):
+    """
+        Returns the a maximizing evaluation_func(a*scores1 + (1-a)*scores2)
+        over a grid of the given stepsize (lowest a on ties), refined
+        num_refinement_rounds times around the best a with a grid that is
+        stepsize times finer. batch_evaluation_func, if given, evaluates
+        an (n, num_coefs) matrix of mixtures in one call; otherwise the
+        mixtures are evaluated on a pool of num_workers threads, or
+        serially if num_workers is None. Mixtures whose objective is nan
+        (e.g. if a single class is retained) are never picked; if every
+        objective on the first grid is nan, a=0 is returned.
+    """
 
+    assert stepsize > 0.0 and stepsize < 1.0
 
-def find_best_mixing_coef(evaluation_func, scores1, scores2, stepsize):
+    def evaluate(coefs_to_try):
+        if (batch_evaluation_func is not None):
+            return np.asarray(batch_evaluation_func(
+                    scores1[:,None]*coefs_to_try[None,:]
+                    + scores2[:,None]*(1.0-coefs_to_try)[None,:]))
+        objective_func = (lambda a: evaluation_func(a*scores1
+                                                    + (1.0-a)*scores2))
+        if (num_workers is not None):
+            pool = ThreadPool(num_workers)
+            try:
+                return np.array(pool.map(objective_func, coefs_to_try))
+            finally:
+                pool.close()
+        return np.array([objective_func(a) for a in coefs_to_try])
+
+    def get_best(coefs_to_try):
+        objectives = np.asarray(evaluate(coefs_to_try), dtype="float64")
+        if (np.all(np.isnan(objectives))):
+            return None, np.nan
+        best_idx = np.nanargmax(objectives)
+        return coefs_to_try[best_idx], objectives[best_idx]
 
-    assert stepsize > 0.0 and stepsize < 1.0
     coefs_to_try = np.arange(0.0, 1+stepsize, stepsize)
-
-    best_objective = None
-    best_a = 0
-    for a in coefs_to_try:
-        b = 1.0 - a
-        scores = a*scores1 + b*scores2
-        objective = evaluation_func(scores) 
-        if (best_objective is None or objective > best_objective):
-            best_objective = objective 
-            best_a = a
+    best_a, best_objective = get_best(coefs_to_try)
+    if (best_a is None):
+        return coefs_to_try[0]
+
+    search_stepsize = stepsize
+    for refinement_round in range(num_refinement_rounds):
+        coefs_to_try = np.arange(max(best_a-search_stepsize, 0.0),
+                                 min(best_a+search_stepsize, 1.0),
+                                 search_stepsize*stepsize)
+        search_stepsize = search_stepsize*stepsize
+        a, objective = get_best(coefs_to_try)
+        if (a is not None and objective > best_objective):
+            best_a, best_objective = a, objective
     return best_a
-
@@ -1,41 +1,109 @@
 from __future__ import division, print_function, absolute_import
 import numpy as np
-from sklearn.neighbors.kde import KernelDensity
-from sklearn.metrics import brier_score_loss
-from sklearn.metrics import log_loss
-import scipy
-from scipy.special import expit
-import scipy.misc
-import scipy.optimize
-from sklearn.isotonic import IsotonicRegression as IR
-from sklearn.linear_model import LogisticRegression as LR
-
-
-def softmax(preact, temp):
-    exponents = np.exp(preact/temp)
-    sum_exponents = np.sum(exponents, axis=1) 
-    return exponents/sum_exponents[:,None]
+import time
+from .instrumentation import get_instrumentation
+from .util import get_float_dtype
+#scipy.optimize and sklearn are imported inside the calibrators that fit
+#with them, so that only numpy is needed to import this module and to
+#apply fitted calibrators
+
+
+def expit(x, out=None):
+    #numpy-only logistic function; exp(-|x|) cannot overflow
+    x = np.asarray(x)
+    exp_neg_abs_x = np.exp(-np.abs(x))
+    return np.divide(np.where(x >= 0, 1.0, exp_neg_abs_x),
+                     1.0 + exp_neg_abs_x, out=out)
+
+
+def softmax(preact, temp, dtype=None):
+    #normalizes over the last axis, so a (runs, n, classes) block of
+    #preacts can be passed in one call
+    dtype = get_float_dtype(preact, dtype)
+    scaled_preact = (np.asarray(preact, dtype=dtype)
+                     /np.asarray(temp, dtype=dtype))
+    #subtracting the row max keeps exp from overflowing, which matters
+    #in float32 already for logits of about 89
+    scaled_preact -= np.max(scaled_preact, axis=-1, keepdims=True)
+    exponents = np.exp(scaled_preact, out=scaled_preact)
+    sum_exponents = np.sum(exponents, axis=-1, keepdims=True)
+    return exponents/sum_exponents
 
 
 #based on https://github.com/gpleiss/temperature_scaling/blob/master/temperature_scaling.py#L78
 def compute_ece(softmax_out, labels, bins):
-
-    bin_boundaries = np.linspace(0,1,num=bins)
-    bin_lowers = bin_boundaries[:-1]
-    bin_uppers = bin_boundaries[1:]
-
-    confidences = np.max(softmax_out,axis=1)
-    is_correct = np.argmax(softmax_out,axis=1)==np.argmax(labels,axis=1)
-
-    ece = 0.0 
-    for bin_lower, bin_upper in zip(bin_lowers, bin_uppers):
-        in_bin = (confidences > bin_lower)*(confidences <= bin_upper)
-        prop_in_bin = np.mean((in_bin)) 
-        if (prop_in_bin > 0.0):
-            accuracy_in_bin = np.mean(is_correct[in_bin])
-            avg_confidence_in_bin = np.mean(confidences[in_bin])
-            ece += np.abs(avg_confidence_in_bin-accuracy_in_bin)*prop_in_bin
-    return ece*100
+    #bins can be a list of bin counts, in which case a list of eces is
+    #returned from a single pass over the data
+    ece_accumulator = EceAccumulator(bins=bins)
+    ece_accumulator.update(softmax_out=softmax_out, labels=labels)
+    return ece_accumulator.get_ece()
+
+
+class EceAccumulator(object):
+
+    """
+        Accumulates, bin by bin, the counts, confidences and accuracies
+        needed for the expected calibration error, so that the ece (and
+        reliability diagram data) of a large evaluation set can be computed
+        by feeding it in chunks. As in compute_ece, `bins` bin boundaries
+        are spaced evenly over [0,1] and a bin holds the confidences in
+        (lower, upper]. bins can be a list to track several bin counts at
+        once.
+    """
+
+    def __init__(self, bins):
+        self.bins_is_list = isinstance(bins, (list, tuple, np.ndarray))
+        self.all_bins = list(bins) if self.bins_is_list else [bins]
+        self.bin_boundaries = [np.linspace(0,1,num=x) for x in self.all_bins]
+        self.counts = [np.zeros(x-1) for x in self.all_bins]
+        self.sum_confidences = [np.zeros(x-1) for x in self.all_bins]
+        self.sum_correct = [np.zeros(x-1) for x in self.all_bins]
+        self.total_count = 0
+
+    def update(self, softmax_out, labels):
+        confidences = np.max(softmax_out,axis=1)
+        is_correct = np.argmax(softmax_out,axis=1)==np.argmax(labels,axis=1)
+        self.total_count += len(confidences)
+        for i, bin_boundaries in enumerate(self.bin_boundaries):
+            num_bins = len(bin_boundaries)-1
+            bin_idx = np.searchsorted(bin_boundaries, confidences,
+                                      side="left")-1
+            #confidences of exactly 0 fall in no bin
+            in_range = bin_idx >= 0
+            bin_idx = bin_idx[in_range]
+            self.counts[i] += np.bincount(bin_idx, minlength=num_bins)
+            self.sum_confidences[i] += np.bincount(bin_idx,
+                weights=confidences[in_range], minlength=num_bins)
+            self.sum_correct[i] += np.bincount(bin_idx,
+                weights=is_correct[in_range], minlength=num_bins)
+
+    def get_reliability_diagram(self):
+        """
+            Returns, for each bin count, a dict of the bin lower and upper
+            boundaries, the counts, and the average confidence and accuracy
+            in each bin (nan for empty bins)
+        """
+        to_return = []
+        for bin_boundaries, counts, sum_confidences, sum_correct in zip(
+                self.bin_boundaries, self.counts, self.sum_confidences,
+                self.sum_correct):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                to_return.append({
+                    'bin_lowers': bin_boundaries[:-1],
+                    'bin_uppers': bin_boundaries[1:],
+                    'counts': counts,
+                    'avg_confidences': sum_confidences/counts,
+                    'accuracies': sum_correct/counts})
+        return to_return if self.bins_is_list else to_return[0]
+
+    def get_ece(self):
+        eces = []
+        for counts, sum_confidences, sum_correct in zip(
+                self.counts, self.sum_confidences, self.sum_correct):
+            #|avg_confidence - accuracy|*prop_in_bin, summed over bins
+            eces.append(100*np.sum(np.abs(sum_confidences - sum_correct))
+                        /self.total_count)
+        return eces if self.bins_is_list else eces[0]
 
 
 class CalibratorFactory(object):
@@ -44,72 +112,120 @@ class CalibratorFactory(object):
         raise NotImplementedError()
 
 
+class SoftmaxCalibrationFunc(object):
+
+    def __init__(self, temp=1.0, dtype=None):
+        self.temp = temp
+        self.dtype = dtype
+
+    def __call__(self, preact):
+        return softmax(preact=preact, temp=self.temp, dtype=self.dtype)
+
+
 class Softmax(CalibratorFactory):
 
     def __call__(self, valid_preacts=None, valid_labels=None):
-        return (lambda x: softmax(preact=x, temp=1.0))
+        return SoftmaxCalibrationFunc(temp=1.0)
+
+
+def temp_scaling_nll_and_grad(preacts, labels, temp,
+                              chunk_size=None, dtype=None):
+    """
+        Mean negative log likelihood of softmax(preacts/temp) and its
+        derivative w.r.t. temp. preacts and labels (one-hot) can be
+        memory-mapped; they are read chunk_size rows at a time (all at
+        once if None) and cast to dtype (default: the dtype of preacts if
+        it is floating, else float64). The logsumexp is stabilized by the
+        row max, and the sums are accumulated in float64.
+    """
+    dtype = get_float_dtype(preacts[:0], dtype)
+    num_rows = len(preacts)
+    if (chunk_size is None):
+        chunk_size = num_rows
+    temp = float(temp)
+    total_nll = 0.0
+    total_grad = 0.0
+    for start in range(0, num_rows, chunk_size):
+        chunk_preacts = np.asarray(preacts[start:start+chunk_size],
+                                   dtype=dtype)
+        chunk_labels = np.asarray(labels[start:start+chunk_size],
+                                  dtype=dtype)
+        scaled_preacts = chunk_preacts/temp
+        max_scaled_preacts = np.max(scaled_preacts, axis=1, keepdims=True)
+        #reuse the buffer for the shifted exponents
+        exp_result = np.exp(scaled_preacts - max_scaled_preacts,
+                            out=scaled_preacts)
+        sum_exp = np.sum(exp_result, axis=1)
+        log_sum_exp = max_scaled_preacts[:,0] + np.log(sum_exp)
+        #expected preactivation under the softmax
+        expected_preacts = np.einsum("ij,ij->i", chunk_preacts,
+                                     exp_result)/sum_exp
+        logits_that_matter = np.einsum("ij,ij->i", chunk_preacts,
+                                       chunk_labels)
+        total_nll += np.sum(log_sum_exp - logits_that_matter/temp,
+                            dtype="float64")
+        total_grad += np.sum(logits_that_matter - expected_preacts,
+                             dtype="float64")
+    return total_nll/num_rows, total_grad/(num_rows*(temp**2))
 
 
 class TempScaling(CalibratorFactory):
 
-    def __init__(self, ece_bins=15, lbfgs_kwargs={}, verbose=True):
+    """
+        Fits a softmax temperature by minimizing the validation NLL with
+        L-BFGS. valid_preacts (and valid_labels) can be a path to a .npy
+        file, which is memory-mapped; with chunk_size set, the NLL, its
+        gradient and the ece are accumulated chunk_size rows at a time.
+        dtype (e.g. np.float32) sets the precision of the per-chunk
+        arithmetic and of the returned calibrator's output; by default
+        both follow the dtype of the preacts.
+    """
+
+    def __init__(self, ece_bins=15, lbfgs_kwargs={}, verbose=True,
+                       chunk_size=None, dtype=None, instrumentation=None):
         self.lbfgs_kwargs = lbfgs_kwargs
         self.verbose = verbose
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
         self.ece_bins = ece_bins
+        self.chunk_size = chunk_size
+        self.dtype = dtype
 
     def __call__(self, valid_preacts, valid_labels):
-
-        assert np.max(np.sum(valid_labels,axis=1)==1.0)
+        import scipy.optimize
+
+        instrumentation = self.instrumentation
+        if (instrumentation is not None):
+            start_time = time.time()
+        if (isinstance(valid_preacts, str)):
+            valid_preacts = np.load(valid_preacts, mmap_mode="r")
+        if (isinstance(valid_labels, str)):
+            valid_labels = np.load(valid_labels, mmap_mode="r")
+
+        #check the labels chunk by chunk, so memory-mapped labels are
+        #never read into memory all at once
+        chunk_size = (self.chunk_size if self.chunk_size is not None
+                      else len(valid_labels))
+        for start in range(0, len(valid_labels), chunk_size):
+            assert np.all(np.sum(valid_labels[start:start+chunk_size],
+                                 axis=1)==1.0), "labels must be one-hot"
 
         #calculate the temperature scaling parameter
         def eval_func(x):
-            x = x[0]
-            temp_scaled_valid_preacts = valid_preacts/float(x)
-            log_sum_exp = scipy.misc.logsumexp(a = temp_scaled_valid_preacts) 
-
-            exp_result = np.exp(temp_scaled_valid_preacts)
-            sum_exp = np.sum(exp_result, axis=1)
-            sum_preact_times_exp = np.sum(valid_preacts*
-                                          exp_result, axis=1)
-
-            logits_that_matter =\
-                np.sum(valid_preacts*valid_labels, axis=1)
-            
-            log_likelihoods = logits_that_matter/float(x) - log_sum_exp
-            nll = -np.mean(log_likelihoods)
-            grads = ((sum_preact_times_exp/sum_exp - logits_that_matter)/\
-                     (float(x)**2))
-            mean_grad = -np.mean(grads)
-            return nll, np.array([mean_grad])
-
-        def eval_fprime(x):
-            x = x[0]
-            temp_scaled_valid_preacts = valid_preacts/float(x)
-            log_sum_exp = scipy.misc.logsumexp(a = temp_scaled_valid_preacts) 
-
-            exp_result = np.exp(temp_scaled_valid_preacts)
-            sum_exp = np.sum(exp_result, axis=1)
-            sum_preact_times_exp = np.sum(temp_scaled_valid_preacts*
-                                          exp_result, axis=1)
-
-            logits_that_matter =\
-                np.sum(valid_preacts*valid_labels, axis=1)
-            
-            log_likelihoods = logits_that_matter/float(x) - log_sum_exp
-            nll = np.mean(log_likelihoods)
-            grads = ((sum_exp/sum_preact_times_exp - logits_that_matter)/\
-                     (float(x)**2))
-            mean_grad = -np.mean(grads)
-
-            return np.array([mean_grad])
-
-        if (self.verbose):
-            original_nll = eval_func(np.array([1.0])) 
-            original_ece = compute_ece(
-                softmax_out=softmax(preact=valid_preacts, temp=1.0),
-                labels=valid_labels, bins=self.ece_bins) 
-            print("Original NLL & grad is: ",original_nll)
-            print("Original ECE is: ",original_ece)
+            nll, grad = temp_scaling_nll_and_grad(
+                            preacts=valid_preacts, labels=valid_labels,
+                            temp=x[0], chunk_size=self.chunk_size,
+                            dtype=self.dtype)
+            return nll, np.array([grad])
+
+        if (instrumentation is not None):
+            original_nll, original_grad = eval_func(np.array([1.0])) 
+            original_ece = self.compute_ece_in_chunks(
+                valid_preacts=valid_preacts, valid_labels=valid_labels,
+                temp=1.0)
+            instrumentation.on_event("temp_scaling.initial",
+                {"nll": original_nll, "grad": original_grad[0],
+                 "ece": original_ece})
             
         optimization_result = scipy.optimize.minimize(fun=eval_func,
                                   x0=np.array([1.0]),
@@ -118,128 +234,452 @@ class TempScaling(CalibratorFactory):
                                   method='L-BFGS-B',
                                   tol=1e-07,
                                   **self.lbfgs_kwargs)
-        if (self.verbose):
-            print(optimization_result)
         optimal_t = optimization_result.x
 
-        if (self.verbose):
-            final_nll = eval_func(np.array([optimal_t])) 
-            final_ece = compute_ece(
-                softmax_out=softmax(preact=valid_preacts, temp=optimal_t),
-                labels=valid_labels, bins=self.ece_bins) 
-            print("Final NLL & grad is: ",final_nll)
-            print("Final ECE is: ",final_ece)
-
-        return (lambda x: softmax(preact=x, temp=optimal_t))
+        if (instrumentation is not None):
+            instrumentation.on_event("temp_scaling.optimizer",
+                {"temperature": optimal_t[0],
+                 "iterations": optimization_result.nit,
+                 "function_evaluations": optimization_result.nfev,
+                 "success": optimization_result.success,
+                 "message": optimization_result.message})
+            final_nll, final_grad = eval_func(optimal_t)
+            final_ece = self.compute_ece_in_chunks(
+                valid_preacts=valid_preacts, valid_labels=valid_labels,
+                temp=optimal_t)
+            instrumentation.on_event("temp_scaling.final",
+                {"nll": final_nll, "grad": final_grad[0],
+                 "ece": final_ece, "seconds": time.time() - start_time})
+
+        return SoftmaxCalibrationFunc(temp=optimal_t, dtype=self.dtype)
+
+    def compute_ece_in_chunks(self, valid_preacts, valid_labels, temp):
+        chunk_size = (self.chunk_size if self.chunk_size is not None
+                      else len(valid_preacts))
+        ece_accumulator = EceAccumulator(bins=self.ece_bins)
+        for start in range(0, len(valid_preacts), chunk_size):
+            ece_accumulator.update(
+                softmax_out=softmax(
+                    preact=np.asarray(valid_preacts[start:start+chunk_size]),
+                    temp=temp),
+                labels=np.asarray(valid_labels[start:start+chunk_size]))
+        return ece_accumulator.get_ece()
+
+
+class ExpitCalibrationFunc(object):
+
+    def __call__(self, preact):
+        return expit(preact)
 
 
 class Expit(CalibratorFactory):
 
     def __call__(self, valid_preacts=None, valid_labels=None):
-        def func(preact):
-            return expit(preact)
-        return func
+        return ExpitCalibrationFunc()
+
+
+def flatten_single_column(preact):
+    #an (n, 1) preact is a single task, to be calibrated to shape (n,)
+    if (preact.ndim == 2 and preact.shape[1] == 1):
+        return preact[:,0]
+    return preact
+
+
+def fit_platt_scaling(preacts, labels, C=1.0, max_iterations=100,
+                      tol=1e-10):
+    """
+        Fits a Platt scaling (coef, intercept) pair to every column of the
+        (n, k) preacts and labels at once. It minimizes the log loss plus
+        0.5*coef**2/C, the same objective as sklearn's
+        LogisticRegression(C=C), using Newton's method. Each step solves
+        the 2x2 Newton system of every task in closed form, and halves the
+        step for any task whose loss would increase. Tasks drop out of the
+        iteration once their step falls below tol. Returns (coefs,
+        intercepts), each of shape (k,).
+    """
+    preacts = np.asarray(preacts, dtype="float64")
+    labels = np.asarray(labels, dtype="float64")
+    num_tasks = preacts.shape[1]
+
+    def compute_loss(preacts, labels, coefs, intercepts):
+        logits = preacts*coefs[None,:] + intercepts[None,:]
+        return (np.sum(np.logaddexp(0, logits) - labels*logits, axis=0)
+                + 0.5*np.square(coefs)/C)
+
+    #start from the best intercept-only fit
+    mean_labels = np.clip(np.mean(labels, axis=0), 1e-7, 1-1e-7)
+    coefs = np.zeros(num_tasks)
+    intercepts = np.log(mean_labels/(1-mean_labels))
+    loss = compute_loss(preacts, labels, coefs, intercepts)
+
+    active = np.arange(num_tasks)
+    for iteration in range(max_iterations):
+        if (len(active) < num_tasks):
+            active_preacts = preacts[:,active]
+            active_labels = labels[:,active]
+        else:
+            active_preacts, active_labels = preacts, labels
+        active_coefs = coefs[active]
+        active_intercepts = intercepts[active]
+        active_loss = loss[active]
+
+        probs = expit(active_preacts*active_coefs[None,:]
+                      + active_intercepts[None,:])
+        residuals = probs - active_labels
+        weights = probs*(1-probs)
+        grad_coef = (np.sum(residuals*active_preacts, axis=0)
+                     + active_coefs/C)
+        grad_intercept = np.sum(residuals, axis=0)
+        hess_coef = (np.sum(weights*np.square(active_preacts), axis=0)
+                     + 1.0/C)
+        hess_cross = np.sum(weights*active_preacts, axis=0)
+        hess_intercept = np.sum(weights, axis=0)
+        det = np.maximum(hess_coef*hess_intercept - np.square(hess_cross),
+                         1e-12)
+        step_coef = (hess_intercept*grad_coef - hess_cross*grad_intercept)/det
+        step_intercept = (hess_coef*grad_intercept
+                          - hess_cross*grad_coef)/det
+
+        #allow for rounding error in the summed loss
+        max_loss = active_loss + 1e-12*np.abs(active_loss)
+        step_size = np.ones(len(active))
+        new_loss = compute_loss(active_preacts, active_labels,
+                                active_coefs - step_coef,
+                                active_intercepts - step_intercept)
+        worse = new_loss > max_loss
+        for halving in range(30):
+            if (not np.any(worse)):
+                break
+            step_size[worse] *= 0.5
+            new_loss[worse] = compute_loss(active_preacts[:,worse],
+                active_labels[:,worse],
+                active_coefs[worse] - step_size[worse]*step_coef[worse],
+                active_intercepts[worse]
+                - step_size[worse]*step_intercept[worse])
+            worse = new_loss > max_loss
+        #no decrease even for a tiny step: leave that task where it is
+        step_size[worse] = 0.0
+        new_loss[worse] = active_loss[worse]
+
+        coef_change = step_size*step_coef
+        intercept_change = step_size*step_intercept
+        coefs[active] = active_coefs - coef_change
+        intercepts[active] = active_intercepts - intercept_change
+        loss[active] = new_loss
+        converged = ((np.abs(coef_change) <= tol*(1+np.abs(coefs[active])))
+                     & (np.abs(intercept_change)
+                        <= tol*(1+np.abs(intercepts[active]))))
+        active = active[~converged]
+        if (len(active) == 0):
+            break
+
+    return coefs, intercepts
+
+
+class PlattCalibrationFunc(object):
+
+    """
+        Fitted Platt scaling calibrator: expit(coef*preact + intercept),
+        with no sklearn objects involved at apply time. For a single task
+        coef and intercept are scalars and it applies elementwise, so
+        e.g. a whole (runs, n) block of dropout preacts can be passed at
+        once; an (n, 1) preact is treated as (n,). For k tasks coef and
+        intercept have shape (k,) and preact is (..., k). If out is given
+        (an array of the output shape), the result is written into it.
+        The result is computed in dtype, or in the dtype of preact if
+        that is floating (see util.get_float_dtype).
+    """
+
+    def __init__(self, coef, intercept, dtype=None):
+        self.coef = np.asarray(coef, dtype="float64")
+        self.intercept = np.asarray(intercept, dtype="float64")
+        self.dtype = dtype
+
+    def __call__(self, preact, out=None):
+        preact = flatten_single_column(np.asarray(preact))
+        dtype = get_float_dtype(preact, self.dtype)
+        out = np.multiply(preact.astype(dtype, copy=False),
+                          self.coef.astype(dtype), out=out)
+        out += self.intercept.astype(dtype)
+        return expit(out, out=out)
 
 
 class PlattScaling(CalibratorFactory):
 
-    def __init__(self, verbose=True):
+    """
+        If valid_labels is an (n, k) matrix, valid_preacts must be (n, k)
+        too and all k tasks are fitted at once; the returned calibrator
+        then maps (n, k) preacts to (n, k) probabilities.
+    """
+
+    def __init__(self, verbose=True, C=1.0, instrumentation=None,
+                       dtype=None):
         self.verbose=verbose
+        self.C = C
+        self.dtype = dtype
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
 
     def __call__(self, valid_preacts, valid_labels):
 
-        lr = LR()                                                       
-        #LR needs X to be 2-dimensional
-        lr.fit(valid_preacts.reshape(-1,1), valid_labels) 
+        if (self.instrumentation is not None):
+            start_time = time.time()
+
+        valid_labels = np.asarray(valid_labels)
+        multi_task = (valid_labels.ndim == 2)
+        if (multi_task):
+            coefs, intercepts = fit_platt_scaling(
+                preacts=valid_preacts, labels=valid_labels, C=self.C)
+            coef, intercept = coefs, intercepts
+        else:
+            coefs, intercepts = fit_platt_scaling(
+                preacts=np.asarray(valid_preacts).reshape(-1,1),
+                labels=valid_labels.reshape(-1,1), C=self.C)
+            coef, intercept = coefs[0], intercepts[0]
    
-        if (self.verbose): 
-            print("Platt scaling coef:", lr.coef_[0][0],
-                  "; intercept:",lr.intercept_[0])
+        if (self.instrumentation is not None): 
+            self.instrumentation.on_event("platt_scaling.fit",
+                {"coef": coef, "intercept": intercept,
+                 "num_tasks": len(coefs),
+                 "seconds": time.time() - start_time})
     
-        def calibration_func(preact):
-            return lr.predict_proba(preact.reshape(-1,1))[:,1]
-    
-        return calibration_func
+        return PlattCalibrationFunc(coef=coef, intercept=intercept,
+                                    dtype=self.dtype)
+
+
+class IsotonicCalibrationFunc(object):
+
+    """
+        Fitted isotonic regression calibrator, stored as the breakpoints
+        of the piecewise-linear fit and applied with np.interp. Preacts
+        outside the fitted range get the value at the nearest end, as
+        with clipping to the validation range. It applies elementwise, so
+        e.g. a whole (runs, n) block of dropout preacts can be passed at
+        once; an (n, 1) preact is treated as (n,). If out is given (an
+        array of the output shape), the result is written into it. The
+        result has dtype, or the dtype of preact if that is floating.
+    """
+
+    def __init__(self, x_breakpoints, y_breakpoints, dtype=None):
+        self.x_breakpoints = np.asarray(x_breakpoints, dtype="float64")
+        self.y_breakpoints = np.asarray(y_breakpoints, dtype="float64")
+        self.dtype = dtype
+
+    def __call__(self, preact, out=None):
+        preact = flatten_single_column(np.asarray(preact))
+        result = np.interp(preact, self.x_breakpoints, self.y_breakpoints)
+        if (out is None):
+            return result.astype(get_float_dtype(preact, self.dtype),
+                                 copy=False)
+        out[...] = result
+        return out
 
 
 class IsotonicRegression(CalibratorFactory):
 
-    def __init__(self, verbose=True):
+    def __init__(self, verbose=True, dtype=None, instrumentation=None):
         self.verbose = verbose 
+        self.dtype = dtype
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
 
     def __call__(self, valid_preacts, valid_labels):
+        from sklearn.isotonic import IsotonicRegression as IR
+        if (self.instrumentation is not None):
+            start_time = time.time()
         ir = IR()
-        valid_preacts = valid_preacts.flatten()
-        min_valid_preact = np.min(valid_preacts)
-        max_valid_preact = np.max(valid_preacts)
+        valid_preacts = np.asarray(valid_preacts).flatten()
+        valid_labels = np.asarray(valid_labels).flatten()
         assert len(valid_preacts)==len(valid_labels)
         #sorting to be safe...I think weird results can happen when unsorted
-        sorted_valid_preacts, sorted_valid_labels = zip(
-            *sorted(zip(valid_preacts, valid_labels), key=lambda x: x[0]))
-        y = ir.fit_transform(sorted_valid_preacts, sorted_valid_labels)
-    
-        def calibration_func(preact):
-            preact = np.minimum(preact, max_valid_preact)
-            preact = np.maximum(preact, min_valid_preact)
-            return ir.transform(preact.flatten())
-
-        return calibration_func
+        sorting_order = np.argsort(valid_preacts, kind="mergesort")
+        sorted_valid_preacts = valid_preacts[sorting_order]
+        y = ir.fit_transform(sorted_valid_preacts,
+                             valid_labels[sorting_order])
+
+        #the fit is constant over tied preacts; keep one point per preact
+        #and drop the interior points of each flat stretch
+        x_breakpoints, first_idx = np.unique(sorted_valid_preacts,
+                                             return_index=True)
+        y_breakpoints = y[first_idx]
+        keep = np.ones(len(x_breakpoints), dtype=bool)
+        keep[1:-1] = ((y_breakpoints[1:-1] != y_breakpoints[:-2])
+                      | (y_breakpoints[1:-1] != y_breakpoints[2:]))
+
+        if (self.instrumentation is not None):
+            self.instrumentation.on_event("isotonic_regression.fit",
+                {"num_examples": len(valid_preacts),
+                 "num_breakpoints": int(np.sum(keep)),
+                 "seconds": time.time() - start_time})
+
+        return IsotonicCalibrationFunc(x_breakpoints=x_breakpoints[keep],
+                                       y_breakpoints=y_breakpoints[keep],
+                                       dtype=self.dtype)
+
+
+class BinnedKDE(object):
+
+    """
+        Gaussian kernel density estimate for 1-D data on [lower, upper]
+        (e.g. calibrated probabilities). Fitting linearly bins the data onto
+        a grid of num_grid_points and convolves the bin weights with the
+        kernel using an FFT, so it costs O(n + num_grid_points*log
+        num_grid_points); the density at any point is then interpolated
+        from the grid in O(log num_grid_points). Points outside
+        [lower, upper] get the density at the nearest edge.
+
+        If fit is given a 2-D array, every row is a separate sample with
+        its own density (all rows are binned and convolved at once), and
+        __call__ then takes an array with the same number of rows and
+        evaluates each row under its own density.
+    """
+
+    def __init__(self, bandwidth, num_grid_points=2048,
+                       lower=0.0, upper=1.0):
+        self.bandwidth = bandwidth
+        self.grid = np.linspace(lower, upper, num_grid_points)
+        self.grid_densities = None
+
+    def fit(self, x):
+        x = np.asarray(x, dtype="float64")
+        rows = x if x.ndim == 2 else x.reshape(1,-1)
+        num_rows, num_points = rows.shape
+        num_grid_points = len(self.grid)
+        grid_spacing = self.grid[1] - self.grid[0]
+        #linear binning: split each point between its two grid neighbours;
+        #each row gets its own stretch of num_grid_points bins
+        grid_pos = np.clip((rows - self.grid[0])/grid_spacing,
+                           0, num_grid_points-1)
+        left_idx = np.minimum(np.floor(grid_pos).astype("int64"),
+                              num_grid_points-2)
+        right_weight = (grid_pos - left_idx).ravel()
+        left_idx = (left_idx + num_grid_points*np.arange(
+                        num_rows, dtype="int64")[:,None]).ravel()
+        bin_weights = (np.bincount(left_idx, weights=1-right_weight,
+                                   minlength=num_rows*num_grid_points)
+                       + np.bincount(left_idx+1, weights=right_weight,
+                                     minlength=num_rows*num_grid_points)
+                      ).reshape(num_rows, num_grid_points)
+
+        #kernel at every grid offset, zero-padded for a linear convolution
+        offsets = np.arange(-(num_grid_points-1), num_grid_points)
+        kernel = np.exp(-0.5*np.square(offsets*grid_spacing/self.bandwidth))\
+                 /(self.bandwidth*np.sqrt(2*np.pi))
+        fft_len = 1 << int(np.ceil(np.log2(3*num_grid_points)))
+        convolved = np.fft.irfft(np.fft.rfft(bin_weights, fft_len, axis=1)
+                                 *np.fft.rfft(kernel, fft_len),
+                                 fft_len, axis=1)
+        grid_densities = np.maximum(
+            convolved[:,num_grid_points-1:2*num_grid_points-1], 0)/num_points
+        self.grid_densities = (grid_densities if x.ndim == 2
+                               else grid_densities[0])
+        return self
+
+    def __call__(self, x):
+        #the grid is uniform, so the grid cell of every point is computed
+        #directly rather than searched for
+        x = np.asarray(x, dtype="float64")
+        num_grid_points = len(self.grid)
+        grid_pos = np.clip((x - self.grid[0])/(self.grid[1] - self.grid[0]),
+                           0, num_grid_points-1)
+        left_idx = np.minimum(grid_pos.astype("int64"), num_grid_points-2)
+        right_weight = grid_pos - left_idx
+        if (self.grid_densities.ndim == 2):
+            #one density per row
+            left_idx += num_grid_points*np.arange(
+                            len(x), dtype="int64")[:,None]
+        grid_densities = self.grid_densities.ravel()
+        return (grid_densities[left_idx]*(1-right_weight)
+                + grid_densities[left_idx+1]*right_weight)
 
 
 class ImbalanceAdaptationWrapper(CalibratorFactory):
 
-    def __init__(self, base_calibrator_factory, verbose=True):
+    def __init__(self, base_calibrator_factory, verbose=True,
+                       kde_grid_size=2048, instrumentation=None):
         self.base_calibrator_factory = base_calibrator_factory
         self.verbose = verbose
+        self.kde_grid_size = kde_grid_size
+        self.instrumentation = get_instrumentation(
+            instrumentation=instrumentation, verbose=verbose)
 
     def __call__(self, valid_preacts, valid_labels):
+        if (self.instrumentation is not None):
+            start_time = time.time()
         base_calibration_func = self.base_calibrator_factory(
             valid_preacts=valid_preacts, valid_labels=valid_labels)
         calib_valid_probs = base_calibration_func(valid_preacts) 
         # bandwidth is scotts factor
-        valid_kde = KernelDensity(
-            kernel='gaussian', bandwidth=len(valid_labels)**(-1./(1+4))).fit(
-            list(zip(calib_valid_probs, np.zeros((len(calib_valid_probs))))))
-
-        def calibration_func(preact):
-            calib_probs = base_calibration_func(preact)
-            valid_densities_at_test_pts = np.exp(valid_kde.score_samples(
-                zip(calib_probs, np.zeros((len(calib_probs))))))
-            # bandwidth is scotts factor
-            kde_test = KernelDensity(kernel='gaussian',
-                bandwidth=len(calib_probs)**(-1./(1+4))).fit(
-                list(zip(calib_probs, np.zeros((len(calib_probs))))))
-            test_densities_at_test_pts = np.exp(kde_test.score_samples(
-                zip(calib_probs, np.zeros((len(calib_probs))))))
-            neg_densities_at_test_pts =\
-                valid_densities_at_test_pts*(1-calib_probs)*\
-                len(valid_labels)/(len(valid_labels) - np.sum(valid_labels))
-            pos_densities_at_test_pts =\
-                valid_densities_at_test_pts*calib_probs*(len(valid_labels)\
-                /np.sum(valid_labels))
-
-            def eval_func(x):
-                x = x[0]
-                differences =\
-                    test_densities_at_test_pts-(x*pos_densities_at_test_pts\
-                    +(1-x)*neg_densities_at_test_pts)
-                loss = np.sum(np.square(differences))
-                grad = np.sum(2*(differences)*(neg_densities_at_test_pts\
-                    -pos_densities_at_test_pts))
-                return loss, np.array([grad])
-
-            alpha = scipy.optimize.minimize(fun=eval_func,
-                x0=np.array([0.5]),
-                bounds=[(0,1)],
-                jac=True,
-                method='L-BFGS-B',
-                tol=1e-07,
-                )['x'][0]
-
-            new_calib_test = pos_densities_at_test_pts*alpha / (
-                pos_densities_at_test_pts*alpha + neg_densities_at_test_pts*(1-alpha)
-                )
-
-            return new_calib_test
-
-        return calibration_func
+        valid_kde = BinnedKDE(bandwidth=len(valid_labels)**(-1./(1+4)),
+                              num_grid_points=self.kde_grid_size).fit(
+                              calib_valid_probs)
+        if (self.instrumentation is not None):
+            self.instrumentation.on_event("imbalance_adaptation.fit",
+                {"num_valid": len(valid_labels),
+                 "num_valid_positives": np.sum(valid_labels),
+                 "seconds": time.time() - start_time})
+
+        return ImbalanceAdaptationCalibrationFunc(
+                    base_calibration_func=base_calibration_func,
+                    valid_kde=valid_kde,
+                    num_valid=len(valid_labels),
+                    num_valid_positives=np.sum(valid_labels),
+                    kde_grid_size=self.kde_grid_size)
+
+
+class ImbalanceAdaptationCalibrationFunc(object):
+
+    """
+        The fitted state of an ImbalanceAdaptationWrapper: the base
+        calibration function, the KDE of the calibrated validation
+        probabilities and the validation class counts.
+    """
+
+    def __init__(self, base_calibration_func, valid_kde, num_valid,
+                       num_valid_positives, kde_grid_size=2048):
+        self.base_calibration_func = base_calibration_func
+        self.valid_kde = valid_kde
+        self.num_valid = num_valid
+        self.num_valid_positives = num_valid_positives
+        self.kde_grid_size = kde_grid_size
+
+    def __call__(self, preact):
+        #the test density is fitted per batch, so each row of a (runs, n)
+        #block of dropout preacts gets its own KDE and its own alpha
+        calib_probs = np.asarray(self.base_calibration_func(preact),
+                                 dtype="float64")
+        is_block = (calib_probs.ndim == 2 and calib_probs.shape[1] > 1)
+        batches = calib_probs if is_block else calib_probs.reshape(1,-1)
+        valid_densities_at_test_pts = self.valid_kde(batches)
+        # bandwidth is scotts factor
+        kde_test = BinnedKDE(bandwidth=batches.shape[1]**(-1./(1+4)),
+                             num_grid_points=self.kde_grid_size).fit(
+                             batches)
+        test_densities_at_test_pts = kde_test(batches)
+        neg_densities_at_test_pts =\
+            valid_densities_at_test_pts*(1-batches)*\
+            self.num_valid/(self.num_valid - self.num_valid_positives)
+        pos_densities_at_test_pts =\
+            valid_densities_at_test_pts*batches*(self.num_valid\
+            /self.num_valid_positives)
+
+        #alpha minimizes sum((test - (alpha*pos + (1-alpha)*neg))**2) on
+        #[0,1]; the loss is quadratic in alpha, so the minimizer of each
+        #row is the clipped least-squares solution
+        pos_minus_neg = pos_densities_at_test_pts - neg_densities_at_test_pts
+        test_minus_neg = test_densities_at_test_pts - neg_densities_at_test_pts
+        numerator = np.sum(test_minus_neg*pos_minus_neg, axis=1)
+        denominator = np.sum(np.square(pos_minus_neg), axis=1)
+        alpha = np.clip(numerator/np.where(denominator > 0, denominator, 1),
+                        0, 1)
+        alpha[denominator == 0] = 0.5
+        alpha = alpha[:,None]
+
+        new_calib_test = pos_densities_at_test_pts*alpha / (
+            pos_densities_at_test_pts*alpha + neg_densities_at_test_pts*(1-alpha)
+            )
+        if (not is_block):
+            new_calib_test = new_calib_test.reshape(calib_probs.shape)
+
+        return new_calib_test
+
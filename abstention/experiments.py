@@ -0,0 +1,258 @@
+from __future__ import division, print_function, absolute_import
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from .abstention import AbstentionEval
+from .util import fit_calibrator, apply_calibrator, get_std_over_runs
+
+
+class InMemoryArrays(object):
+
+    def __init__(self, name_to_array):
+        self.name_to_array = name_to_array
+
+    def get_refs(self):
+        return self
+
+    def get_arrays(self):
+        return self.name_to_array
+
+    def close(self):
+        pass
+
+
+class SharedArrays(object):
+
+    """
+        Writes a dict of numpy arrays, once, to .npy files in a temporary
+        directory (under /dev/shm where it exists, i.e. in shared memory)
+        and hands out a small picklable handle, get_refs(), that worker
+        processes turn back into read-only memory maps of the same
+        pages, so the arrays are never copied per task. close() deletes
+        the files; call it once the workers are done.
+    """
+
+    def __init__(self, name_to_array, dir=None):
+        if (dir is None and os.path.isdir("/dev/shm")):
+            dir = "/dev/shm"
+        self.tmp_dir = tempfile.mkdtemp(prefix="abstention_", dir=dir)
+        name_to_path = OrderedDict()
+        for idx, (name, arr) in enumerate(name_to_array.items()):
+            name_to_path[name] = os.path.join(self.tmp_dir,
+                                              "array_"+str(idx)+".npy")
+            np.save(name_to_path[name], np.asarray(arr))
+        self.refs = SharedArrayRefs(name_to_path=name_to_path)
+
+    def get_refs(self):
+        return self.refs
+
+    def close(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class SharedArrayRefs(object):
+
+    def __init__(self, name_to_path):
+        self.name_to_path = name_to_path
+
+    def get_arrays(self):
+        return MappedArrays(name_to_path=self.name_to_path)
+
+
+class MappedArrays(object):
+
+    """
+        Read-only view of the arrays of a SharedArrayRefs that maps each
+        file when it is looked up. Mapping is cheap, so a task maps only
+        the arrays it uses and nothing is cached between tasks: a cache
+        would be shared by the threads of a ThreadPool and would keep the
+        files' memory alive in long-lived workers after close().
+    """
+
+    def __init__(self, name_to_path):
+        self.name_to_path = name_to_path
+
+    def __getitem__(self, name):
+        return np.load(self.name_to_path[name], mmap_mode="r")
+
+    def get(self, name, default=None):
+        return self[name] if name in self.name_to_path else default
+
+
+#abstainers may modify the posteriors in place, so each task works on
+#copies; every worker (process or thread) copies into its own buffers,
+#which are reused by all of its tasks with arrays of the same shape
+worker_buffers = threading.local()
+
+
+def copy_to_worker_buffer(name, arr):
+    name_to_buffer = getattr(worker_buffers, "name_to_buffer", None)
+    if (name_to_buffer is None):
+        name_to_buffer = worker_buffers.name_to_buffer = {}
+    buf = name_to_buffer.get(name)
+    if (buf is None or buf.shape != arr.shape or buf.dtype != arr.dtype):
+        buf = name_to_buffer[name] = np.empty(arr.shape, dtype=arr.dtype)
+    np.copyto(buf, arr)
+    return buf
+
+
+def run_calibration_task(args):
+    arrays, seed, cb_factory, runs_per_batch = args
+    name_to_array = arrays.get_arrays()
+    cb_func = fit_calibrator((cb_factory,
+                              name_to_array[(seed, "valid_preacts")],
+                              name_to_array[(seed, "valid_labels")]))
+    to_return = OrderedDict()
+    for split in ["valid", "test"]:
+        to_return[split+"_posterior"] = apply_calibrator(
+            (cb_func, name_to_array[(seed, split+"_preacts")]))
+        dropout_preacts = name_to_array.get((seed, split+"_dropout_preacts"))
+        if (dropout_preacts is not None):
+            to_return[split+"_uncert"] = get_std_over_runs(
+                (cb_func, dropout_preacts, runs_per_batch))
+    return to_return
+
+
+def run_abstention_task(args):
+    (arrays, seed, cb_method_name, abstainer_name, abstainer_factory,
+     eval_name_to_eval_class, proportions_to_retain) = args
+    name_to_array = arrays.get_arrays()
+    key = (seed, cb_method_name)
+    abstaining_func = abstainer_factory(
+        valid_labels=name_to_array[(seed, "valid_labels")],
+        valid_posterior=copy_to_worker_buffer("valid_posterior",
+                            name_to_array[key+("valid_posterior",)]),
+        valid_uncert=name_to_array.get(key+("valid_uncert",)))
+    test_labels = name_to_array[(seed, "test_labels")]
+    test_posterior = name_to_array[key+("test_posterior",)]
+    abstention_scores = abstaining_func(
+        posterior_probs=copy_to_worker_buffer("test_posterior",
+                                              test_posterior),
+        uncertainties=name_to_array.get(key+("test_uncert",)))
+
+    rows = []
+    for eval_name, eval_class in eval_name_to_eval_class.items():
+        abstention_eval = eval_class(
+            proportion_to_retain=proportions_to_retain[0])
+        if (isinstance(abstention_eval, AbstentionEval)):
+            values = abstention_eval.retention_curve(
+                abstention_scores=abstention_scores,
+                y_true=test_labels, y_score=test_posterior,
+                proportions_to_retain=proportions_to_retain)
+        else:
+            values = [eval_class(proportion_to_retain=proportion_to_retain)(
+                        abstention_scores=abstention_scores,
+                        y_true=test_labels, y_score=test_posterior)
+                      for proportion_to_retain in proportions_to_retain]
+        for proportion_to_retain, value in zip(proportions_to_retain,
+                                               values):
+            rows.append(OrderedDict([
+                ("seed", seed), ("calibrator", cb_method_name),
+                ("abstainer", abstainer_name), ("metric", eval_name),
+                ("proportion_to_retain", proportion_to_retain),
+                ("value", value)]))
+    return rows
+
+
+def run_experiment_grid(seed_to_data, cb_method_name_to_factory,
+                        abstainer_name_to_factory, eval_name_to_eval_class,
+                        proportions_to_retain, runs_per_batch=None,
+                        pool=None, share_inputs=None):
+    """
+        Evaluates every calibrator x abstainer x evaluation x retention
+        level combination on every seed.
+
+        seed_to_data maps a seed (or any other replicate id) to a dict
+        with the arrays "valid_labels", "valid_preacts", "test_labels" and
+        "test_preacts", and optionally "valid_dropout_preacts" and
+        "test_dropout_preacts" of shape (runs, n), from which the
+        uncertainties are estimated as in
+        obtain_posterior_probs_and_uncert_estimates. eval_name_to_eval_class
+        maps a name to e.g. AuRocAbstentionEval: anything that is called
+        as eval_class(proportion_to_retain=...) and returns an evaluation
+        function. All the retention levels of an AbstentionEval are
+        evaluated together.
+
+        The calibrators are fit once per (seed, calibrator), then the
+        abstainers once per (seed, calibrator, abstainer), mapping over
+        `pool` if given. If the pool is a process pool (or share_inputs
+        is True), the input arrays and the calibrated posteriors and
+        uncertainties are placed in shared memory (see SharedArrays), so
+        workers read them without copying; the factories must then be
+        picklable.
+
+        Returns a tidy table: a list of dicts with the keys seed,
+        calibrator, abstainer, metric, proportion_to_retain and value
+        (pandas.DataFrame(rows) turns it into a data frame). See
+        get_method_to_perfs for the input to get_ustats_mat.
+    """
+    if (share_inputs is None):
+        share_inputs = pool is not None and not isinstance(pool, ThreadPool)
+    map_func = pool.map if pool is not None else map
+    make_arrays = SharedArrays if share_inputs else InMemoryArrays
+    seeds = list(seed_to_data.keys())
+    cb_method_names = list(cb_method_name_to_factory.keys())
+
+    input_arrays = make_arrays(OrderedDict(
+        ((seed, array_name), np.asarray(arr))
+        for seed in seeds
+        for array_name, arr in seed_to_data[seed].items()))
+    try:
+        arrays = input_arrays.get_refs()
+        calibration_tasks = [(seed, cb_method_name)
+                             for seed in seeds
+                             for cb_method_name in cb_method_names]
+        calibration_results = list(map_func(run_calibration_task,
+            [(arrays, seed, cb_method_name_to_factory[cb_method_name],
+              runs_per_batch)
+             for seed, cb_method_name in calibration_tasks]))
+    finally:
+        input_arrays.close()
+
+    name_to_array = OrderedDict()
+    for seed in seeds:
+        for array_name in ["valid_labels", "test_labels"]:
+            name_to_array[(seed, array_name)] =\
+                np.asarray(seed_to_data[seed][array_name])
+    for (seed, cb_method_name), result in zip(calibration_tasks,
+                                              calibration_results):
+        for array_name, arr in result.items():
+            name_to_array[(seed, cb_method_name, array_name)] = arr
+    del calibration_results
+    calibrated_arrays = make_arrays(name_to_array)
+    try:
+        arrays = calibrated_arrays.get_refs()
+        all_rows = map_func(run_abstention_task,
+            [(arrays, seed, cb_method_name, abstainer_name,
+              abstainer_factory, eval_name_to_eval_class,
+              list(proportions_to_retain))
+             for seed in seeds
+             for cb_method_name in cb_method_names
+             for abstainer_name, abstainer_factory in
+                 abstainer_name_to_factory.items()])
+        return [row for rows in all_rows for row in rows]
+    finally:
+        calibrated_arrays.close()
+
+
+def get_method_to_perfs(rows, method_field="abstainer", **filters):
+    """
+        Selects the rows of a run_experiment_grid table that match all
+        the filters (e.g. metric="auprc", proportion_to_retain=0.8,
+        calibrator="platt") and returns an OrderedDict of method ->
+        values, one value per seed in the order of the table, as taken
+        by get_ustats_mat. The method is the value of method_field, or a
+        tuple of values if method_field is a list of fields.
+    """
+    method_to_perfs = OrderedDict()
+    for row in rows:
+        if all(row[field] == value for field, value in filters.items()):
+            method = (tuple(row[field] for field in method_field)
+                      if isinstance(method_field, (list, tuple))
+                      else row[method_field])
+            method_to_perfs.setdefault(method, []).append(row["value"])
+    return method_to_perfs
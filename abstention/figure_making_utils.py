@@ -1,34 +1,127 @@
 from __future__ import division, print_function
 import numpy as np
 
-#srs: signed rank sum test
-def wilcox_srs(vals1, vals2):   
-    signed_ranks = ([(1+x[0])*np.sign(x[1]) for x in 
-                     enumerate(sorted(vals1-vals2, key=lambda x: abs(x)))])
-    sum_positives = sum([x for x in signed_ranks if x > 0]+[1e-7])
-    sum_negatives = sum([x for x in signed_ranks if x < 0]+[-1e-7])
+
+def get_sorted_signs(differences):
+    #differences is (num_pairs, num_seeds). Sorting each row by absolute
+    #difference (stably, so tied magnitudes keep their original order)
+    #gives the signs in rank order: the difference with sign
+    #sorted_signs[:,k] has rank k+1. A zero difference still takes up a
+    #rank but counts towards neither sum.
+    differences = np.asarray(differences)
+    sorting_order = np.argsort(np.abs(differences), axis=1, kind="mergesort")
+    return np.sign(differences[np.arange(len(differences))[:,None],
+                               sorting_order])
+
+
+def get_signed_rank_sums(sorted_signs):
+    ranks = np.arange(1, sorted_signs.shape[1]+1)
+    sum_positives = np.sum((sorted_signs > 0)*ranks, axis=1)
+    sum_negatives = np.sum((sorted_signs < 0)*ranks, axis=1)
+    return sum_positives, sum_negatives
+
+
+def srs_from_rank_sums(sum_positives, sum_negatives):
+    sum_positives = sum_positives + 1e-7
+    sum_negatives = sum_negatives + 1e-7
     #0.05 threshold for one-sided test when N=10 is 10:
     #http://www.real-statistics.com/statistics-tables/wilcoxon-signed-ranks-table/
-    if (np.abs(sum_negatives) < sum_positives):
-        return np.abs(sum_negatives)
-    else:
-        return -np.abs(sum_positives)
+    return np.where(sum_negatives < sum_positives,
+                    sum_negatives, -sum_positives)
 
 
-def get_ustats_mat(method_to_perfs, method_names, max_ustat=55):
-    to_return = np.zeros((len(method_names), len(method_names)))
-    for i in range(len(method_names)):
-        for j in range(len(method_names)):
-            if (i!=j):
-                to_return[i,j] = wilcox_srs(
-                            vals1 = method_to_perfs[method_names[i]],
-                            vals2 = method_to_perfs[method_names[j]])
-            else:
-                to_return[i,j] = max_ustat
+#srs: signed rank sum test
+def wilcox_srs(vals1, vals2):   
+    sum_positives, sum_negatives = get_signed_rank_sums(
+        get_sorted_signs((np.asarray(vals1)-np.asarray(vals2))[None,:]))
+    return srs_from_rank_sums(sum_positives, sum_negatives)[0]
+
 
+def get_pairwise_sorted_signs(perfs):
+    #signs in rank order for every pair i < j of rows of the
+    #(num_methods, num_seeds) perfs array
+    perfs = np.asarray(perfs, dtype="float64")
+    pair_i, pair_j = np.triu_indices(len(perfs), k=1)
+    return pair_i, pair_j, get_sorted_signs(perfs[pair_i] - perfs[pair_j])
+
+
+def get_srs_mat(perfs, max_ustat=55):
+    """
+        Signed rank sum statistic of every ordered pair of rows of the
+        (num_methods, num_seeds) perfs array, as returned by wilcox_srs,
+        computed from one ranking per unordered pair: swapping the two
+        methods swaps the positive and negative rank sums.
+    """
+    pair_i, pair_j, sorted_signs = get_pairwise_sorted_signs(perfs)
+    sum_positives, sum_negatives = get_signed_rank_sums(sorted_signs)
+    to_return = np.full((len(perfs), len(perfs)), float(max_ustat))
+    to_return[pair_i, pair_j] = srs_from_rank_sums(sum_positives,
+                                                   sum_negatives)
+    to_return[pair_j, pair_i] = srs_from_rank_sums(sum_negatives,
+                                                   sum_positives)
     return to_return
 
 
+def get_srs_pvalue_mat(perfs, mode="exact", num_permutations=10000,
+                             seed=1234):
+    """
+        Two-sided p-values of the signed rank test for every pair of rows
+        of the (num_methods, num_seeds) perfs array, as a symmetric matrix
+        (1 on the diagonal). The statistic is min(sum_positives,
+        sum_negatives). With mode="exact" its null distribution (each
+        nonzero difference's sign equally likely to be + or -) is
+        computed for all pairs at once by dynamic programming over the
+        ranks, which takes O(num_pairs*num_seeds**3) time. With
+        mode="permutation", num_permutations random sign flips, shared
+        across pairs, are evaluated with one matrix product.
+    """
+    pair_i, pair_j, sorted_signs = get_pairwise_sorted_signs(perfs)
+    sum_positives, sum_negatives = get_signed_rank_sums(sorted_signs)
+    observed = np.minimum(sum_positives, sum_negatives)
+    num_pairs, num_seeds = sorted_signs.shape
+    ranks = np.arange(1, num_seeds+1)
+
+    if (mode == "exact"):
+        max_sum = num_seeds*(num_seeds+1)//2
+        #null distribution of sum_positives for every pair
+        sum_probs = np.zeros((num_pairs, max_sum+1))
+        sum_probs[:,0] = 1.0
+        for rank in ranks:
+            has_sign = (sorted_signs[:,rank-1] != 0)
+            shifted = np.zeros(sum_probs.shape)
+            shifted[:,rank:] = sum_probs[:,:-rank]
+            sum_probs[has_sign] = 0.5*(sum_probs[has_sign]
+                                       + shifted[has_sign])
+        #the null distribution is symmetric, so P(min <= observed)
+        #is at most twice P(sum_positives <= observed)
+        pvals = np.minimum(1.0, 2*np.cumsum(sum_probs, axis=1)[
+                                    np.arange(num_pairs), observed])
+    elif (mode == "permutation"):
+        signed_ranks = (sorted_signs != 0)*ranks
+        total_ranks = np.sum(signed_ranks, axis=1)
+        flips = np.random.RandomState(seed).randint(
+                    2, size=(num_permutations, num_seeds))
+        permuted_sum_positives = np.dot(flips, signed_ranks.T)
+        permuted_stats = np.minimum(permuted_sum_positives,
+                                    total_ranks[None,:]
+                                    - permuted_sum_positives)
+        pvals = (1.0 + np.sum(permuted_stats <= observed[None,:], axis=0))\
+                /(1.0 + num_permutations)
+    else:
+        raise ValueError("Unsupported mode: "+str(mode))
+
+    to_return = np.ones((len(perfs), len(perfs)))
+    to_return[pair_i, pair_j] = pvals
+    to_return[pair_j, pair_i] = pvals
+    return to_return
+
+
+def get_ustats_mat(method_to_perfs, method_names, max_ustat=55):
+    return get_srs_mat(perfs=[method_to_perfs[method_name]
+                              for method_name in method_names],
+                       max_ustat=max_ustat)
+
+
 def get_tied_top_and_worst_methods(ustats_mat, method_names, threshold=11):
     sorted_methods_and_ustats = sorted(
         zip(method_names, ustats_mat),
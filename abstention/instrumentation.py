@@ -0,0 +1,84 @@
+from __future__ import division, print_function, absolute_import
+import logging
+import sys
+
+
+class Instrumentation(object):
+
+    """
+        Receives structured events from the abstainers and calibrators
+        as on_event(stage, fields). stage is a name like
+        "recursive_eviction.progress" and fields is a dict, e.g. the wall
+        time in seconds, item counts, estimated vs. validation metrics or
+        optimizer iterations. Components take an instrumentation
+        argument; if it is None and verbose is False, no event is built
+        at all, so disabled instrumentation costs nothing.
+    """
+
+    def on_event(self, stage, fields):
+        raise NotImplementedError()
+
+
+class PrintInstrumentation(Instrumentation):
+
+    """
+        Prints every event to stdout; this is what verbose=True means.
+    """
+
+    def __init__(self, flush=True):
+        self.flush = flush
+
+    def on_event(self, stage, fields):
+        print(stage+":", ", ".join(str(key)+"="+str(fields[key])
+                                   for key in sorted(fields.keys())))
+        if (self.flush):
+            sys.stdout.flush()
+
+
+class CallbackInstrumentation(Instrumentation):
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def on_event(self, stage, fields):
+        self.callback(stage, fields)
+
+
+class LoggingInstrumentation(Instrumentation):
+
+    """
+        Logs every event to a logging.Logger; the stage and fields are
+        also attached to the log record as record.stage and
+        record.fields, for handlers that forward them elsewhere.
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = (logger if logger is not None
+                       else logging.getLogger("abstention"))
+        self.level = level
+
+    def on_event(self, stage, fields):
+        if (self.logger.isEnabledFor(self.level)):
+            self.logger.log(self.level, "%s: %s", stage, fields,
+                            extra={"stage": stage, "fields": fields})
+
+
+class RecordingInstrumentation(Instrumentation):
+
+    """
+        Keeps every (stage, fields) event in self.events.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def on_event(self, stage, fields):
+        self.events.append((stage, fields))
+
+
+def get_instrumentation(instrumentation, verbose):
+    #an explicit instrumentation object wins; otherwise verbose keeps
+    #the console output, and None means no events are generated at all
+    if (instrumentation is not None):
+        return instrumentation
+    return PrintInstrumentation() if verbose else None
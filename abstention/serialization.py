@@ -0,0 +1,89 @@
+from __future__ import division, print_function, absolute_import
+import os
+import pickle
+import numpy as np
+
+
+OBJECTS_FILE = "objects.pkl"
+ARRAYS_DIR = "arrays"
+
+
+class ArrayExtractingPickler(pickle.Pickler):
+
+    """
+        Pickles an object graph, but writes every numeric numpy array of
+        at least min_array_nbytes bytes to its own .npy file in
+        arrays_dir and only records the file name in the pickle.
+    """
+
+    def __init__(self, file, arrays_dir, min_array_nbytes,
+                       protocol=pickle.HIGHEST_PROTOCOL):
+        pickle.Pickler.__init__(self, file, protocol)
+        self.arrays_dir = arrays_dir
+        self.min_array_nbytes = min_array_nbytes
+        #id(array) -> file name, so an array shared by several fitted
+        #objects is only written once; the arrays are kept referenced so
+        #that their ids cannot be reused while pickling
+        self.saved_arrays = {}
+        self.kept_alive = []
+
+    def persistent_id(self, obj):
+        if (isinstance(obj, np.ndarray) and obj.dtype.kind in "biufc"
+            and obj.nbytes >= self.min_array_nbytes):
+            if (id(obj) not in self.saved_arrays):
+                file_name = "array_"+str(len(self.saved_arrays))+".npy"
+                np.save(os.path.join(self.arrays_dir, file_name),
+                        np.asarray(obj))
+                self.saved_arrays[id(obj)] = file_name
+                self.kept_alive.append(obj)
+            return ("npy", self.saved_arrays[id(obj)])
+        return None
+
+
+class ArrayLoadingUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, arrays_dir, mmap_mode):
+        pickle.Unpickler.__init__(self, file)
+        self.arrays_dir = arrays_dir
+        self.mmap_mode = mmap_mode
+        self.loaded_arrays = {}
+
+    def persistent_load(self, pid):
+        kind, file_name = pid
+        assert kind == "npy", "unknown persistent id "+str(pid)
+        if (file_name not in self.loaded_arrays):
+            self.loaded_arrays[file_name] = np.load(
+                os.path.join(self.arrays_dir, file_name),
+                mmap_mode=self.mmap_mode)
+        return self.loaded_arrays[file_name]
+
+
+def save(obj, path, min_array_nbytes=4096):
+    """
+        Saves a fitted abstaining or calibration function (or any
+        picklable object, e.g. a dict of them) to the directory `path`.
+        The object graph goes to objects.pkl; numpy arrays of at least
+        min_array_nbytes bytes (validation cdfs, isotonic breakpoints,
+        KDE grids, ...) are stored as separate .npy files, so that load
+        can memory-map them instead of reading them in.
+    """
+    arrays_dir = os.path.join(path, ARRAYS_DIR)
+    if (not os.path.isdir(arrays_dir)):
+        os.makedirs(arrays_dir)
+    with open(os.path.join(path, OBJECTS_FILE), "wb") as f:
+        ArrayExtractingPickler(file=f, arrays_dir=arrays_dir,
+                               min_array_nbytes=min_array_nbytes).dump(obj)
+
+
+def load(path, mmap_mode="r"):
+    """
+        Loads an object written by save. With the default mmap_mode="r"
+        the large arrays are read-only memory maps, so loading costs
+        about the same whatever their size, and worker processes that
+        load the same directory share the pages through the OS cache.
+        Use mmap_mode=None to read the arrays into memory instead.
+    """
+    with open(os.path.join(path, OBJECTS_FILE), "rb") as f:
+        return ArrayLoadingUnpickler(
+                    file=f, arrays_dir=os.path.join(path, ARRAYS_DIR),
+                    mmap_mode=mmap_mode).load()
@@ -1,77 +1,473 @@
 from __future__ import division, print_function, absolute_import
-from keras import backend as K
+import os
+import time
 import numpy as np
 from collections import OrderedDict
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from .instrumentation import get_instrumentation
 
 
-def get_preact_func(model, task_idx):
+def prefetch_batches(data, batch_size, num_to_prefetch=2):
+    """
+        Yields (start_idx, data[start_idx:start_idx+batch_size]) for
+        successive batches. The slicing (which for a memmap or h5py
+        dataset means reading from disk) happens in a background thread,
+        up to num_to_prefetch batches ahead, so it overlaps with whatever
+        the consumer does with the previous batch.
+    """
+    batch_queue = queue.Queue(maxsize=num_to_prefetch)
+    stop = threading.Event()
+
+    def produce_batches():
+        try:
+            for start_idx in range(0, len(data), batch_size):
+                if (stop.is_set()):
+                    return
+                batch_queue.put(
+                    (start_idx,
+                     np.asarray(data[start_idx:start_idx+batch_size])))
+        except Exception as e:
+            batch_queue.put(e)
+            return
+        batch_queue.put(None)
+
+    producer = threading.Thread(target=produce_batches)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = batch_queue.get()
+            if (item is None):
+                return
+            if (isinstance(item, Exception)):
+                raise item
+            yield item
+    finally:
+        #if the consumer stopped early, unblock the producer so it exits
+        stop.set()
+        while producer.is_alive():
+            try:
+                batch_queue.get_nowait()
+            except queue.Empty:
+                pass
+            producer.join(0.01)
+
+
+def get_preact_func(model, task_idx=None):
+    """
+        Returns batched_func(data, learning_phase, batch_size,
+        prefetch=True), which runs the model over data in batches and
+        returns the preactivations of the penultimate layer, for column
+        task_idx (an int or a list of ints) or for all columns if
+        task_idx is None, so several tasks cost a single pass over the
+        network. See get_batched_preact_func.
+    """
+    #keras is only needed here, so importing this module doesn't load it
+    from keras import backend as K
     preact_func = K.function([model.layers[0].input, K.learning_phase()],
                                    [model.layers[-2].output])
-    def batched_func(data, learning_phase, batch_size):
-        to_return = []
-        start_idx = 0
-        while start_idx < len(data):
-            to_return.extend(
-                preact_func([data[start_idx:start_idx+batch_size],
-                            learning_phase])[0][:, task_idx])
-            start_idx += batch_size
-        return np.array(to_return)
+    return get_batched_preact_func(preact_func=preact_func,
+                                   task_idx=task_idx)
+
+
+def get_batched_preact_func(preact_func, task_idx=None):
+    """
+        Wraps preact_func([batch, learning_phase]), which returns a
+        one-element list with the (batch, columns) preactivations (as a
+        keras backend function does), into batched_func(data,
+        learning_phase, batch_size, prefetch=True). Results are written
+        into a preallocated array, and with prefetch the next batch is
+        sliced in a background thread while preact_func runs on the
+        current one.
+    """
+    def batched_func(data, learning_phase, batch_size, prefetch=True):
+        if (prefetch):
+            batches = prefetch_batches(data=data, batch_size=batch_size)
+        else:
+            batches = ((start_idx, data[start_idx:start_idx+batch_size])
+                       for start_idx in range(0, len(data), batch_size))
+        to_return = None
+        for start_idx, batch in batches:
+            batch_preacts = preact_func([batch, learning_phase])[0]
+            if (task_idx is not None):
+                batch_preacts = batch_preacts[:, task_idx]
+            if (to_return is None):
+                to_return = np.empty(
+                    (len(data),)+batch_preacts.shape[1:],
+                    dtype=batch_preacts.dtype)
+            to_return[start_idx:start_idx+len(batch_preacts)] =\
+                batch_preacts
+        if (to_return is None):
+            return np.zeros((0,))
+        return to_return
     return batched_func
 
 
-def obtain_raw_data(preact_func, data, num_dropout_runs, batch_size=50):
-    print("Computing deterministic activations")
+class WelfordAccumulator(object):
+
+    """
+        Running elementwise mean and variance over a stream of equal-shape
+        arrays (e.g. one array of per-example values per dropout run),
+        using Welford's update. Memory is that of two arrays, however many
+        arrays are streamed through it.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.sum_squared_deviations = None
+
+    def update(self, x):
+        x = np.asarray(x, dtype="float64")
+        if (self.mean is None):
+            self.mean = np.zeros(x.shape)
+            self.sum_squared_deviations = np.zeros(x.shape)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta/self.count
+        self.sum_squared_deviations += delta*(x - self.mean)
+
+    def update_batch(self, xs):
+        #folds in a whole stack of arrays (along the first axis) at once,
+        #using Chan et al.'s rule for merging two sets of moments
+        xs = np.asarray(xs, dtype="float64")
+        batch_count = len(xs)
+        if (batch_count == 0):
+            return
+        batch_mean = np.mean(xs, axis=0)
+        batch_sum_squared_deviations = np.sum(
+            np.square(xs - batch_mean[None]), axis=0)
+        if (self.mean is None):
+            self.count = batch_count
+            self.mean = batch_mean
+            self.sum_squared_deviations = batch_sum_squared_deviations
+            return
+        total_count = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta*(batch_count/total_count)
+        self.sum_squared_deviations += (batch_sum_squared_deviations
+            + np.square(delta)*(self.count*batch_count/total_count))
+        self.count = total_count
+
+    def get_mean(self):
+        return self.mean
+
+    def get_var(self, ddof=1):
+        return self.sum_squared_deviations/(self.count - ddof)
+
+    def get_std(self, ddof=1):
+        return np.sqrt(self.get_var(ddof=ddof))
+
+
+def get_float_dtype(arr, dtype=None):
+    #the dtype policy: results are computed in dtype if it is given, else
+    #in the dtype of arr if that is floating (so float32 inputs stay
+    #float32), else in float64. Sums and cumsums over the examples are
+    #accumulated in float64 whatever the dtype
+    if (dtype is not None):
+        return np.dtype(dtype)
+    arr_dtype = np.asarray(arr).dtype
+    return (arr_dtype if np.issubdtype(arr_dtype, np.floating)
+            else np.dtype("float64"))
+
+
+def external_argsort(values, chunk_size, tmp_dir):
+    """
+        Stable argsort of a 1-D array that need not fit in memory (e.g. a
+        memory-mapped .npy file), holding about chunk_size values in
+        memory at a time. Each chunk is sorted into a run on disk. The
+        runs are then merged in one pass: a regular sample of the runs
+        gives splitters that cut the sorted order into buckets of at
+        most chunk_size values, the bounds of every bucket in every run
+        are found with np.searchsorted, and each bucket is sorted on its
+        own. The sample holds about 2*num_runs**2 values, so memory
+        stays O(chunk_size) as long as chunk_size**2 is at least about
+        2*len(values). Returns (sorted_values, sorted_indices) as float64
+        and int64 memmaps in tmp_dir, equal to
+        values[np.argsort(values, kind="mergesort")] and that argsort.
+    """
+    num_values = len(values)
+
+    def open_memmap(name, dtype):
+        return np.lib.format.open_memmap(os.path.join(tmp_dir, name+".npy"),
+                                         mode="w+", dtype=dtype,
+                                         shape=(num_values,))
+
+    run_values = open_memmap("run_values", "float64")
+    run_indices = open_memmap("run_indices", "int64")
+    run_bounds = []
+    for start in range(0, num_values, chunk_size):
+        chunk = np.asarray(values[start:start+chunk_size], dtype="float64")
+        order = np.argsort(chunk, kind="mergesort")
+        run_values[start:start+len(chunk)] = chunk[order]
+        run_indices[start:start+len(chunk)] = order + start
+        run_bounds.append((start, start+len(chunk)))
+    if (len(run_bounds) <= 1):
+        return run_values, run_indices
+
+    #the order of the runs on disk is the order of their indices, so ties
+    #are broken by position: a splitter is a (value, position) pair
+    num_runs = len(run_bounds)
+    sample_step = max(chunk_size//(2*num_runs), 1)
+    sample_positions = np.concatenate(
+        [np.arange(start, end, sample_step) for start, end in run_bounds])
+    sample_values = np.asarray(run_values[sample_positions])
+    sample_order = np.lexsort((sample_positions, sample_values))
+    #every bucket then holds at most splitter_step*sample_step values
+    #plus fewer than sample_step values from each run
+    splitter_step = max(chunk_size//(2*sample_step), 1)
+    splitters = sample_order[splitter_step::splitter_step]
+    splitter_values = sample_values[splitters]
+    splitter_positions = sample_positions[splitters]
+
+    #bucket_bounds[r, b] is where bucket b starts in run r: values equal
+    #to a splitter go before it in earlier runs and after it in later ones
+    bucket_bounds = np.zeros((num_runs, len(splitters)+2), dtype="int64")
+    for run_idx, (start, end) in enumerate(run_bounds):
+        run = run_values[start:end]
+        bucket_bounds[run_idx, 1:-1] = start + np.where(
+            splitter_positions >= end,
+            np.searchsorted(run, splitter_values, side="right"),
+            np.searchsorted(run, splitter_values, side="left"))
+        in_run = (splitter_positions >= start)&(splitter_positions < end)
+        bucket_bounds[run_idx, 1:-1][in_run] = splitter_positions[in_run]
+        bucket_bounds[run_idx, 0] = start
+        bucket_bounds[run_idx, -1] = end
+
+    sorted_values = open_memmap("sorted_values", "float64")
+    sorted_indices = open_memmap("sorted_indices", "int64")
+    num_written = 0
+    for bucket_idx in range(len(splitters)+1):
+        bucket_starts = bucket_bounds[:, bucket_idx]
+        bucket_ends = bucket_bounds[:, bucket_idx+1]
+        #concatenated in run order, so a stable sort keeps ties in order
+        #of index
+        bucket_values = np.concatenate(
+            [run_values[start:end]
+             for start, end in zip(bucket_starts, bucket_ends)])
+        bucket_indices = np.concatenate(
+            [run_indices[start:end]
+             for start, end in zip(bucket_starts, bucket_ends)])
+        order = np.argsort(bucket_values, kind="mergesort")
+        sorted_values[num_written:num_written+len(order)] =\
+            bucket_values[order]
+        sorted_indices[num_written:num_written+len(order)] =\
+            bucket_indices[order]
+        num_written += len(order)
+    del run_values, run_indices
+    os.remove(os.path.join(tmp_dir, "run_values.npy"))
+    os.remove(os.path.join(tmp_dir, "run_indices.npy"))
+    return sorted_values, sorted_indices
+
+
+def identity(x):
+    return x
+
+
+def get_uncert_transform_funcs(cb_method_name_to_cb_func):
+    #the transformations to apply to the preactivations for uncertainty
+    #estimation: the raw preactivations plus every calibration method
+    uncert_transform_funcs = OrderedDict()
+    uncert_transform_funcs['preactivation'] = identity
+    uncert_transform_funcs.update(cb_method_name_to_cb_func) 
+    return uncert_transform_funcs
+
+
+def obtain_raw_data(preact_func, data, num_dropout_runs, batch_size=50,
+                    uncert_transform_funcs=None,
+                    cb_method_name_to_factory=None, labels=None, pool=None,
+                    verbose=True, instrumentation=None):
+    """
+        By default returns the deterministic preactivations and a
+        (num_dropout_runs, n) array of the dropout preactivations.
+
+        If uncert_transform_funcs (an OrderedDict of name -> function, as
+        made by get_uncert_transform_funcs) is given, the dropout runs are
+        not kept: each run is passed through every transform as soon as it
+        is computed and folded into one WelfordAccumulator per transform.
+        The second return value is then an OrderedDict of name ->
+        WelfordAccumulator (use get_std() for the uncertainty estimate),
+        so memory is O(n*transforms) rather than O(n*runs).
+
+        The calibrators are usually fit on the deterministic
+        preactivations of the same (validation) data, so instead of
+        uncert_transform_funcs, cb_method_name_to_factory and the labels
+        of data can be given: the calibrators are then fit (mapping over
+        pool if given) between the deterministic and the dropout passes,
+        the transforms are get_uncert_transform_funcs of the fitted
+        calibrators, and an OrderedDict of the fitted calibration
+        functions is returned as a third value, e.g. to pass as
+        uncert_transform_funcs for the test data.
+
+        Progress is reported through instrumentation (printed if verbose
+        and no instrumentation is given) as "raw_data.deterministic"
+        and, every 10 dropout runs, "raw_data.dropout_progress" events.
+    """
+    instrumentation = get_instrumentation(
+        instrumentation=instrumentation, verbose=verbose)
+    if (instrumentation is not None):
+        start_time = time.time()
     deterministic_preacts = np.array(
         preact_func(data=data, learning_phase=0,
                     batch_size=batch_size))
-    
-    print("Computing nondeterministic activations")
+    if (instrumentation is not None):
+        instrumentation.on_event("raw_data.deterministic",
+            {"num_examples": len(deterministic_preacts),
+             "seconds": time.time() - start_time})
+
+    if (cb_method_name_to_factory is not None):
+        assert uncert_transform_funcs is None,\
+            "give either uncert_transform_funcs or cb_method_name_to_factory"
+        cb_method_name_to_cb_func = fit_calibrators(
+            cb_method_name_to_factory=cb_method_name_to_factory,
+            valid_preacts=deterministic_preacts, valid_labels=labels,
+            pool=pool)
+        uncert_transform_funcs = get_uncert_transform_funcs(
+                                    cb_method_name_to_cb_func)
+
     dropout_run_results = []
+    if (uncert_transform_funcs is not None):
+        transform_name_to_accumulator = OrderedDict(
+            [(transform_name, WelfordAccumulator())
+             for transform_name in uncert_transform_funcs])
     for i in range(num_dropout_runs):
-        if ((i+1)%10==0):
-            print("Done",i+1,"runs")
-        dropout_run_results.append(
-            np.array(preact_func(data=data, learning_phase=1,
-                                 batch_size=batch_size)).squeeze())
+        dropout_preacts = np.array(
+            preact_func(data=data, learning_phase=1,
+                        batch_size=batch_size)).squeeze()
+        if (uncert_transform_funcs is None):
+            dropout_run_results.append(dropout_preacts)
+        else:
+            for transform_name, transform_func in\
+                uncert_transform_funcs.items():
+                transform_name_to_accumulator[transform_name].update(
+                    transform_func(dropout_preacts))
+        if (instrumentation is not None and
+            ((i+1)%10==0 or i+1==num_dropout_runs)):
+            instrumentation.on_event("raw_data.dropout_progress",
+                {"num_runs_done": i+1,
+                 "num_dropout_runs": num_dropout_runs,
+                 "seconds": time.time() - start_time})
+    if (cb_method_name_to_factory is not None):
+        return (deterministic_preacts, transform_name_to_accumulator,
+                cb_method_name_to_cb_func)
+    if (uncert_transform_funcs is not None):
+        return deterministic_preacts, transform_name_to_accumulator
     return deterministic_preacts, np.array(dropout_run_results)
 
 
+def fit_calibrator(args):
+    cb_factory, valid_preacts, valid_labels = args
+    return cb_factory(valid_preacts=valid_preacts,
+                      valid_labels=valid_labels)
+
+
+def fit_calibrators(cb_method_name_to_factory, valid_preacts,
+                    valid_labels, pool=None):
+    map_func = pool.map if pool is not None else map
+    cb_method_names = list(cb_method_name_to_factory.keys())
+    return OrderedDict(zip(cb_method_names,
+        map_func(fit_calibrator,
+                 [(cb_method_name_to_factory[cb_method_name],
+                   valid_preacts, valid_labels)
+                  for cb_method_name in cb_method_names])))
+
+
+def apply_calibrator(args):
+    cb_func, preacts = args
+    return cb_func(preacts)
+
+
+def get_std_over_runs(args):
+    transform_func, dropout_preacts, runs_per_batch = args
+    if (runs_per_batch is None):
+        runs_per_batch = len(dropout_preacts)
+    accumulator = WelfordAccumulator()
+    for start_idx in range(0, len(dropout_preacts), runs_per_batch):
+        accumulator.update_batch(transform_func(
+            dropout_preacts[start_idx:start_idx+runs_per_batch]))
+    return accumulator.get_std(ddof=1)
+
+
 def obtain_posterior_probs_and_uncert_estimates(
     cb_method_name_to_factory,
     valid_labels,
-    valid_preacts, valid_dropout_preacts,
-    test_preacts, test_dropout_preacts):
+    valid_preacts=None, valid_dropout_preacts=None,
+    test_preacts=None, test_dropout_preacts=None,
+    runs_per_batch=None, pool=None,
+    preact_func=None, valid_data=None, test_data=None,
+    num_dropout_runs=None, batch_size=50,
+    verbose=True, instrumentation=None):
+    """
+        The calibration functions are applied to runs_per_batch dropout
+        runs per call (all of them by default), as a (runs, n) block.
+        The independent pieces of work - fitting each calibrator, then
+        each (transform, valid/test split) pair - are mapped over `pool`
+        if given (e.g. a ThreadPool, or a multiprocessing.Pool if the
+        factories and calibration functions are picklable).
 
-    cb_method_name_to_cb_func = OrderedDict()
-    for cb_method_name, cb_factory in cb_method_name_to_factory.items():
-        cb_method_name_to_cb_func[cb_method_name] =\
-            cb_factory(valid_preacts=valid_preacts,
-                      valid_labels=valid_labels)
+        In streaming mode, preact_func, valid_data, test_data and
+        num_dropout_runs are given instead of the preactivations: the
+        data are run through obtain_raw_data, which fits the calibrators
+        on the deterministic validation preactivations and folds every
+        dropout run into the uncertainty accumulators as it finishes, so
+        the (runs, n) dropout arrays are never materialized; verbose and
+        instrumentation are passed on to it.
+    """
+    map_func = pool.map if pool is not None else map
+
+    if (preact_func is not None):
+        valid_preacts, valid_accumulators, cb_method_name_to_cb_func =\
+            obtain_raw_data(preact_func=preact_func, data=valid_data,
+                num_dropout_runs=num_dropout_runs, batch_size=batch_size,
+                cb_method_name_to_factory=cb_method_name_to_factory,
+                labels=valid_labels, pool=pool,
+                verbose=verbose, instrumentation=instrumentation)
+        test_preacts, test_accumulators = obtain_raw_data(
+            preact_func=preact_func, data=test_data,
+            num_dropout_runs=num_dropout_runs, batch_size=batch_size,
+            uncert_transform_funcs=get_uncert_transform_funcs(
+                                    cb_method_name_to_cb_func),
+            verbose=verbose, instrumentation=instrumentation)
+        transform_name_to_valid_uncert = OrderedDict(
+            (transform_name, accumulator.get_std(ddof=1))
+            for transform_name, accumulator in valid_accumulators.items())
+        transform_name_to_test_uncert = OrderedDict(
+            (transform_name, accumulator.get_std(ddof=1))
+            for transform_name, accumulator in test_accumulators.items())
+    else:
+        cb_method_name_to_cb_func = fit_calibrators(
+            cb_method_name_to_factory=cb_method_name_to_factory,
+            valid_preacts=valid_preacts, valid_labels=valid_labels,
+            pool=pool)
+        uncert_transform_funcs = get_uncert_transform_funcs(
+                                    cb_method_name_to_cb_func)
+        #apply them to validation and test set to
+        #get different uncertainty estimates
+        transform_names = list(uncert_transform_funcs.keys())
+        uncerts = list(map_func(get_std_over_runs,
+            [(transform_func, dropout_preacts, runs_per_batch)
+             for transform_func in uncert_transform_funcs.values()
+             for dropout_preacts in [valid_dropout_preacts,
+                                     test_dropout_preacts]]))
+        transform_name_to_valid_uncert = OrderedDict(
+            zip(transform_names, uncerts[0::2]))
+        transform_name_to_test_uncert = OrderedDict(
+            zip(transform_names, uncerts[1::2]))
     
     #get all the types of posterior probabilities
-    cb_method_name_to_valid_posterior_prob = OrderedDict()
-    cb_method_name_to_test_posterior_prob = OrderedDict()
-    for cb_method_name, cb_func in cb_method_name_to_cb_func.items():
-        cb_method_name_to_valid_posterior_prob[cb_method_name] =\
-            cb_func(valid_preacts)
-        cb_method_name_to_test_posterior_prob[cb_method_name] =\
-            cb_func(test_preacts)
-    
-    #get all the types of transformations to apply to the
-    #preactivations for uncertainty estimation
-    uncert_transform_funcs = OrderedDict()
-    uncert_transform_funcs['preactivation'] = lambda x: x
-    #add all the calibration methods too
-    uncert_transform_funcs.update(cb_method_name_to_cb_func) 
-    #apply them to validation and test set to
-    #get different uncertainty estimates
-    transform_name_to_valid_uncert = OrderedDict()
-    transform_name_to_test_uncert = OrderedDict()
-    for transform_name, transform_func in uncert_transform_funcs.items():
-        transform_name_to_valid_uncert[transform_name] =\
-            np.std(np.array([transform_func(x) for x in valid_dropout_preacts]), axis=0, ddof=1)
-        transform_name_to_test_uncert[transform_name] =\
-            np.std(np.array([transform_func(x) for x in test_dropout_preacts]), axis=0, ddof=1) 
+    cb_method_names = list(cb_method_name_to_cb_func.keys())
+    posterior_probs = list(map_func(apply_calibrator,
+        [(cb_func, preacts)
+         for cb_func in cb_method_name_to_cb_func.values()
+         for preacts in [valid_preacts, test_preacts]]))
+    cb_method_name_to_valid_posterior_prob = OrderedDict(
+        zip(cb_method_names, posterior_probs[0::2]))
+    cb_method_name_to_test_posterior_prob = OrderedDict(
+        zip(cb_method_names, posterior_probs[1::2]))
 
     return (cb_method_name_to_valid_posterior_prob,
             cb_method_name_to_test_posterior_prob,
@@ -0,0 +1,339 @@
+"""
+    Times and memory-profiles the abstainers, calibrators and evaluation
+    helpers on synthetic data, writing one JSON record per line:
+
+        python benchmarks/run_benchmarks.py --output before.jsonl
+        python benchmarks/run_benchmarks.py --output after.jsonl \
+            --compare before.jsonl
+
+    Each record has the benchmark name, the number of examples (n) and
+    tasks, the best wall-clock time over --repeats runs and the peak
+    memory allocated during a run (via tracemalloc, Python 3 only), or a
+    "skipped" reason when the case is too big. --compare prints the
+    time/memory ratios against an earlier output file and exits with
+    status 1 if any time ratio exceeds --regression-threshold.
+"""
+from __future__ import division, print_function, absolute_import
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                                   __file__))))
+from abstention import abstention, calibration
+
+
+class SyntheticData(object):
+
+    """
+        Binary labels drawn from beta-distributed posteriors (which are
+        therefore calibrated), for a validation and a test set of n
+        examples and num_tasks tasks, plus the matching logits and
+        MC-dropout-style uncertainties. 1-D arrays when num_tasks is 1.
+    """
+
+    def __init__(self, n, num_tasks, seed=1234):
+        rng = np.random.RandomState(seed)
+        shape = (n,) if num_tasks == 1 else (n, num_tasks)
+        self.valid_posterior = np.clip(rng.beta(0.5, 2, size=shape),
+                                       1e-6, 1-1e-6)
+        self.valid_labels = 1.0*(rng.uniform(size=shape)
+                                 < self.valid_posterior)
+        self.test_posterior = np.clip(rng.beta(0.5, 2, size=shape),
+                                      1e-6, 1-1e-6)
+        self.test_labels = 1.0*(rng.uniform(size=shape)
+                                < self.test_posterior)
+        self.valid_preacts = np.log(self.valid_posterior
+                                    /(1-self.valid_posterior))
+        self.test_preacts = np.log(self.test_posterior
+                                   /(1-self.test_posterior))
+        self.valid_uncert = rng.uniform(size=shape)
+        self.test_uncert = rng.uniform(size=shape)
+        self.abstention_scores = rng.uniform(size=n)
+
+
+class Benchmark(object):
+
+    """
+        run_func(data) is what gets timed. Cases with multi_task=False are
+        only run for a single task; max_size caps n for cases whose cost
+        grows faster than n*log(n).
+    """
+
+    def __init__(self, name, run_func, multi_task=False, max_size=None):
+        self.name = name
+        self.run_func = run_func
+        self.multi_task = multi_task
+        self.max_size = max_size
+
+
+def as_task_columns(arr):
+    return arr.reshape(len(arr), -1)
+
+
+def fit_and_apply_abstainer(factory, needs_columns=False):
+    #needs_columns: factory wants (n, num_tasks) inputs even for one task
+    def run_func(data):
+        transform = as_task_columns if needs_columns else (lambda x: x)
+        factory(valid_labels=transform(data.valid_labels),
+                valid_posterior=transform(data.valid_posterior),
+                valid_uncert=transform(data.valid_uncert))(
+                    posterior_probs=transform(data.test_posterior),
+                    uncertainties=transform(data.test_uncert))
+    return run_func
+
+
+def fit_and_apply_calibrator(factory):
+    def run_func(data):
+        factory(valid_preacts=data.valid_preacts,
+                valid_labels=data.valid_labels)(data.test_preacts)
+    return run_func
+
+
+def run_temp_scaling(data):
+    #a 10-class problem, with the binary posteriors as the true class
+    rng = np.random.RandomState(1234)
+    num_classes = 10
+    n = len(data.valid_labels)
+    preacts = rng.normal(size=(n, num_classes))
+    true_classes = rng.randint(num_classes, size=n)
+    preacts[np.arange(n), true_classes] += 3*data.valid_posterior
+    labels = np.zeros((n, num_classes))
+    labels[np.arange(n), true_classes] = 1
+    calibration.TempScaling(verbose=False)(
+        valid_preacts=preacts, valid_labels=labels)(preacts)
+
+
+def run_ece(data):
+    softmax_out = np.stack([1-data.test_posterior, data.test_posterior],
+                           axis=1)
+    labels = np.stack([1-data.test_labels, data.test_labels], axis=1)
+    calibration.compute_ece(softmax_out=softmax_out, labels=labels,
+                            bins=15)
+
+
+def run_metric(metric):
+    def run_func(data):
+        metric(y_true=data.test_labels, y_score=data.test_posterior)
+    return run_func
+
+
+def run_retention_curve(abstention_eval_class):
+    def run_func(data):
+        abstention_eval_class(proportion_to_retain=1.0).retention_curve(
+            abstention_scores=data.abstention_scores,
+            y_true=data.test_labels, y_score=data.test_posterior,
+            proportions_to_retain=np.linspace(0.05, 1.0, 20))
+    return run_func
+
+
+def get_benchmarks():
+    return [
+        Benchmark("MarginalDeltaAuRoc",
+            fit_and_apply_abstainer(
+                abstention.MarginalDeltaAuRoc(verbose=False))),
+        Benchmark("MarginalDeltaAuPrc",
+            fit_and_apply_abstainer(
+                abstention.MarginalDeltaAuPrc(verbose=False))),
+        Benchmark("RecursiveMarginalDeltaAuRoc",
+            fit_and_apply_abstainer(
+                abstention.RecursiveMarginalDeltaAuRoc(
+                    proportion_to_retain=0.8, verbose=False))),
+        #each auPRC eviction is an O(n) pass, so the whole fit is O(n^2)
+        Benchmark("RecursiveMarginalDeltaAuPrc",
+            fit_and_apply_abstainer(
+                abstention.RecursiveMarginalDeltaAuPrc(
+                    proportion_to_retain=0.8, verbose=False)),
+            max_size=10**5),
+        Benchmark("NegativeAbsLogLikelihoodRatio",
+            fit_and_apply_abstainer(
+                abstention.NegativeAbsLogLikelihoodRatio())),
+        Benchmark("NegPosteriorDistanceFromThreshold(OptimalF1)",
+            fit_and_apply_abstainer(
+                abstention.NegPosteriorDistanceFromThreshold(
+                    abstention.OptimalF1(beta=1.0, range_to_search=None,
+                                         verbose=False)))),
+        Benchmark("ConvexHybrid",
+            fit_and_apply_abstainer(abstention.ConvexHybrid(
+                factory1=abstention.MarginalDeltaAuRoc(verbose=False),
+                factory2=abstention.Uncertainty(),
+                abstention_eval_func=abstention.AuRocAbstentionEval(
+                    proportion_to_retain=0.8),
+                verbose=False))),
+        Benchmark("MulticlassWrapper(MarginalDeltaAuRoc)",
+            fit_and_apply_abstainer(abstention.MulticlassWrapper(
+                abstention.MarginalDeltaAuRoc(verbose=False), verbose=False),
+                needs_columns=True), multi_task=True),
+        Benchmark("MulticlassWrapper(NegativeAbsLogLikelihoodRatio)",
+            fit_and_apply_abstainer(abstention.MulticlassWrapper(
+                abstention.NegativeAbsLogLikelihoodRatio(), verbose=False),
+                needs_columns=True), multi_task=True),
+        Benchmark("Expit", fit_and_apply_calibrator(calibration.Expit())),
+        Benchmark("PlattScaling",
+            fit_and_apply_calibrator(calibration.PlattScaling(
+                verbose=False)), multi_task=True),
+        Benchmark("IsotonicRegression",
+            fit_and_apply_calibrator(calibration.IsotonicRegression(
+                verbose=False))),
+        Benchmark("ImbalanceAdaptationWrapper(PlattScaling)",
+            fit_and_apply_calibrator(calibration.ImbalanceAdaptationWrapper(
+                calibration.PlattScaling(verbose=False), verbose=False))),
+        Benchmark("TempScaling", run_temp_scaling),
+        Benchmark("compute_ece", run_ece),
+        Benchmark("auroc_score", run_metric(abstention.auroc_score),
+                  multi_task=True),
+        Benchmark("average_precision_score",
+                  run_metric(abstention.average_precision_score),
+                  multi_task=True),
+        Benchmark("AuRocAbstentionEval.retention_curve",
+                  run_retention_curve(abstention.AuRocAbstentionEval)),
+        Benchmark("AuPrcAbstentionEval.retention_curve",
+                  run_retention_curve(abstention.AuPrcAbstentionEval)),
+    ]
+
+
+def time_and_profile(run_func, data, repeats):
+    seconds = []
+    peak_memory_bytes = None
+    for repeat in range(repeats):
+        if (tracemalloc is not None and repeat == 0):
+            #tracing slows things down, so only the first run is traced
+            tracemalloc.start()
+        start = time.time()
+        run_func(data)
+        seconds.append(time.time() - start)
+        if (tracemalloc is not None and repeat == 0):
+            peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    #with tracing on, the first run only counts if it's the only one
+    return (min(seconds[1:]) if len(seconds) > 1 else seconds[0],
+            peak_memory_bytes)
+
+
+def get_environment():
+    try:
+        git_revision = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode("utf-8").strip()
+    except Exception:
+        git_revision = None
+    return {"git_revision": git_revision,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine()}
+
+
+def run_benchmarks(benchmarks, sizes, tasks, repeats, max_cells, out_file):
+    environment = get_environment()
+    devnull = open(os.devnull, "w")
+    for num_tasks in tasks:
+        for n in sizes:
+            data = None
+            for benchmark in benchmarks:
+                if (num_tasks > 1 and not benchmark.multi_task):
+                    continue
+                record = {"benchmark": benchmark.name, "n": n,
+                          "num_tasks": num_tasks}
+                record.update(environment)
+                if (benchmark.max_size is not None
+                    and n > benchmark.max_size):
+                    record["skipped"] = "n > "+str(benchmark.max_size)
+                elif (n*num_tasks > max_cells):
+                    record["skipped"] = "n*num_tasks > "+str(max_cells)
+                else:
+                    if (data is None):
+                        data = SyntheticData(n=n, num_tasks=num_tasks)
+                    #some abstainers print progress; keep it out of the way
+                    stdout = sys.stdout
+                    sys.stdout = devnull
+                    try:
+                        seconds, peak_memory_bytes = time_and_profile(
+                            benchmark.run_func, data, repeats)
+                    finally:
+                        sys.stdout = stdout
+                    record["seconds"] = seconds
+                    record["peak_memory_bytes"] = peak_memory_bytes
+                out_file.write(json.dumps(record, sort_keys=True)+"\n")
+                out_file.flush()
+                print(benchmark.name, "n="+str(n), "tasks="+str(num_tasks),
+                      record.get("seconds", record.get("skipped")))
+    devnull.close()
+
+
+def load_records(path):
+    records = {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if ("seconds" in record):
+                records[(record["benchmark"], record["n"],
+                         record["num_tasks"])] = record
+    return records
+
+
+def compare(new_path, old_path, regression_threshold):
+    old_records = load_records(old_path)
+    new_records = load_records(new_path)
+    regressions = []
+    print("benchmark\tn\tnum_tasks\ttime_ratio\tmemory_ratio")
+    for key in sorted(set(old_records) & set(new_records)):
+        old_record, new_record = old_records[key], new_records[key]
+        time_ratio = new_record["seconds"]/max(old_record["seconds"], 1e-9)
+        memory_ratio = None
+        if (old_record.get("peak_memory_bytes")
+            and new_record.get("peak_memory_bytes") is not None):
+            memory_ratio = (new_record["peak_memory_bytes"]
+                            /old_record["peak_memory_bytes"])
+        print("\t".join(str(x) for x in
+                        list(key)+[time_ratio, memory_ratio]))
+        if (time_ratio > regression_threshold):
+            regressions.append(key)
+    if (len(regressions) > 0):
+        print("Regressions (time ratio >", regression_threshold, "):",
+              regressions)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", required=True,
+                        help="JSON-lines file to write the results to")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10**3, 10**4, 10**5, 10**6, 10**7])
+    parser.add_argument("--tasks", type=int, nargs="+",
+                        default=[1, 10, 100, 1000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-cells", type=int, default=10**8,
+                        help="skip cases where n*num_tasks exceeds this")
+    parser.add_argument("--only", nargs="+", default=None,
+                        help="names of the benchmarks to run")
+    parser.add_argument("--compare", default=None,
+                        help="earlier output file to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=1.25)
+    args = parser.parse_args()
+
+    benchmarks = [x for x in get_benchmarks()
+                  if args.only is None or x.name in args.only]
+    with open(args.output, "w") as out_file:
+        run_benchmarks(benchmarks=benchmarks, sizes=args.sizes,
+                       tasks=args.tasks, repeats=args.repeats,
+                       max_cells=args.max_cells, out_file=out_file)
+    if (args.compare is not None):
+        if (len(compare(new_path=args.output, old_path=args.compare,
+                        regression_threshold=args.regression_threshold))
+            > 0):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.abstention import (AbstentionEval, AuRocAbstentionEval,
+                                   AuPrcAbstentionEval,
+                                   average_precision_score,
+                                   average_precision_retention_curve)
+
+
+class TestAbstentionEval(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.y_score = np.round(np.random.rand(2000), 2)
+        self.y_true = 1.0*(np.random.rand(2000) < self.y_score)
+        self.abstention_scores = np.round(np.random.rand(2000), 2)
+        self.proportions_to_retain = np.linspace(0.05, 1.0, 20)
+
+    def check_retention_curve(self, abstention_eval_class):
+        curve = abstention_eval_class(proportion_to_retain=1.0)\
+                    .retention_curve(
+                        abstention_scores=self.abstention_scores,
+                        y_true=self.y_true, y_score=self.y_score,
+                        proportions_to_retain=self.proportions_to_retain)
+        expected = [abstention_eval_class(proportion_to_retain=x)(
+                        abstention_scores=self.abstention_scores,
+                        y_true=self.y_true, y_score=self.y_score)
+                    for x in self.proportions_to_retain]
+        np.testing.assert_allclose(curve, expected, rtol=1e-10)
+
+    def test_auroc_retention_curve(self):
+        self.check_retention_curve(AuRocAbstentionEval)
+
+    def test_auprc_retention_curve(self):
+        self.check_retention_curve(AuPrcAbstentionEval)
+
+    def test_auroc_all_retention_levels(self):
+        curve = AuRocAbstentionEval(proportion_to_retain=1.0)\
+                    .retention_curve(
+                        abstention_scores=self.abstention_scores,
+                        y_true=self.y_true, y_score=self.y_score)
+        self.assertEqual(len(curve), len(self.y_true))
+        for num_retained in [50, 333, 1999]:
+            self.assertAlmostEqual(
+                curve[num_retained-1],
+                AuRocAbstentionEval(
+                    proportion_to_retain=num_retained/len(self.y_true))(
+                    abstention_scores=self.abstention_scores,
+                    y_true=self.y_true, y_score=self.y_score))
+
+    def test_empty_retention_levels(self):
+        for abstention_eval_class in [AuRocAbstentionEval,
+                                      AuPrcAbstentionEval]:
+            curve = abstention_eval_class(proportion_to_retain=1.0)\
+                        .retention_curve(
+                            abstention_scores=self.abstention_scores,
+                            y_true=self.y_true, y_score=self.y_score,
+                            proportions_to_retain=[0.0, 0.01, 0.5])
+            self.assertTrue(np.isnan(curve[0]))
+            self.assertFalse(np.any(np.isnan(curve[1:])))
+
+    def test_auprc_retention_curve_batches(self):
+        #levels split over several batches of the cumulative pass
+        curve = AuPrcAbstentionEval(proportion_to_retain=1.0)\
+                    .retention_curve(
+                        abstention_scores=self.abstention_scores,
+                        y_true=self.y_true, y_score=self.y_score)
+        indices = np.argsort(self.abstention_scores)
+        np.testing.assert_allclose(
+            average_precision_retention_curve(
+                y_true=self.y_true[indices], y_score=self.y_score[indices],
+                num_retained=np.arange(1, len(self.y_true)+1),
+                max_batch_entries=7*len(self.y_true)), curve, rtol=1e-12)
+        for num_retained in [1, 37, 1500]:
+            self.assertAlmostEqual(
+                curve[num_retained-1],
+                average_precision_score(
+                    y_true=self.y_true[indices[:num_retained]],
+                    y_score=self.y_score[indices[:num_retained]]))
+
+    def check_bootstrap(self, abstention_eval_class):
+        abstention_eval = abstention_eval_class(proportion_to_retain=0.8)
+        #the same evaluator without the batched metric evaluates every
+        #resample separately, on explicitly resampled arrays
+        loop_eval = AbstentionEval(
+                        metric=abstention_eval.metric,
+                        proportion_to_retain=0.8,
+                        retention_curve_func=\
+                            abstention_eval.retention_curve_func)
+        kwargs = dict(abstention_scores=self.abstention_scores,
+                      y_true=self.y_true, y_score=self.y_score,
+                      proportions_to_retain=[0.05, 0.5, 0.8, 1.0],
+                      num_bootstraps=50)
+        values = abstention_eval.bootstrap_retention_curve(
+                    random_state=1, batch_size=7, **kwargs)
+        self.assertEqual(values.shape, (50, 4))
+        np.testing.assert_allclose(
+            values, loop_eval.bootstrap_retention_curve(
+                        random_state=1, **kwargs), rtol=1e-10)
+
+        lower, upper = abstention_eval.bootstrap_intervals(
+                            random_state=1, **kwargs)
+        curve = abstention_eval.retention_curve(
+                    abstention_scores=self.abstention_scores,
+                    y_true=self.y_true, y_score=self.y_score,
+                    proportions_to_retain=[0.05, 0.5, 0.8, 1.0])
+        self.assertTrue(np.all(lower <= curve) and np.all(curve <= upper))
+        #fewer retained examples, wider intervals
+        self.assertTrue((upper-lower)[0] > (upper-lower)[-1])
+
+    def test_auroc_bootstrap(self):
+        self.check_bootstrap(AuRocAbstentionEval)
+
+    def test_auprc_bootstrap(self):
+        self.check_bootstrap(AuPrcAbstentionEval)
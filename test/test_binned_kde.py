@@ -0,0 +1,28 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.calibration import BinnedKDE
+
+
+class TestBinnedKDE(unittest.TestCase):
+
+    def test_matches_exact_gaussian_kde(self):
+        np.random.seed(1234)
+        x = np.random.beta(0.5, 2, size=1000)
+        bandwidth = len(x)**(-1./(1+4))
+        kde = BinnedKDE(bandwidth=bandwidth).fit(x)
+        exact = np.sum(np.exp(-0.5*np.square(
+                    (x[:,None]-x[None,:])/bandwidth)), axis=1)\
+                /(len(x)*bandwidth*np.sqrt(2*np.pi))
+        np.testing.assert_allclose(kde(x), exact, rtol=1e-4)
+
+    def test_rows_match_separate_fits(self):
+        np.random.seed(1234)
+        x = np.random.beta(0.5, 2, size=(4, 500))
+        kde = BinnedKDE(bandwidth=0.1).fit(x)
+        self.assertEqual(kde.grid_densities.shape, (4, 2048))
+        np.testing.assert_allclose(
+            kde(x), [BinnedKDE(bandwidth=0.1).fit(row)(row) for row in x],
+            rtol=1e-10)
@@ -0,0 +1,118 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from sklearn.isotonic import IsotonicRegression as IR
+from sklearn.linear_model import LogisticRegression as LR
+from abstention.calibration import (PlattScaling, IsotonicRegression,
+                                    ImbalanceAdaptationWrapper, TempScaling)
+
+
+class TestCalibrators(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.valid_preacts = np.round(np.random.randn(1000), 2)
+        self.valid_labels = 1.0*(np.random.rand(1000)
+                                 < 1/(1+np.exp(-2*self.valid_preacts)))
+        self.test_preacts = 1.5*np.random.randn(3000)
+
+    def test_platt_matches_sklearn(self):
+        calibration_func = PlattScaling(verbose=False)(
+            valid_preacts=self.valid_preacts[:,None],
+            valid_labels=self.valid_labels)
+        lr = LR(tol=1e-12, max_iter=10000).fit(self.valid_preacts[:,None],
+                                               self.valid_labels)
+        expected = lr.predict_proba(self.test_preacts[:,None])[:,1]
+        np.testing.assert_allclose(calibration_func(self.test_preacts),
+                                   expected, rtol=1e-6)
+        out = np.empty(len(self.test_preacts))
+        self.assertTrue(calibration_func(self.test_preacts, out=out) is out)
+        np.testing.assert_allclose(out, expected, rtol=1e-6)
+
+    def test_multitask_platt_matches_per_task(self):
+        valid_preacts = np.random.randn(1000, 5)*np.arange(1, 6)
+        valid_labels = 1.0*(np.random.rand(1000, 5)
+                            < 1/(1+np.exp(-valid_preacts+1)))
+        #a task with a single class
+        valid_labels[:,4] = 1
+        test_preacts = np.random.randn(200, 5)
+        multitask_probs = PlattScaling(verbose=False)(
+            valid_preacts=valid_preacts,
+            valid_labels=valid_labels)(test_preacts)
+        self.assertEqual(multitask_probs.shape, (200, 5))
+        for task_idx in range(5):
+            np.testing.assert_allclose(
+                multitask_probs[:,task_idx],
+                PlattScaling(verbose=False)(
+                    valid_preacts=valid_preacts[:,task_idx],
+                    valid_labels=valid_labels[:,task_idx])(
+                    test_preacts[:,task_idx]), rtol=1e-8)
+
+    def test_isotonic_matches_sklearn(self):
+        calibration_func = IsotonicRegression(verbose=False)(
+            valid_preacts=self.valid_preacts,
+            valid_labels=self.valid_labels)
+        ir = IR().fit(self.valid_preacts, self.valid_labels)
+        expected = ir.transform(np.clip(self.test_preacts,
+                                        np.min(self.valid_preacts),
+                                        np.max(self.valid_preacts)))
+        np.testing.assert_allclose(calibration_func(self.test_preacts),
+                                   expected, rtol=1e-10)
+        out = np.empty(len(self.test_preacts))
+        self.assertTrue(calibration_func(self.test_preacts, out=out) is out)
+        np.testing.assert_allclose(out, expected, rtol=1e-10)
+
+    def test_imbalance_adaptation_block_matches_per_run(self):
+        calibration_func = ImbalanceAdaptationWrapper(
+            base_calibrator_factory=PlattScaling(verbose=False),
+            verbose=False)(valid_preacts=self.valid_preacts,
+                           valid_labels=self.valid_labels)
+        dropout_preacts = self.test_preacts[None,:]\
+                          + 0.3*np.random.randn(5, len(self.test_preacts))
+        np.testing.assert_allclose(
+            calibration_func(dropout_preacts),
+            [calibration_func(run) for run in dropout_preacts],
+            rtol=1e-12)
+
+    def test_temp_scaling_checks_labels_per_chunk(self):
+        preacts = np.random.randn(100, 3)
+        labels = np.eye(3)[np.argmax(preacts, axis=1)]
+        labels[95] = 0
+        with self.assertRaises(AssertionError):
+            TempScaling(verbose=False, chunk_size=30)(
+                valid_preacts=preacts, valid_labels=labels)
+
+    def test_chunked_and_memmapped_temp_scaling_match_in_memory(self):
+        preacts = 3*np.random.randn(2000, 4)
+        labels = np.eye(4)[np.argmax(preacts + 2*np.random.randn(2000, 4),
+                                     axis=1)]
+        expected = TempScaling(verbose=False)(
+            valid_preacts=preacts, valid_labels=labels).temp
+        for chunk_size in [1, 300, 1999, 2000, 5000]:
+            np.testing.assert_allclose(
+                TempScaling(verbose=False, chunk_size=chunk_size)(
+                    valid_preacts=preacts, valid_labels=labels).temp,
+                expected, rtol=1e-5)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            preacts_path = os.path.join(tmp_dir, "preacts.npy")
+            labels_path = os.path.join(tmp_dir, "labels.npy")
+            np.save(preacts_path, preacts)
+            np.save(labels_path, labels)
+            np.testing.assert_allclose(
+                TempScaling(verbose=False, chunk_size=300)(
+                    valid_preacts=np.load(preacts_path, mmap_mode="r"),
+                    valid_labels=np.load(labels_path, mmap_mode="r")).temp,
+                expected, rtol=1e-5)
+            np.testing.assert_allclose(
+                TempScaling(verbose=False, chunk_size=300)(
+                    valid_preacts=preacts_path,
+                    valid_labels=labels_path).temp,
+                expected, rtol=1e-5)
+        finally:
+            shutil.rmtree(tmp_dir)
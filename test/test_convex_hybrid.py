@@ -0,0 +1,128 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.abstention import (ConvexHybrid, AuRocAbstentionEval,
+                                   AuPrcAbstentionEval,
+                                   find_best_mixing_coef)
+
+
+def grid_search(evaluation_func, scores1, scores2, coefs_to_try):
+    #a plain search: the first a with the highest non-nan objective
+    best_a, best_objective = None, None
+    for a in coefs_to_try:
+        objective = evaluation_func(a*scores1 + (1.0-a)*scores2)
+        if (not np.isnan(objective) and
+            (best_objective is None or objective > best_objective)):
+            best_a, best_objective = a, objective
+    return best_a, best_objective
+
+
+class NoisyDistanceFromHalf(object):
+
+    def __init__(self, noise):
+        self.noise = noise
+
+    def __call__(self, valid_labels, valid_posterior, valid_uncert):
+        return (lambda posterior_probs, uncertainties:
+                0.1*self.noise - np.abs(posterior_probs - 0.5))
+
+
+class TestConvexHybrid(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        self.valid_posterior = rng.rand(3000)
+        self.valid_labels = 1.0*(rng.rand(3000) < self.valid_posterior)
+        self.valid_uncert = rng.rand(3000)
+        self.abstention_eval = AuPrcAbstentionEval(proportion_to_retain=0.7)
+        #two equally noisy versions of the same score, so that the best
+        #mixture is an interior one
+        self.factory1 = NoisyDistanceFromHalf(noise=rng.randn(3000))
+        self.factory2 = NoisyDistanceFromHalf(noise=rng.randn(3000))
+
+    def fit(self, **kwargs):
+        return ConvexHybrid(factory1=self.factory1, factory2=self.factory2,
+                            verbose=False, **kwargs)(
+            valid_labels=self.valid_labels,
+            valid_posterior=self.valid_posterior,
+            valid_uncert=self.valid_uncert).mixing_coef
+
+    def get_scores(self):
+        return [factory(valid_labels=self.valid_labels,
+                        valid_posterior=self.valid_posterior,
+                        valid_uncert=self.valid_uncert)(
+                    posterior_probs=self.valid_posterior,
+                    uncertainties=self.valid_uncert)
+                for factory in [self.factory1, self.factory2]]
+
+    def evaluation_func(self, scores):
+        return self.abstention_eval(abstention_scores=scores,
+                                    y_true=self.valid_labels,
+                                    y_score=self.valid_posterior)
+
+    def test_modes_match_grid_search(self):
+        scores1, scores2 = self.get_scores()
+        expected, expected_objective = grid_search(
+            evaluation_func=self.evaluation_func, scores1=scores1,
+            scores2=scores2, coefs_to_try=np.arange(0.0, 1.05, 0.05))
+        #a plain function rather than an AbstentionEval is evaluated one
+        #mixture at a time, serially or on threads
+        plain_eval_func = (lambda abstention_scores, y_true, y_score:
+                           self.abstention_eval(
+                               abstention_scores=abstention_scores,
+                               y_true=y_true, y_score=y_score))
+        for kwargs in [dict(abstention_eval_func=self.abstention_eval),
+                       dict(abstention_eval_func=plain_eval_func),
+                       dict(abstention_eval_func=plain_eval_func,
+                            num_workers=3)]:
+            self.assertAlmostEqual(self.fit(stepsize=0.05, **kwargs),
+                                   expected)
+
+        refined = [self.fit(stepsize=0.05, num_refinement_rounds=2,
+                            **kwargs)
+                   for kwargs in [
+                       dict(abstention_eval_func=self.abstention_eval),
+                       dict(abstention_eval_func=plain_eval_func,
+                            num_workers=3)]]
+        self.assertAlmostEqual(refined[0], refined[1])
+        self.assertTrue(abs(refined[0] - expected) <= 0.05)
+        self.assertTrue(
+            self.evaluation_func(refined[0]*scores1 + (1-refined[0])*scores2)
+            >= expected_objective)
+
+    def test_nan_objectives_are_skipped(self):
+        #a*ones + (1-a)*zeros recovers a from the scores
+        scores1, scores2 = np.ones(10), np.zeros(10)
+        def evaluation_func(scores):
+            a = scores[0]
+            return np.nan if a < 0.3 else -(a - 0.6)**2
+        def degenerate_evaluation_func(scores):
+            #every mixture is degenerate
+            return np.nan
+        for func, expected in [(evaluation_func, 0.6),
+                               (degenerate_evaluation_func, 0.0)]:
+            def batch_evaluation_func(scores):
+                return np.array([func(column) for column in scores.T])
+            for kwargs in [dict(), dict(num_workers=2),
+                           dict(batch_evaluation_func=batch_evaluation_func),
+                           dict(num_refinement_rounds=2)]:
+                self.assertAlmostEqual(find_best_mixing_coef(
+                    evaluation_func=func, scores1=scores1,
+                    scores2=scores2, stepsize=0.1, **kwargs), expected)
+
+    def test_evaluate_many_matches_per_column(self):
+        rng = np.random.RandomState(1)
+        #ties in the abstention scores
+        abstention_scores = np.round(rng.rand(3000, 7), 2)
+        for eval_class in [AuRocAbstentionEval, AuPrcAbstentionEval]:
+            abstention_eval = eval_class(proportion_to_retain=0.6)
+            np.testing.assert_allclose(
+                abstention_eval.evaluate_many(
+                    abstention_scores=abstention_scores,
+                    y_true=self.valid_labels, y_score=self.valid_posterior),
+                [abstention_eval(abstention_scores=column,
+                                 y_true=self.valid_labels,
+                                 y_score=self.valid_posterior)
+                 for column in abstention_scores.T], rtol=1e-10)
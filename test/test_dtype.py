@@ -0,0 +1,109 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.abstention import (MarginalDeltaAuRoc, MarginalDeltaAuPrc,
+                                   NegativeAbsLogLikelihoodRatio)
+from abstention.calibration import (PlattScaling, IsotonicRegression,
+                                    TempScaling, SoftmaxCalibrationFunc)
+
+
+class TestFloat32Policy(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        self.valid_preacts = rng.randn(3000)
+        self.valid_labels = 1.0*(rng.rand(3000)
+                                 < 1/(1+np.exp(-2*self.valid_preacts)))
+        self.test_preacts = rng.randn(2000)
+        self.valid_posterior = rng.rand(3000, 3)
+        self.valid_posterior_labels = 1.0*(rng.rand(3000, 3)
+                                           < self.valid_posterior)
+        #float32 cannot resolve 1-p for p within ~1e-7 of 1, where the
+        #log likelihood ratio then differs; keep away from 0 and 1
+        self.test_posterior = 0.001 + 0.998*rng.rand(2000, 3)
+
+    def check_float32_close(self, func):
+        result64 = func(self.test_preacts)
+        result32 = func(self.test_preacts.astype("float32"))
+        self.assertEqual(result64.dtype, np.float64)
+        self.assertEqual(result32.dtype, np.float32)
+        np.testing.assert_allclose(result32, result64, rtol=1e-5,
+                                   atol=1e-6)
+
+    def test_calibrators(self):
+        for factory in [PlattScaling(verbose=False),
+                        IsotonicRegression(verbose=False)]:
+            self.check_float32_close(factory(
+                valid_preacts=self.valid_preacts,
+                valid_labels=self.valid_labels))
+
+    def test_temp_scaling(self):
+        rng = np.random.RandomState(1)
+        preacts = rng.randn(2000, 4)
+        labels = np.eye(4)[np.argmax(preacts + rng.randn(2000, 4), axis=1)]
+        func = TempScaling(verbose=False)(valid_preacts=preacts,
+                                          valid_labels=labels)
+        result64 = func(preacts[:500])
+        result32 = func(preacts[:500].astype("float32"))
+        self.assertEqual(result32.dtype, np.float32)
+        np.testing.assert_allclose(result32, result64, rtol=1e-5)
+
+    def test_softmax_large_float32_logits(self):
+        preacts = np.array([[100.0, 0.0, -5.0], [1000.0, 999.0, 0.0]])
+        func = SoftmaxCalibrationFunc(temp=0.5)
+        result64 = func(preacts)
+        result32 = func(preacts.astype("float32"))
+        self.assertEqual(result32.dtype, np.float32)
+        self.assertTrue(np.all(np.isfinite(result32)))
+        np.testing.assert_allclose(result32, result64, rtol=1e-5,
+                                   atol=1e-30)
+        np.testing.assert_allclose(np.sum(result32, axis=1), 1.0,
+                                   rtol=1e-6)
+
+    def test_dtype_override(self):
+        func = PlattScaling(verbose=False, dtype=np.float32)(
+            valid_preacts=self.valid_preacts,
+            valid_labels=self.valid_labels)
+        self.assertEqual(func(self.test_preacts).dtype, np.float32)
+        scores = MarginalDeltaAuRoc(verbose=False, dtype="float32")(
+            valid_labels=self.valid_posterior_labels,
+            valid_posterior=self.valid_posterior)(
+            posterior_probs=self.test_posterior.copy())
+        self.assertEqual(scores.dtype, np.float32)
+
+    def test_marginal_delta_scores(self):
+        for factory in [MarginalDeltaAuRoc(verbose=False),
+                        MarginalDeltaAuPrc(verbose=False),
+                        MarginalDeltaAuPrc(estimate_cdfs_from_valid=True,
+                                           verbose=False),
+                        NegativeAbsLogLikelihoodRatio()]:
+            for column in [0, slice(None)]:
+                func = factory(
+                    valid_labels=self.valid_posterior_labels[:,column],
+                    valid_posterior=self.valid_posterior[:,column])
+                scores64 = func(
+                    posterior_probs=self.test_posterior[:,column].copy(),
+                    uncertainties=None)
+                scores32 = func(
+                    posterior_probs=self.test_posterior[:,column].astype(
+                                        "float32"),
+                    uncertainties=None)
+                self.assertEqual(scores64.dtype, np.float64)
+                self.assertEqual(scores32.dtype, np.float32)
+                self.assertEqual(scores32.shape, scores64.shape)
+                #the scores are relative to their spread
+                scale = np.max(np.abs(scores64))
+                np.testing.assert_allclose(scores32/scale, scores64/scale,
+                                           rtol=0, atol=1e-4)
+                #and the ranking, which is all that abstention uses,
+                #agrees to within float32 ties
+                self.assertTrue(np.mean(
+                    np.argsort(scores32, axis=0, kind="mergesort")
+                    == np.argsort(scores64, axis=0, kind="mergesort"))
+                    > 0.99)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.calibration import compute_ece, EceAccumulator
+
+
+def loop_ece(softmax_out, labels, bins):
+    #the original per-bin loop
+    bin_boundaries = np.linspace(0,1,num=bins)
+    confidences = np.max(softmax_out,axis=1)
+    is_correct = np.argmax(softmax_out,axis=1)==np.argmax(labels,axis=1)
+    ece = 0.0
+    for bin_lower, bin_upper in zip(bin_boundaries[:-1], bin_boundaries[1:]):
+        in_bin = (confidences > bin_lower)*(confidences <= bin_upper)
+        prop_in_bin = np.mean(in_bin)
+        if (prop_in_bin > 0.0):
+            ece += np.abs(np.mean(confidences[in_bin])
+                          - np.mean(is_correct[in_bin]))*prop_in_bin
+    return ece*100
+
+
+class TestEce(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        preacts = 3*rng.randn(5000, 4)
+        exp_preacts = np.exp(preacts - np.max(preacts, axis=1,
+                                              keepdims=True))
+        self.softmax_out = exp_preacts/np.sum(exp_preacts, axis=1,
+                                              keepdims=True)
+        #confidences exactly on bin boundaries go to the lower bin
+        self.softmax_out[:100] = [0.5, 0.25, 0.25, 0.0]
+        self.labels = np.eye(4)[np.argmax(preacts + 2*rng.randn(5000, 4),
+                                          axis=1)]
+
+    def test_matches_loop(self):
+        for bins in [2, 3, 15, 100, 1000]:
+            self.assertAlmostEqual(
+                compute_ece(softmax_out=self.softmax_out,
+                            labels=self.labels, bins=bins),
+                loop_ece(softmax_out=self.softmax_out,
+                         labels=self.labels, bins=bins), places=10)
+
+    def test_empty_bins(self):
+        #all the confidences are in (0.6, 0.7], so most bins are empty
+        softmax_out = np.zeros((1000, 2))
+        softmax_out[:,0] = 0.6 + 0.1*np.random.RandomState(1).rand(1000)
+        softmax_out[:,1] = 1 - softmax_out[:,0]
+        labels = self.labels[:1000,:2]
+        ece = compute_ece(softmax_out=softmax_out, labels=labels, bins=50)
+        self.assertAlmostEqual(ece, loop_ece(softmax_out=softmax_out,
+                                             labels=labels, bins=50),
+                               places=10)
+        diagram = EceAccumulator(bins=50)
+        diagram.update(softmax_out=softmax_out, labels=labels)
+        counts = diagram.get_reliability_diagram()['counts']
+        bin_boundaries = np.linspace(0,1,num=50)
+        confidences = softmax_out[:,0]
+        np.testing.assert_array_equal(counts, [
+            np.sum((confidences > lower)*(confidences <= upper))
+            for lower, upper in zip(bin_boundaries[:-1], bin_boundaries[1:])])
+        self.assertTrue(np.sum(counts == 0) > 40)
+        self.assertEqual(np.sum(counts), 1000)
+
+    def test_chunked_matches_one_call(self):
+        bins = [15, 30]
+        expected = compute_ece(softmax_out=self.softmax_out,
+                               labels=self.labels, bins=bins)
+        ece_accumulator = EceAccumulator(bins=bins)
+        for start in range(0, len(self.labels), 700):
+            ece_accumulator.update(
+                softmax_out=self.softmax_out[start:start+700],
+                labels=self.labels[start:start+700])
+        np.testing.assert_allclose(ece_accumulator.get_ece(), expected,
+                                   rtol=1e-12)
+        np.testing.assert_allclose(
+            expected, [loop_ece(softmax_out=self.softmax_out,
+                                labels=self.labels, bins=x) for x in bins],
+            rtol=1e-10)
@@ -0,0 +1,114 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import warnings
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from abstention.experiments import run_experiment_grid, get_method_to_perfs
+from abstention.abstention import (MarginalDeltaAuRoc, MarginalDeltaAuPrc,
+                                   NegativeAbsLogLikelihoodRatio,
+                                   Uncertainty, AuRocAbstentionEval,
+                                   AuPrcAbstentionEval)
+from abstention.calibration import PlattScaling, IsotonicRegression
+from abstention.figure_making_utils import get_ustats_mat
+
+
+class TestExperiments(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        self.seed_to_data = OrderedDict()
+        for seed in range(3):
+            data = {}
+            for split, n in [("valid", 500), ("test", 800)]:
+                preacts = rng.randn(n)
+                data[split+"_preacts"] = preacts
+                data[split+"_dropout_preacts"] =\
+                    preacts[None,:] + 0.3*rng.randn(10, n)
+                data[split+"_labels"] =\
+                    1.0*(rng.rand(n) < 1/(1+np.exp(-2*preacts)))
+            self.seed_to_data[seed] = data
+        self.cb_method_name_to_factory = OrderedDict([
+            ("platt", PlattScaling(verbose=False)),
+            ("isotonic", IsotonicRegression(verbose=False))])
+        self.abstainer_name_to_factory = OrderedDict([
+            ("auroc", MarginalDeltaAuRoc(verbose=False)),
+            ("auprc", MarginalDeltaAuPrc(verbose=False)),
+            ("llr", NegativeAbsLogLikelihoodRatio()),
+            ("uncert", Uncertainty())])
+        self.eval_name_to_eval_class = OrderedDict([
+            ("auroc", AuRocAbstentionEval),
+            ("auprc", AuPrcAbstentionEval)])
+        self.proportions_to_retain = [0.5, 0.8, 1.0]
+
+    def run_grid(self, pool=None, share_inputs=None):
+        return run_experiment_grid(
+            seed_to_data=self.seed_to_data,
+            cb_method_name_to_factory=self.cb_method_name_to_factory,
+            abstainer_name_to_factory=self.abstainer_name_to_factory,
+            eval_name_to_eval_class=self.eval_name_to_eval_class,
+            proportions_to_retain=self.proportions_to_retain, pool=pool,
+            share_inputs=share_inputs)
+
+    def test_grid_matches_direct_evaluation(self):
+        rows = self.run_grid()
+        self.assertEqual(len(rows), 3*2*4*2*3)
+        data = self.seed_to_data[1]
+        cb_func = PlattScaling(verbose=False)(
+            valid_preacts=data["valid_preacts"],
+            valid_labels=data["valid_labels"])
+        test_posterior = cb_func(data["test_preacts"])
+        scores = MarginalDeltaAuPrc(verbose=False)(
+            valid_labels=data["valid_labels"],
+            valid_posterior=cb_func(data["valid_preacts"]))(
+            posterior_probs=test_posterior.copy())
+        expected = AuRocAbstentionEval(proportion_to_retain=0.8)(
+            abstention_scores=scores, y_true=data["test_labels"],
+            y_score=test_posterior)
+        method_to_perfs = get_method_to_perfs(
+            rows, calibrator="platt", metric="auroc",
+            proportion_to_retain=0.8)
+        self.assertEqual(list(method_to_perfs.keys()),
+                         ["auroc", "auprc", "llr", "uncert"])
+        self.assertAlmostEqual(method_to_perfs["auprc"][1], expected)
+        ustats_mat = get_ustats_mat(method_to_perfs=method_to_perfs,
+                                    method_names=["auroc", "auprc"])
+        self.assertEqual(np.shape(ustats_mat), (2, 2))
+
+    def test_saturated_posteriors_do_not_warn(self):
+        #isotonic regression gives posteriors of exactly 0 and 1
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", RuntimeWarning)
+            rows = self.run_grid()
+        self.assertTrue(all(np.isfinite(row["value"]) for row in rows))
+
+    def test_llr_does_not_modify_posteriors(self):
+        posterior = np.array([0.0, 0.3, 1.0])
+        scores = NegativeAbsLogLikelihoodRatio()(
+            valid_labels=np.array([0, 1, 1]),
+            valid_posterior=posterior)(posterior_probs=posterior)
+        np.testing.assert_array_equal(posterior, [0.0, 0.3, 1.0])
+        self.assertTrue(np.all(np.isfinite(scores)))
+
+    def check_pool_matches_serial(self, pool, share_inputs=None):
+        try:
+            pooled_rows = self.run_grid(pool=pool, share_inputs=share_inputs)
+        finally:
+            pool.close()
+            pool.join()
+        serial_rows = self.run_grid()
+        self.assertEqual([[row[key] for key in row if key != "value"]
+                          for row in pooled_rows],
+                         [[row[key] for key in row if key != "value"]
+                          for row in serial_rows])
+        np.testing.assert_allclose([row["value"] for row in pooled_rows],
+                                   [row["value"] for row in serial_rows])
+
+    def test_process_pool_matches_serial(self):
+        self.check_pool_matches_serial(Pool(2))
+
+    def test_shared_thread_pool_matches_serial(self):
+        self.check_pool_matches_serial(ThreadPool(4), share_inputs=True)
@@ -0,0 +1,55 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.figure_making_utils import (wilcox_srs, get_ustats_mat,
+                                            get_srs_pvalue_mat)
+
+
+def loop_wilcox_srs(vals1, vals2):
+    #the original per-pair implementation
+    signed_ranks = ([(1+x[0])*np.sign(x[1]) for x in
+                     enumerate(sorted(vals1-vals2, key=lambda x: abs(x)))])
+    sum_positives = sum([x for x in signed_ranks if x > 0]+[1e-7])
+    sum_negatives = sum([x for x in signed_ranks if x < 0]+[-1e-7])
+    if (np.abs(sum_negatives) < sum_positives):
+        return np.abs(sum_negatives)
+    else:
+        return -np.abs(sum_positives)
+
+
+class TestFigureMakingUtils(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        #rounded so that there are tied and zero differences
+        self.perfs = np.round(np.random.rand(8, 10), 1)
+        self.method_names = ["method"+str(i) for i in range(8)]
+        self.method_to_perfs = dict(zip(self.method_names, self.perfs))
+
+    def test_ustats_mat_matches_loop(self):
+        ustats_mat = get_ustats_mat(method_to_perfs=self.method_to_perfs,
+                                    method_names=self.method_names)
+        for i in range(8):
+            for j in range(8):
+                expected = (55 if i==j else
+                            loop_wilcox_srs(self.perfs[i], self.perfs[j]))
+                self.assertAlmostEqual(ustats_mat[i,j], expected)
+                if (i != j):
+                    self.assertAlmostEqual(
+                        wilcox_srs(self.perfs[i], self.perfs[j]), expected)
+
+    def test_pvalues(self):
+        perfs = np.random.rand(5, 10)
+        exact_pvals = get_srs_pvalue_mat(perfs, mode="exact")
+        permutation_pvals = get_srs_pvalue_mat(perfs, mode="permutation",
+                                               num_permutations=20000)
+        np.testing.assert_allclose(exact_pvals, exact_pvals.T)
+        np.testing.assert_allclose(permutation_pvals, exact_pvals, atol=0.02)
+        #without ties or zeros, matches the classic exact test: 19 of the
+        #1024 sign patterns of 10 ranks have a rank sum of at most 7
+        differences = np.array([1, -2, 3, 4, -5, 6, 7, 8, 9, 10])/10.0
+        pvals = get_srs_pvalue_mat(np.array([differences,
+                                             np.zeros(10)]), mode="exact")
+        self.assertAlmostEqual(pvals[0,1], 2*19/1024)
@@ -0,0 +1,43 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import os
+import subprocess
+import sys
+
+
+#generous upper bound on the cold-start cost of importing the package
+#(on top of numpy) and applying a lightweight abstainer and calibrator
+MAX_IMPORT_SECONDS = 1.0
+HEAVY_MODULES = ['keras', 'tensorflow', 'theano', 'scipy', 'sklearn']
+
+IMPORT_SCRIPT = """
+import sys, time
+import numpy as np
+start = time.time()
+import abstention
+from abstention.abstention import NegativeAbsLogLikelihoodRatio
+from abstention.calibration import Expit
+posterior = Expit()()(np.linspace(-3, 3, 10))
+NegativeAbsLogLikelihoodRatio()(valid_labels=np.arange(10)%%2,
+    valid_posterior=posterior, valid_uncert=None)(
+    posterior_probs=posterior, uncertainties=None)
+print(time.time() - start)
+print(' '.join(x for x in %r if x in sys.modules))
+""" % (HEAVY_MODULES,)
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_cold_start(self):
+        repo_root = os.path.dirname(os.path.dirname(os.path.abspath(
+                                    __file__)))
+        output = subprocess.check_output(
+            [sys.executable, "-c", IMPORT_SCRIPT],
+            cwd=repo_root).decode("utf-8").split("\n")
+        import_seconds = float(output[0])
+        loaded_heavy_modules = output[1].split()
+        self.assertEqual(loaded_heavy_modules, [])
+        self.assertTrue(import_seconds < MAX_IMPORT_SECONDS,
+                        "cold start took "+str(import_seconds)+"s")
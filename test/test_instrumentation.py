@@ -0,0 +1,67 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import sys
+import numpy as np
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+from abstention.abstention import (MarginalDeltaAuRoc,
+                                   RecursiveMarginalDeltaAuRoc)
+from abstention.calibration import PlattScaling
+from abstention.instrumentation import (RecordingInstrumentation,
+                                        CallbackInstrumentation)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.valid_posterior = np.random.rand(1000)
+        self.valid_labels = 1.0*(np.random.rand(1000)
+                                 < self.valid_posterior)
+        self.test_posterior = np.random.rand(1000)
+
+    def run_abstainer(self, factory):
+        return factory(valid_labels=self.valid_labels,
+                       valid_posterior=self.valid_posterior,
+                       valid_uncert=None)(
+                       posterior_probs=self.test_posterior,
+                       uncertainties=None)
+
+    def test_recorded_events(self):
+        instrumentation = RecordingInstrumentation()
+        self.run_abstainer(RecursiveMarginalDeltaAuRoc(
+            proportion_to_retain=0.5, instrumentation=instrumentation))
+        self.run_abstainer(MarginalDeltaAuRoc(
+            instrumentation=instrumentation))
+        stages = [stage for stage, fields in instrumentation.events]
+        self.assertEqual(stages.count("recursive_eviction.progress"), 5)
+        self.assertEqual(stages[5], "recursive_eviction.done")
+        self.assertEqual(instrumentation.events[5][1]["num_evicted"], 500)
+        self.assertTrue("marginal_delta.metric_estimates" in stages)
+        self.assertEqual(stages[-1], "marginal_delta.score")
+
+        callback_events = []
+        PlattScaling(instrumentation=CallbackInstrumentation(
+            lambda stage, fields: callback_events.append(stage)))(
+            valid_preacts=self.valid_posterior-0.5,
+            valid_labels=self.valid_labels)
+        self.assertEqual(callback_events, ["platt_scaling.fit"])
+
+    def test_silent_when_disabled(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.run_abstainer(RecursiveMarginalDeltaAuRoc(
+                proportion_to_retain=0.5, verbose=False))
+            self.run_abstainer(MarginalDeltaAuRoc(verbose=False))
+            PlattScaling(verbose=False)(
+                valid_preacts=self.valid_posterior-0.5,
+                valid_labels=self.valid_labels)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(output, "")
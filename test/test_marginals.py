@@ -7,7 +7,8 @@ import sys
 import os
 import numpy as np
 from abstention.abstention import (MarginalDeltaAuRocMixin,
-                                   MarginalDeltaAuPrcMixin)
+                                   MarginalDeltaAuPrcMixin,
+                                   ValidationCdfs)
 import scipy.stats.mstats
 
 class TestMarginals(unittest.TestCase):
@@ -59,3 +60,25 @@ class TestMarginals(unittest.TestCase):
         self.apply_marginals_eval(
             marginal_delta_metric_mixin=MarginalDeltaAuPrcMixin(),
             total_num=1000, frac_pos=0.1)
+
+    def test_validation_cdf_lookup(self):
+        np.random.seed(1234)
+        valid_posterior = np.round(np.random.rand(200), 2)
+        valid_labels = 1.0*(np.random.rand(200) < valid_posterior)
+        test_posterior = np.round(np.random.rand(300), 2)
+        pos_cdfs, neg_cdfs = ValidationCdfs(
+            valid_labels=valid_labels,
+            valid_posterior=valid_posterior)(test_posterior)
+        #the cdfs stored with the highest-ranked validation example <= the
+        #test posterior, which count the examples ranked below that one
+        sorted_valid = sorted(zip(valid_posterior, valid_labels),
+                              key=lambda x: x[0])
+        for prob, pos_cdf, neg_cdf in zip(test_posterior, pos_cdfs, neg_cdfs):
+            below = [label for (valid_prob, label) in sorted_valid
+                     if valid_prob <= prob][:-1]
+            self.assertAlmostEqual(
+                pos_cdf, np.sum(np.array(below)==1)/np.sum(valid_labels==1))
+            self.assertAlmostEqual(
+                neg_cdf, max(np.sum(np.array(below)==0)/
+                             np.sum(valid_labels==0),
+                             np.finfo(np.float32).eps))
@@ -0,0 +1,46 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from abstention.abstention import (auroc_score, average_precision_score,
+                                   basic_average_precision_score)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.y_score = np.random.rand(500, 4)
+        self.y_true = 1.0*(np.random.rand(500, 4) < self.y_score)
+
+    def test_auroc_matches_sklearn(self):
+        tied_y_score = np.round(self.y_score, 1)
+        for y_score in [self.y_score, tied_y_score]:
+            np.testing.assert_allclose(
+                auroc_score(y_true=self.y_true, y_score=y_score),
+                [roc_auc_score(y_true=self.y_true[:,i], y_score=y_score[:,i])
+                 for i in range(4)])
+            self.assertAlmostEqual(
+                auroc_score(y_true=self.y_true[:,0], y_score=y_score[:,0]),
+                roc_auc_score(y_true=self.y_true[:,0], y_score=y_score[:,0]))
+
+    def test_average_precision_matches_basic(self):
+        np.testing.assert_allclose(
+            average_precision_score(y_true=self.y_true, y_score=self.y_score),
+            [basic_average_precision_score(y_true=self.y_true[:,i],
+                                           y_score=self.y_score[:,i])
+             for i in range(4)])
+
+    def test_average_precision_ties(self):
+        y_true = np.array([0, 1, 1, 0, 1])
+        y_score = np.array([0.1, 0.5, 0.5, 0.5, 0.9])
+        #the top positive has nothing above it; the two tied positives
+        #only have the 0.9 positive above them
+        self.assertAlmostEqual(
+            average_precision_score(y_true=y_true, y_score=y_score), 1.0)
+        #all positives are tied below the only negative above them
+        y_score = np.array([0.1, 0.5, 0.5, 0.9, 0.5])
+        self.assertAlmostEqual(
+            average_precision_score(y_true=y_true, y_score=y_score), 0.0)
@@ -0,0 +1,56 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from abstention.abstention import (MulticlassWrapper, MarginalDeltaAuRoc,
+                                   MarginalDeltaAuPrc,
+                                   NegativeAbsLogLikelihoodRatio,
+                                   NegPosteriorDistanceFromThreshold,
+                                   OptimalF1, RecursiveMarginalDeltaAuPrc)
+
+
+class TestMulticlassWrapper(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.valid_posterior = np.random.rand(300, 4)
+        self.valid_labels = 1.0*(np.random.rand(300, 4)
+                                 < self.valid_posterior)
+        self.test_posterior = np.random.rand(500, 4)
+
+    def check_matches_per_column(self, factory, pool=None):
+        scores = MulticlassWrapper(factory, pool=pool)(
+                    valid_labels=self.valid_labels,
+                    valid_posterior=self.valid_posterior,
+                    valid_uncert=None)(
+                    posterior_probs=self.test_posterior.copy(),
+                    uncertainties=None)
+        for class_idx in range(4):
+            class_scores = factory(
+                valid_labels=self.valid_labels[:,class_idx],
+                valid_posterior=self.valid_posterior[:,class_idx],
+                valid_uncert=None)(
+                posterior_probs=self.test_posterior[:,class_idx].copy(),
+                uncertainties=None)
+            np.testing.assert_allclose(scores[:,class_idx], class_scores,
+                                       rtol=1e-10)
+
+    def test_vectorized_factories(self):
+        for factory in [MarginalDeltaAuRoc(verbose=False),
+                        MarginalDeltaAuPrc(estimate_cdfs_from_valid=True,
+                                           verbose=False),
+                        NegativeAbsLogLikelihoodRatio(),
+                        NegPosteriorDistanceFromThreshold(
+                            OptimalF1(beta=1.0, verbose=False))]:
+            self.assertTrue(factory.handles_multiple_tasks)
+            self.check_matches_per_column(factory)
+
+    def test_pooled_factory(self):
+        factory = RecursiveMarginalDeltaAuPrc(proportion_to_retain=0.8,
+                                              verbose=False)
+        self.assertFalse(factory.handles_multiple_tasks)
+        pool = ThreadPool(2)
+        self.check_matches_per_column(factory, pool=pool)
+        pool.close()
@@ -0,0 +1,48 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.abstention import OptimalF1
+
+
+class TestOptimalF1(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.valid_posterior = np.round(np.random.rand(500, 3), 2)
+        self.valid_labels = 1.0*(np.random.rand(500, 3)
+                                 < np.square(self.valid_posterior))
+
+    def fbeta_at_threshold(self, threshold_finder, labels, posterior,
+                                 threshold):
+        y_pred = posterior > threshold
+        return threshold_finder.compute_fbeta(
+                true_positives=np.sum(labels*y_pred),
+                predicted_positives=np.sum(y_pred),
+                total_positives=np.sum(labels==1))
+
+    def test_all_thresholds_beats_grid(self):
+        exact_finder = OptimalF1(beta=1.0, range_to_search=None,
+                                 verbose=False)
+        grid_finder = OptimalF1(beta=1.0, verbose=False)
+        labels = self.valid_labels[:,0]
+        posterior = self.valid_posterior[:,0]
+        exact_score = self.fbeta_at_threshold(exact_finder, labels, posterior,
+                            exact_finder(labels, posterior))
+        best_possible = max([
+            self.fbeta_at_threshold(exact_finder, labels, posterior, x)
+            for x in [-1.0]+list(np.unique(posterior))])
+        grid_score = self.fbeta_at_threshold(exact_finder, labels, posterior,
+                            grid_finder(labels, posterior))
+        self.assertAlmostEqual(exact_score, best_possible)
+        self.assertTrue(exact_score >= grid_score)
+
+    def test_multitask_matches_per_task(self):
+        finder = OptimalF1(beta=2.0, range_to_search=None, verbose=False)
+        thresholds = finder(self.valid_labels, self.valid_posterior)
+        self.assertEqual(thresholds.shape, (3,))
+        for task_idx in range(3):
+            self.assertEqual(thresholds[task_idx],
+                             finder(self.valid_labels[:,task_idx],
+                                    self.valid_posterior[:,task_idx]))
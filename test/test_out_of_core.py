@@ -0,0 +1,59 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from abstention.util import external_argsort
+from abstention.abstention import MarginalDeltaAuRoc, MarginalDeltaAuPrc
+
+
+class TestOutOfCore(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.valid_posterior = np.random.rand(1000)
+        self.valid_labels = 1.0*(np.random.rand(1000) < self.valid_posterior)
+        #rounded, so that there are many ties across sorted runs
+        self.test_posterior = np.round(np.random.rand(5000), 3)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.posterior_file = os.path.join(self.tmp_dir, "posterior.npy")
+        np.save(self.posterior_file, self.test_posterior)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_external_argsort(self):
+        expected_indices = np.argsort(self.test_posterior, kind="mergesort")
+        #several small runs, a few larger runs and a single run
+        for chunk_size in [100, 999, 5000]:
+            sort_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+            sorted_values, sorted_indices = external_argsort(
+                values=np.load(self.posterior_file, mmap_mode="r"),
+                chunk_size=chunk_size, tmp_dir=sort_dir)
+            np.testing.assert_array_equal(sorted_indices, expected_indices)
+            np.testing.assert_array_equal(
+                sorted_values, self.test_posterior[expected_indices])
+
+    def test_matches_in_memory_scores(self):
+        out_file = os.path.join(self.tmp_dir, "scores.npy")
+        for factory in [MarginalDeltaAuRoc(verbose=False),
+                        MarginalDeltaAuPrc(verbose=False),
+                        MarginalDeltaAuPrc(estimate_cdfs_from_valid=True,
+                                           verbose=False),
+                        MarginalDeltaAuRoc(all_estimates_from_valid=True,
+                                           verbose=False)]:
+            abstaining_func = factory(valid_labels=self.valid_labels,
+                                      valid_posterior=self.valid_posterior)
+            expected = abstaining_func(self.test_posterior.copy())
+            scores = abstaining_func.score_out_of_core(
+                posterior_probs=self.posterior_file, out=out_file,
+                chunk_size=700, tmp_dir=self.tmp_dir)
+            self.assertTrue(isinstance(scores, np.memmap))
+            np.testing.assert_allclose(np.load(out_file), expected,
+                rtol=1e-6, atol=1e-8*np.max(np.abs(expected)))
+        #the sorted runs are cleaned up
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ["posterior.npy", "scores.npy"])
@@ -0,0 +1,68 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.abstention import (MarginalDeltaAuRoc, MarginalDeltaAuPrc,
+                                   MarginalDeltaEvictionEngine,
+                                   AuRocEvictionEngine, AuPrcEvictionEngine,
+                                   FenwickTree)
+
+
+class TestRecursiveEviction(unittest.TestCase):
+
+    def test_auroc_engine_matches_full_recompute(self):
+        np.random.seed(1234)
+        sorted_ppos = np.sort(np.random.beta(0.5, 2, size=500))
+        full_engine = MarginalDeltaEvictionEngine(
+                        marginal_delta_metric=MarginalDeltaAuRoc(),
+                        sorted_ppos=sorted_ppos)
+        incremental_engine = AuRocEvictionEngine(sorted_ppos=sorted_ppos)
+        full_ordering = [full_engine.evict_next() for i in range(400)]
+        incremental_ordering = [incremental_engine.evict_next()
+                                for i in range(400)]
+        self.assertEqual(full_ordering, incremental_ordering)
+
+    def test_auroc_engine_evicts_all(self):
+        #down to a single class, where the estimated metric is nan
+        np.random.seed(1)
+        sorted_ppos = np.sort(np.random.rand(300))
+        engine = AuRocEvictionEngine(sorted_ppos=sorted_ppos)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ordering = [engine.evict_next() for i in range(300)]
+        self.assertEqual(sorted(ordering), list(range(300)))
+
+    def test_auprc_engine_matches_full_recompute(self):
+        for beta_params in [(0.5, 2), (1, 1), (5, 1)]:
+            np.random.seed(1234)
+            sorted_ppos = np.sort(np.random.beta(*beta_params, size=500))
+            full_engine = MarginalDeltaEvictionEngine(
+                            marginal_delta_metric=MarginalDeltaAuPrc(),
+                            sorted_ppos=sorted_ppos)
+            incremental_engine = AuPrcEvictionEngine(
+                                    sorted_ppos=sorted_ppos)
+            full_ordering = [full_engine.evict_next() for i in range(450)]
+            incremental_ordering = [incremental_engine.evict_next()
+                                    for i in range(450)]
+            self.assertEqual(full_ordering, incremental_ordering)
+
+    def test_fenwick_tree_scalar_and_vectorized_agree(self):
+        rng = np.random.RandomState(1)
+        values = rng.randint(0, 3, size=37).astype("float64")
+        tree = FenwickTree(37, values=values)
+        batch_tree = FenwickTree(37)
+        batch_tree.add(np.arange(37), values)
+        for position, value in [(0, 2.0), (36, 1.0), (17, -1.0)]:
+            tree.add_one(position, value)
+            batch_tree.add([position], value)
+            values[position] += value
+        np.testing.assert_allclose(tree.tree, batch_tree.tree)
+        np.testing.assert_allclose(
+            [tree.prefix_sum_one(position) for position in range(38)],
+            np.concatenate([[0.0], np.cumsum(values)]))
+        np.testing.assert_allclose(batch_tree.prefix_sum(np.arange(38)),
+                                   np.concatenate([[0.0], np.cumsum(values)]))
+        #the first position where the running sum reaches each target
+        for target in range(1, int(np.sum(values))+1):
+            self.assertEqual(tree.find_prefix(target),
+                             np.searchsorted(np.cumsum(values), target))
@@ -0,0 +1,157 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from multiprocessing import Pool
+from abstention import serialization
+from abstention.abstention import (MulticlassWrapper, MarginalDeltaAuRoc,
+                                   MarginalDeltaAuPrc,
+                                   RecursiveMarginalDeltaAuPrc,
+                                   NegativeAbsLogLikelihoodRatio,
+                                   NegPosteriorDistanceFromThreshold,
+                                   OptimalF1, Uncertainty, ConvexHybrid,
+                                   AuPrcAbstentionEval)
+from abstention.calibration import (TempScaling, PlattScaling,
+                                    IsotonicRegression,
+                                    ImbalanceAdaptationWrapper)
+from abstention.instrumentation import CallbackInstrumentation
+
+
+class TestSerialization(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.valid_posterior = np.random.rand(2000, 3)
+        self.valid_labels = 1.0*(np.random.rand(2000, 3)
+                                 < self.valid_posterior)
+        self.valid_uncert = np.random.rand(2000, 3)
+        self.test_posterior = np.random.rand(1000, 3)
+        self.test_uncert = np.random.rand(1000, 3)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_abstaining_funcs(self):
+        factories = [
+            MarginalDeltaAuRoc(verbose=False),
+            MarginalDeltaAuPrc(estimate_cdfs_from_valid=True, verbose=False),
+            NegativeAbsLogLikelihoodRatio(),
+            NegPosteriorDistanceFromThreshold(
+                OptimalF1(beta=1.0, verbose=False)),
+            MulticlassWrapper(ConvexHybrid(
+                factory1=MarginalDeltaAuPrc(verbose=False),
+                factory2=Uncertainty(),
+                abstention_eval_func=AuPrcAbstentionEval(
+                    proportion_to_retain=0.8),
+                verbose=False))]
+        return [factory(valid_labels=self.valid_labels,
+                        valid_posterior=self.valid_posterior,
+                        valid_uncert=self.valid_uncert)
+                for factory in factories]
+
+    def check_same_scores(self, funcs, loaded_funcs):
+        for func, loaded_func in zip(funcs, loaded_funcs):
+            np.testing.assert_allclose(
+                loaded_func(posterior_probs=self.test_posterior.copy(),
+                            uncertainties=self.test_uncert),
+                func(posterior_probs=self.test_posterior.copy(),
+                     uncertainties=self.test_uncert))
+
+    def test_pickle_abstaining_funcs(self):
+        funcs = self.get_abstaining_funcs()
+        self.check_same_scores(funcs, pickle.loads(pickle.dumps(funcs)))
+
+    def test_pickle_drops_instrumentation(self):
+        events = []
+        instrumentation = CallbackInstrumentation(
+                            lambda stage, fields: events.append(stage))
+        funcs = [
+            MarginalDeltaAuPrc(instrumentation=instrumentation)(
+                valid_labels=self.valid_labels[:,0],
+                valid_posterior=self.valid_posterior[:,0]),
+            RecursiveMarginalDeltaAuPrc(proportion_to_retain=0.9,
+                                        instrumentation=instrumentation)(
+                valid_labels=self.valid_labels[:,0],
+                valid_posterior=self.valid_posterior[:,0])]
+        unpickled_funcs = pickle.loads(pickle.dumps(funcs))
+        self.assertTrue(
+            unpickled_funcs[0].marginal_delta_metric.instrumentation is None)
+        self.assertTrue(unpickled_funcs[1].recursive_marginal_delta_metric
+                        .instrumentation is None)
+        #the original functions keep theirs
+        test_posterior = self.test_posterior[:,0]
+        for func, unpickled_func in zip(funcs, unpickled_funcs):
+            del events[:]
+            scores = func(posterior_probs=test_posterior.copy(),
+                          uncertainties=None)
+            self.assertTrue(len(events) > 0)
+            np.testing.assert_allclose(
+                unpickled_func(posterior_probs=test_posterior.copy(),
+                               uncertainties=None), scores)
+
+    def test_save_and_load_memmapped(self):
+        funcs = self.get_abstaining_funcs()
+        serialization.save(funcs, self.tmp_dir)
+        loaded_funcs = serialization.load(self.tmp_dir)
+        self.check_same_scores(funcs, loaded_funcs)
+        #the validation cdfs are memory-mapped
+        cdfs = loaded_funcs[0].validation_stats.cdfs
+        self.assertTrue(any(isinstance(x, np.memmap)
+                            for x in vars(cdfs).values()))
+
+    def test_save_and_load_calibrators(self):
+        valid_preacts = np.random.randn(2000)
+        valid_labels = 1.0*(np.random.rand(2000)
+                            < 1/(1+np.exp(-2*valid_preacts)))
+        test_preacts = np.random.randn(500)
+        funcs = [
+            PlattScaling(verbose=False)(valid_preacts=valid_preacts,
+                                        valid_labels=valid_labels),
+            IsotonicRegression(verbose=False)(valid_preacts=valid_preacts,
+                                              valid_labels=valid_labels),
+            ImbalanceAdaptationWrapper(
+                base_calibrator_factory=PlattScaling(verbose=False),
+                verbose=False)(valid_preacts=valid_preacts,
+                               valid_labels=valid_labels)]
+        softmax_preacts = np.random.randn(2000, 3)
+        softmax_labels = np.eye(3)[np.argmax(
+            softmax_preacts + np.random.randn(2000, 3), axis=1)]
+        temp_scaling_func = TempScaling(verbose=False)(
+            valid_preacts=softmax_preacts, valid_labels=softmax_labels)
+
+        serialization.save([funcs, temp_scaling_func], self.tmp_dir,
+                           min_array_nbytes=0)
+        loaded_funcs, loaded_temp_scaling_func =\
+            serialization.load(self.tmp_dir)
+        for func, loaded_func in zip(funcs, loaded_funcs):
+            np.testing.assert_allclose(loaded_func(test_preacts.copy()),
+                                       func(test_preacts.copy()))
+        np.testing.assert_allclose(
+            loaded_temp_scaling_func(softmax_preacts[:10]),
+            temp_scaling_func(softmax_preacts[:10]))
+
+    def test_multiclass_wrapper_process_pool(self):
+        factory = RecursiveMarginalDeltaAuPrc(proportion_to_retain=0.9,
+                                              verbose=False)
+        pool = Pool(2)
+        try:
+            func = MulticlassWrapper(factory, pool=pool)(
+                        valid_labels=self.valid_labels,
+                        valid_posterior=self.valid_posterior,
+                        valid_uncert=None)
+            scores = func(posterior_probs=self.test_posterior,
+                          uncertainties=None)
+        finally:
+            pool.close()
+            pool.join()
+        #the pool is not part of the pickled state
+        unpickled_func = pickle.loads(pickle.dumps(func))
+        self.assertTrue(unpickled_func.pool is None)
+        np.testing.assert_allclose(
+            unpickled_func(posterior_probs=self.test_posterior,
+                           uncertainties=None), scores)
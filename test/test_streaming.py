@@ -0,0 +1,50 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from abstention.abstention import (QuantileSketch,
+                                   StreamingMarginalDeltaScorer,
+                                   MarginalDeltaAuRoc, MarginalDeltaAuPrc)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.valid_posterior = np.random.beta(0.5, 2, size=5000)
+        self.valid_labels = 1.0*(np.random.rand(5000)
+                                 < self.valid_posterior)
+        self.test_posterior = np.random.beta(0.5, 2, size=200000)
+
+    def test_sketch_quantiles(self):
+        sketch = QuantileSketch(max_centroids=200)
+        for start_idx in range(0, len(self.test_posterior), 700):
+            sketch.update(self.test_posterior[start_idx:start_idx+700])
+        self.assertTrue(len(sketch.means) <= 201)
+        self.assertEqual(np.sum(sketch.counts), len(self.test_posterior))
+        probs = (np.arange(100)+0.5)/100
+        quantiles = sketch.get_quantiles(probs)
+        #rank error of each quantile, as a fraction of the stream
+        ranks = np.searchsorted(np.sort(self.test_posterior),
+                                quantiles)/len(self.test_posterior)
+        self.assertTrue(np.max(np.abs(ranks - probs)) <= 2/200)
+
+    def test_streaming_matches_batch(self):
+        #the scores of the last batch are within 0.5% (auROC) and 2%
+        #(auPRC, whose top tail is sparse) of the range of the batch
+        #scores
+        for metric, tolerance in [(MarginalDeltaAuRoc(verbose=False), 0.005),
+                                  (MarginalDeltaAuPrc(verbose=False), 0.02)]:
+            batch_scores = metric(valid_labels=self.valid_labels,
+                                  valid_posterior=self.valid_posterior)(
+                                  self.test_posterior)
+            scorer = StreamingMarginalDeltaScorer(metric,
+                        valid_labels=self.valid_labels,
+                        valid_posterior=self.valid_posterior)
+            for start_idx in range(0, len(self.test_posterior), 1000):
+                streaming_scores = scorer(
+                    self.test_posterior[start_idx:start_idx+1000])
+            self.assertTrue(
+                np.max(np.abs(streaming_scores - batch_scores[-1000:]))
+                < tolerance*np.max(np.abs(batch_scores)))
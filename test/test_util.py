@@ -0,0 +1,166 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from abstention.util import (WelfordAccumulator, obtain_raw_data,
+                             get_uncert_transform_funcs, prefetch_batches,
+                             get_batched_preact_func,
+                             obtain_posterior_probs_and_uncert_estimates)
+from abstention.calibration import PlattScaling, IsotonicRegression
+from abstention.instrumentation import RecordingInstrumentation
+
+
+class TestUtil(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.data = np.random.randn(300)
+        self.labels = 1.0*(np.random.rand(300) < 1/(1+np.exp(-self.data)))
+
+    def preact_func(self, data, learning_phase, batch_size):
+        if (learning_phase == 0):
+            return data
+        return data + np.random.randn(len(data))
+
+    def test_prefetch_batches(self):
+        batches = list(prefetch_batches(data=self.data, batch_size=64))
+        self.assertEqual([start_idx for start_idx, batch in batches],
+                         [0, 64, 128, 192, 256])
+        np.testing.assert_array_equal(
+            np.concatenate([batch for start_idx, batch in batches]),
+            self.data)
+        #stopping early must not leave the producer thread hanging
+        for start_idx, batch in prefetch_batches(data=self.data,
+                                                 batch_size=1):
+            break
+
+    def test_welford_matches_numpy(self):
+        runs = np.random.randn(50, 200)*3 + 100
+        accumulator = WelfordAccumulator()
+        for run in runs:
+            accumulator.update(run)
+        np.testing.assert_allclose(accumulator.get_mean(),
+                                   np.mean(runs, axis=0))
+        np.testing.assert_allclose(accumulator.get_std(),
+                                   np.std(runs, axis=0, ddof=1))
+        batch_accumulator = WelfordAccumulator()
+        for start_idx in range(0, 50, 15):
+            batch_accumulator.update_batch(runs[start_idx:start_idx+15])
+        np.testing.assert_allclose(batch_accumulator.get_mean(),
+                                   np.mean(runs, axis=0))
+        np.testing.assert_allclose(batch_accumulator.get_std(),
+                                   np.std(runs, axis=0, ddof=1))
+
+    def test_batched_preact_func(self):
+        data = np.random.randn(250, 3).astype("float32")
+        weights = np.random.randn(3, 4).astype("float32")
+        batch_sizes = []
+        #stands in for the keras backend function of a model
+        def model_func(inputs):
+            batch, learning_phase = inputs
+            batch_sizes.append(len(batch))
+            return [np.dot(batch, weights) + learning_phase]
+        expected = model_func([data, 1])[0]
+        for task_idx in [None, 2, [3, 0]]:
+            for prefetch in [True, False]:
+                del batch_sizes[:]
+                preacts = get_batched_preact_func(
+                    preact_func=model_func, task_idx=task_idx)(
+                    data=data, learning_phase=1, batch_size=64,
+                    prefetch=prefetch)
+                #the last batch is partial
+                self.assertEqual(batch_sizes, [64, 64, 64, 58])
+                self.assertEqual(preacts.dtype, np.float32)
+                np.testing.assert_array_equal(
+                    preacts, expected if task_idx is None
+                             else expected[:, task_idx])
+
+    def test_streaming_raw_data(self):
+        calibration_func = PlattScaling(verbose=False)(
+            valid_preacts=self.data, valid_labels=self.labels)
+        np.random.seed(1)
+        _, dropout_preacts = obtain_raw_data(
+            preact_func=self.preact_func, data=self.data,
+            num_dropout_runs=20, verbose=False)
+        np.random.seed(1)
+        instrumentation = RecordingInstrumentation()
+        _, transform_name_to_accumulator = obtain_raw_data(
+            preact_func=self.preact_func, data=self.data,
+            num_dropout_runs=20,
+            uncert_transform_funcs=get_uncert_transform_funcs(
+                OrderedDict([('platt', calibration_func)])),
+            instrumentation=instrumentation)
+        self.assertEqual([(stage, fields.get("num_runs_done"))
+                          for stage, fields in instrumentation.events],
+                         [("raw_data.deterministic", None),
+                          ("raw_data.dropout_progress", 10),
+                          ("raw_data.dropout_progress", 20)])
+        np.testing.assert_allclose(
+            transform_name_to_accumulator['preactivation'].get_std(),
+            np.std(dropout_preacts, axis=0, ddof=1))
+        np.testing.assert_allclose(
+            transform_name_to_accumulator['platt'].get_std(),
+            np.std([calibration_func(x) for x in dropout_preacts],
+                   axis=0, ddof=1))
+
+    def test_streaming_fits_calibrators_in_one_call(self):
+        cb_method_name_to_factory = OrderedDict([
+            ('platt', PlattScaling(verbose=False)),
+            ('isotonic', IsotonicRegression(verbose=False))])
+        np.random.seed(1)
+        _, valid_dropout_preacts = obtain_raw_data(
+            preact_func=self.preact_func, data=self.data,
+            num_dropout_runs=20, verbose=False)
+        _, test_dropout_preacts = obtain_raw_data(
+            preact_func=self.preact_func, data=self.data[:100],
+            num_dropout_runs=20, verbose=False)
+        expected = obtain_posterior_probs_and_uncert_estimates(
+            cb_method_name_to_factory=cb_method_name_to_factory,
+            valid_labels=self.labels, valid_preacts=self.data,
+            valid_dropout_preacts=valid_dropout_preacts,
+            test_preacts=self.data[:100],
+            test_dropout_preacts=test_dropout_preacts)
+        np.random.seed(1)
+        streamed = obtain_posterior_probs_and_uncert_estimates(
+            cb_method_name_to_factory=cb_method_name_to_factory,
+            valid_labels=self.labels, preact_func=self.preact_func,
+            valid_data=self.data, test_data=self.data[:100],
+            num_dropout_runs=20, verbose=False)
+        for expected_dict, streamed_dict in zip(expected, streamed):
+            self.assertEqual(list(expected_dict.keys()),
+                             list(streamed_dict.keys()))
+            for name in expected_dict:
+                np.testing.assert_allclose(streamed_dict[name],
+                                           expected_dict[name])
+
+    def test_batched_pooled_uncert_estimates(self):
+        valid_dropout_preacts = self.data[None,:]\
+                                + np.random.randn(20, len(self.data))
+        test_dropout_preacts = np.random.randn(20, 100)
+        cb_method_name_to_factory = OrderedDict([
+            ('platt', PlattScaling(verbose=False)),
+            ('isotonic', IsotonicRegression(verbose=False))])
+        pool = ThreadPool(2)
+        (_, _, transform_name_to_valid_uncert,
+         transform_name_to_test_uncert) =\
+            obtain_posterior_probs_and_uncert_estimates(
+                cb_method_name_to_factory=cb_method_name_to_factory,
+                valid_labels=self.labels,
+                valid_preacts=self.data,
+                valid_dropout_preacts=valid_dropout_preacts,
+                test_preacts=test_dropout_preacts[0],
+                test_dropout_preacts=test_dropout_preacts,
+                runs_per_batch=7, pool=pool)
+        pool.close()
+        self.assertEqual(list(transform_name_to_valid_uncert.keys()),
+                         ['preactivation', 'platt', 'isotonic'])
+        for cb_method_name, cb_factory in cb_method_name_to_factory.items():
+            cb_func = cb_factory(valid_preacts=self.data,
+                                 valid_labels=self.labels)
+            np.testing.assert_allclose(
+                transform_name_to_test_uncert[cb_method_name],
+                np.std([cb_func(x) for x in test_dropout_preacts],
+                       axis=0, ddof=1))